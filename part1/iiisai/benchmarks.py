@@ -0,0 +1,544 @@
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from iiisai.classifiers.k_nearest_neighbor import (KNearestNeighbor,
+                                                  open_reference_set)
+from iiisai.classifiers.knn_index import IVFIndex, recall_at_k
+from iiisai.classifiers.linear_classifier import LinearSVM
+from iiisai.classifiers.linear_svm import svm_loss_vectorized
+
+
+def time_function(f, *args, **kwargs):
+  """
+  Call f with the given arguments and return a tuple (seconds, result).
+  """
+  tic = time.time()
+  result = f(*args, **kwargs)
+  toc = time.time()
+  return toc - tic, result
+
+
+def check_knn_ties(num_unique=200, copies=5, num_test=100, dim=8, k=7,
+                   memory_budget=64 * 1024, seed=0):
+  """
+  Check that KNearestNeighbor.kneighbors breaks ties by the smaller training
+  index, on a training set made of repeated rows. The data are small
+  integers so that every distance is computed exactly, and the memory budget
+  is small so that ties are split across many tiles.
+
+  Returns:
+  The (num_test, k) array of neighbors; raises AssertionError on a mismatch.
+  """
+  rng = np.random.RandomState(seed)
+  unique = rng.randint(4, size=(num_unique, dim)).astype(np.float64)
+  X_train = unique[rng.randint(num_unique, size=num_unique * copies)]
+  X_test = rng.randint(4, size=(num_test, dim)).astype(np.float64)
+  classifier = KNearestNeighbor()
+  classifier.train(X_train, rng.randint(10, size=X_train.shape[0]))
+
+  dists = ((X_test[:, np.newaxis] - X_train) ** 2).sum(axis=2)
+  columns = np.broadcast_to(np.arange(X_train.shape[0]), dists.shape)
+  expected = np.lexsort((columns, dists), axis=1)[:, :k]
+  _, neighbors = classifier.kneighbors(X_test, k=k,
+                                       memory_budget=memory_budget)
+  assert np.all(neighbors == expected), 'kneighbors ties are not stable'
+  return neighbors
+
+
+def benchmark_knn_index(dims=(2, 4, 8, 16, 32, 64), num_train=20000,
+                        num_test=500, k=5, leaf_size=40, seed=0,
+                        verbose=True):
+  """
+  Time KNearestNeighbor.predict with KD-tree and ball-tree search against the
+  baseline compute_distances_no_loops path (num_loops=0) and the default
+  tiled brute force engine, on random Gaussian data of increasing
+  dimensionality.
+
+  The trees only pay off in low dimensions. On Gaussian data the KD-tree is
+  about 3x faster than no_loops with 5k training points in 2 dimensions and
+  about 100x faster with 200k points in 2 to 4 dimensions. By 8 dimensions
+  it barely wins even with 200k points, and beyond that both trees visit
+  most leaves and lose to brute force.
+
+  Inputs:
+  - dims: Dimensionalities to try.
+  - num_train, num_test: Number of training and test points.
+  - k: Number of neighbors.
+  - leaf_size: Leaf size of the trees.
+  - seed: Seed for the random data.
+  - verbose: If true, print one line per measurement.
+
+  Returns:
+  A list of dictionaries with keys 'dim', 'method', 'build_time',
+  'query_time', 'speedup' (no_loops query time over query_time) and 'exact'
+  (whether the neighbors and predictions match kneighbors).
+  """
+  rng = np.random.RandomState(seed)
+  results = []
+  for dim in dims:
+    X_train = rng.randn(num_train, dim)
+    y_train = rng.randint(10, size=num_train)
+    X_test = rng.randn(num_test, dim)
+
+    classifier = KNearestNeighbor()
+    build_time, _ = time_function(classifier.train, X_train, y_train)
+    baseline_time, _ = time_function(classifier.predict, X_test, k=k,
+                                     num_loops=0)
+    results.append({'dim': dim, 'method': 'no_loops',
+                    'build_time': build_time, 'query_time': baseline_time,
+                    'exact': True})
+    query_time, y_expected = time_function(classifier.predict, X_test, k=k)
+    results.append({'dim': dim, 'method': 'kneighbors',
+                    'build_time': build_time, 'query_time': query_time,
+                    'exact': True})
+    _, expected = classifier.kneighbors(X_test, k)
+
+    for method in ('kd_tree', 'ball_tree'):
+      classifier = KNearestNeighbor()
+      build_time, _ = time_function(classifier.train, X_train, y_train,
+                                    index=method, leaf_size=leaf_size)
+      query_time, y_pred = time_function(classifier.predict, X_test, k=k)
+      _, neighbors = classifier.index.query(X_test, k)
+      results.append({'dim': dim, 'method': method,
+                      'build_time': build_time, 'query_time': query_time,
+                      'exact': bool(np.all(neighbors == expected) and
+                                    np.all(y_pred == y_expected))})
+    for r in results[-4:]:
+      r['speedup'] = baseline_time / r['query_time']
+
+  if verbose:
+    for r in results:
+      print('dim %3d %-10s build %8.4fs query %8.4fs speedup %6.2fx '
+            'exact %s' % (r['dim'], r['method'], r['build_time'],
+                          r['query_time'], r['speedup'], r['exact']))
+  return results
+
+
+def check_knn_index_ties(num_train=5000, num_test=500, dim=8, k=10,
+                         seed=0):
+  """
+  Check that the KD-tree and ball-tree return the same neighbors and
+  predictions as KNearestNeighbor.kneighbors on tie-heavy data: points on a
+  coarse grid whose coordinates are not exact binary fractions, so that many
+  training points are at mathematically equal distances, plus exact
+  duplicate rows.
+
+  Raises AssertionError on a mismatch.
+  """
+  rng = np.random.RandomState(seed)
+  grid = rng.randint(3, size=(num_train // 2, dim)) / 7.0
+  copies = rng.randint(grid.shape[0], size=num_train - grid.shape[0])
+  X_train = np.vstack((grid, grid[copies]))
+  y_train = rng.randint(10, size=num_train)
+  X_test = rng.randint(3, size=(num_test, dim)) / 7.0
+
+  classifier = KNearestNeighbor()
+  classifier.train(X_train, y_train)
+  _, expected = classifier.kneighbors(X_test, k)
+  y_expected = classifier.predict(X_test, k=k)
+  for method in ('kd_tree', 'ball_tree'):
+    classifier = KNearestNeighbor()
+    classifier.train(X_train, y_train, index=method)
+    _, neighbors = classifier.index.query(X_test, k)
+    assert np.all(neighbors == expected), '%s neighbors differ' % method
+    assert np.all(classifier.predict(X_test, k=k) == y_expected), (
+      '%s predictions differ' % method)
+
+
+def benchmark_knn_ivf(X_train, X_test, k=10, n_lists=None,
+                      nprobes=(1, 2, 4, 8, 16, 32), num_single=100,
+                      verbose=True, **kwargs):
+  """
+  Measure the recall-vs-latency trade-off of the IVF index. Recall@k is
+  measured against the exact brute force neighbors from
+  KNearestNeighbor.kneighbors. Latency is measured both for the whole batch
+  of queries, where queries probing the same cell share its scan, and for
+  queries issued one at a time.
+
+  Inputs:
+  - X_train: Array of shape (num_train, D) of reference points.
+  - X_test: Array of shape (num_test, D) of queries.
+  - k: Number of neighbors.
+  - n_lists: Number of IVF cells; see IVFIndex.
+  - nprobes: Values of nprobe to try.
+  - num_single: Number of queries timed one at a time.
+  - verbose: If true, print one line per measurement.
+  - kwargs: Extra arguments for the IVFIndex constructor.
+
+  Returns:
+  A list of dictionaries with keys 'nprobe', 'recall', 'ms_per_query' and
+  'ms_single_query', plus one entry with nprobe None for exact search.
+  """
+  num_test = X_test.shape[0]
+  num_single = min(num_single, num_test)
+  classifier = KNearestNeighbor()
+  classifier.train(X_train, np.zeros(X_train.shape[0], dtype=np.int64))
+  exact_time, (_, exact) = time_function(classifier.kneighbors, X_test, k)
+  single_time, _ = time_function(
+    lambda: [classifier.kneighbors(X_test[i:i + 1], k)
+             for i in range(num_single)])
+  results = [{'nprobe': None, 'recall': 1.0,
+              'ms_per_query': 1000 * exact_time / num_test,
+              'ms_single_query': 1000 * single_time / num_single}]
+
+  build_time, index = time_function(IVFIndex, X_train, n_lists=n_lists,
+                                    **kwargs)
+  for nprobe in nprobes:
+    query_time, (_, neighbors) = time_function(index.query, X_test, k,
+                                               nprobe=nprobe)
+    single_time, _ = time_function(
+      lambda: [index.query(X_test[i:i + 1], k, nprobe=nprobe)
+               for i in range(num_single)])
+    results.append({'nprobe': nprobe,
+                    'recall': recall_at_k(neighbors, exact),
+                    'ms_per_query': 1000 * query_time / num_test,
+                    'ms_single_query': 1000 * single_time / num_single})
+
+  if verbose:
+    print('IVF build took %fs for %d cells' % (build_time,
+                                               index.centroids.shape[0]))
+    for r in results:
+      name = 'exact' if r['nprobe'] is None else 'nprobe %d' % r['nprobe']
+      print('%-10s recall@%d %.4f  %.4f ms/query batched  %.4f ms/query '
+            'single' % (name, k, r['recall'], r['ms_per_query'],
+                        r['ms_single_query']))
+  return results
+
+
+def check_knn_ivf_votes(num_train=5000, num_test=200, dim=16, k=20,
+                        n_lists=500, seed=0):
+  """
+  Check that KNearestNeighbor.predict through an IVF index whose probed
+  cells hold fewer than k points votes only with the neighbors it found:
+  the -1 entries that pad the result, and removed points, must not vote
+  for any label. Predictions are compared with a per-query majority vote
+  over the valid neighbors, before and after removing points.
+
+  Raises AssertionError on a mismatch.
+  """
+  rng = np.random.RandomState(seed)
+  X_train = rng.randn(num_train, dim)
+  y_train = rng.randint(10, size=num_train)
+  X_test = rng.randn(num_test, dim)
+  classifier = KNearestNeighbor()
+  classifier.train(X_train, y_train, index='ivf', n_lists=n_lists, nprobe=1)
+
+  for removed in (None, np.arange(0, num_train, 13)):
+    if removed is not None:
+      classifier.remove(removed)
+    _, neighbors = classifier._query_index(X_test, k)
+    assert np.any(neighbors < 0), 'Probed cells are not smaller than k'
+    expected = np.array([
+      np.argmax(np.bincount(classifier.y_train[row[row >= 0]],
+                            minlength=classifier.num_classes))
+      for row in neighbors])
+    assert np.all(classifier.predict(X_test, k=k) == expected), (
+      'Missing neighbors voted')
+
+
+def benchmark_knn_parallel(X_train, y_train, X_test, k=5,
+                           n_jobs_list=(1, 2, 4, 8),
+                           backends=('threads', 'processes'), verbose=True):
+  """
+  Measure how KNearestNeighbor.predict scales with the number of workers.
+
+  Inputs:
+  - X_train, y_train: Reference points and labels.
+  - X_test: Queries.
+  - k: Number of neighbors.
+  - n_jobs_list: Worker counts to try.
+  - backends: Parallel backends to try; see KNearestNeighbor.predict.
+  - verbose: If true, print one line per measurement.
+
+  Returns:
+  A list of dictionaries with keys 'backend', 'n_jobs', 'time' and 'speedup'
+  (relative to a single worker).
+  """
+  classifier = KNearestNeighbor()
+  classifier.train(X_train, y_train)
+  serial_time, expected = time_function(classifier.predict, X_test, k=k)
+
+  results = []
+  for backend in backends:
+    for n_jobs in n_jobs_list:
+      elapsed, y_pred = time_function(classifier.predict, X_test, k=k,
+                                      n_jobs=n_jobs, backend=backend)
+      assert np.all(y_pred == expected), 'Parallel predictions differ'
+      results.append({'backend': backend, 'n_jobs': n_jobs, 'time': elapsed,
+                      'speedup': serial_time / elapsed})
+
+  if verbose:
+    for r in results:
+      print('%-9s n_jobs %d: %8.4fs (%.2fx)' % (
+            r['backend'], r['n_jobs'], r['time'], r['speedup']))
+  return results
+
+
+def benchmark_knn_precision(X_train, y_train, X_test, y_test, k=1,
+                            storage_dtypes=('float32', 'float16', 'uint8'),
+                            verbose=True):
+  """
+  Compare KNearestNeighbor accuracy, memory and speed when the training set
+  is stored in reduced precision against the float64 baseline. Intended for
+  CIFAR-10 rows as produced by load_CIFAR10 and reshaped to (N, 3072).
+
+  Inputs:
+  - X_train, y_train: Reference points and labels.
+  - X_test, y_test: Test points and labels.
+  - k: Number of neighbors.
+  - storage_dtypes: Reduced types to try; see KNearestNeighbor.train.
+  - verbose: If true, print one line per storage type.
+
+  Returns:
+  A list of dictionaries with keys 'storage_dtype', 'accuracy',
+  'accuracy_delta' (relative to float64), 'nbytes' and 'time'.
+  """
+  results = []
+  baseline = None
+  for storage_dtype in ('float64',) + tuple(storage_dtypes):
+    classifier = KNearestNeighbor()
+    classifier.train(X_train.astype(np.float64), y_train,
+                     storage_dtype=storage_dtype)
+    elapsed, y_pred = time_function(classifier.predict, X_test, k=k)
+    accuracy = np.mean(y_pred == y_test)
+    if baseline is None:
+      baseline = accuracy
+    results.append({'storage_dtype': storage_dtype, 'accuracy': accuracy,
+                    'accuracy_delta': accuracy - baseline,
+                    'nbytes': classifier.X_train.nbytes, 'time': elapsed})
+
+  if verbose:
+    for r in results:
+      print('%-8s accuracy %.4f (%+.4f)  %8.1f MB  %8.4fs' % (
+            r['storage_dtype'], r['accuracy'], r['accuracy_delta'],
+            r['nbytes'] / 1024.0 ** 2, r['time']))
+  return results
+
+
+def benchmark_knn_memmap(X_train, y_train, X_test, k=5, num_shards=1,
+                         memory_budget=64 * 1024 ** 2, verbose=True):
+  """
+  Compare KNearestNeighbor.predict on an in-memory training set against the
+  same training set memory-mapped from .npy files in a temporary directory.
+
+  Note that a file that was just written is usually still in the page cache,
+  so this measures the streaming overhead rather than cold disk reads.
+
+  Inputs:
+  - X_train, y_train: Reference points and labels.
+  - X_test: Queries.
+  - k: Number of neighbors.
+  - num_shards: If 1 a single .npy file is used, otherwise X_train is split
+    into this many shards in a directory.
+  - memory_budget: Tile memory budget passed to predict.
+  - verbose: If true, print one line per source.
+
+  Returns:
+  A list of dictionaries with keys 'source', 'time' and 'throughput' (MB of
+  training data scanned per second).
+  """
+  directory = tempfile.mkdtemp()
+  try:
+    if num_shards == 1:
+      path = os.path.join(directory, 'X_train.npy')
+      np.save(path, X_train)
+    else:
+      path = os.path.join(directory, 'shards')
+      os.mkdir(path)
+      for i, shard in enumerate(np.array_split(X_train, num_shards)):
+        np.save(os.path.join(path, '%05d.npy' % i), shard)
+
+    results = []
+    for source, data in (('memory', X_train), ('memmap', path)):
+      classifier = KNearestNeighbor()
+      classifier.train(data, y_train)
+      elapsed, _ = time_function(classifier.predict, X_test, k=k,
+                                 memory_budget=memory_budget)
+      results.append({'source': source, 'time': elapsed,
+                      'throughput': X_train.nbytes / 1024.0 ** 2 / elapsed})
+      del classifier
+  finally:
+    shutil.rmtree(directory)
+
+  if verbose:
+    for r in results:
+      print('%-7s %8.4fs  %9.1f MB/s' % (r['source'], r['time'],
+                                         r['throughput']))
+  return results
+
+
+def check_knn_sharded_index(num_train=3000, num_test=100, dim=16, k=5,
+                            num_shards=3, seed=0):
+  """
+  Check that a training set memory-mapped from a directory of .npy shards
+  can be searched through an index: for each index type, the neighbors of
+  KNearestNeighbor trained on the shards must match those of the same index
+  over the in-memory array, and integer-array row indexing of the shards
+  must match the array.
+
+  Raises AssertionError on a mismatch.
+  """
+  rng = np.random.RandomState(seed)
+  X_train = rng.randn(num_train, dim)
+  y_train = rng.randint(10, size=num_train)
+  X_test = rng.randn(num_test, dim)
+  directory = tempfile.mkdtemp()
+  try:
+    for i, shard in enumerate(np.array_split(X_train, num_shards)):
+      np.save(os.path.join(directory, '%05d.npy' % i), shard)
+    rows = rng.randint(-num_train, num_train, size=(7, 3))
+    assert np.all(open_reference_set(directory)[rows] == X_train[rows]), (
+      'Sharded row indexing differs')
+
+    for index in ('kd_tree', 'ball_tree', 'ivf'):
+      expected = KNearestNeighbor()
+      expected.train(X_train, y_train, index=index)
+      classifier = KNearestNeighbor()
+      classifier.train(directory, y_train, index=index)
+      assert np.all(classifier.index.query(X_test, k)[1] ==
+                    expected.index.query(X_test, k)[1]), (
+        'Neighbors from sharded %s differ' % index)
+      assert np.all(classifier.predict(X_test, k=k) ==
+                    expected.predict(X_test, k=k)), (
+        'Predictions from sharded %s differ' % index)
+      del classifier
+  finally:
+    shutil.rmtree(directory)
+
+
+def benchmark_linear_sweep(X_train, y_train, X_val, y_val,
+                           learning_rates=(1e-7, 5e-7, 1e-6, 5e-6),
+                           regularization_strengths=(1e3, 1e4, 2.5e4, 5e4),
+                           num_iters=200, batch_size=200, classifier=LinearSVM,
+                           verbose=True):
+  """
+  Compare a hyperparameter grid search that trains one classifier after
+  another, as the svm and softmax notebooks do, against train_sweep, which
+  trains all of them in one run.
+
+  Inputs:
+  - X_train, y_train, X_val, y_val: Training and validation data.
+  - learning_rates, regularization_strengths: The grid to search.
+  - num_iters, batch_size: Passed on to training.
+  - classifier: LinearSVM or Softmax.
+  - verbose: If true, print one line per method.
+
+  Returns:
+  A list of dictionaries with keys 'method', 'time' and 'best_val_accuracy'.
+  """
+  def serial():
+    best_val = -1
+    for lr in learning_rates:
+      for reg in regularization_strengths:
+        model = classifier()
+        model.train(X_train, y_train, learning_rate=lr, reg=reg,
+                    num_iters=num_iters, batch_size=batch_size)
+        best_val = max(best_val, np.mean(model.predict(X_val) == y_val))
+    return best_val
+
+  serial_time, serial_best = time_function(serial)
+  sweep_time, results = time_function(
+      classifier.train_sweep, X_train, y_train, X_val, y_val, learning_rates,
+      regularization_strengths, num_iters=num_iters, batch_size=batch_size)
+  results = [{'method': 'serial', 'time': serial_time,
+              'best_val_accuracy': serial_best},
+             {'method': 'train_sweep', 'time': sweep_time,
+              'best_val_accuracy': max(r['val_accuracy']
+                                       for r in results.values())}]
+
+  if verbose:
+    for r in results:
+      print('%-11s %8.3fs  best val accuracy %f' % (
+            r['method'], r['time'], r['best_val_accuracy']))
+  return results
+
+
+def _svm_loss_vectorized_original(W, X, y, reg):
+  """
+  The original svm_loss_vectorized, which builds several (N, C) temporaries
+  and takes two X.T.dot products.
+  """
+  num_classes = W.shape[1]
+  num_train = X.shape[0]
+  scores = X.dot(W)
+  correct_class_scores = scores[np.arange(len(X)), y]
+  margins = scores - correct_class_scores[:, None] + 1
+  margins_mask = margins < 0
+  margins[margins_mask] = 0
+  margins[np.arange(len(margins)), y] = 0
+  loss = np.sum(margins, axis=1)
+  loss = np.sum(loss)
+  include_in_computation = 1 * (margins > 0)
+  times_to_exclude = include_in_computation.sum(axis=1)
+  correct_class_indices = np.zeros(include_in_computation.shape)
+  correct_class_indices[np.arange(num_train), y] = 1
+  correct_class_exclusion = correct_class_indices * np.transpose(
+      [times_to_exclude] * num_classes)
+  dW = X.T.dot(include_in_computation) - X.T.dot(correct_class_exclusion)
+  loss /= num_train
+  dW /= num_train
+  loss += reg * np.sum(W * W)
+  dW += 2 * reg * W
+  return loss, dW
+
+
+def benchmark_svm_loss(num_train=500, dim=3073, num_classes=10, reg=2.5e4,
+                       num_repeats=100, seed=0, verbose=True):
+  """
+  Compare the original svm_loss_vectorized against the current one in
+  float64 and float32, with and without a workspace, on random data of
+  CIFAR-10 size (a minibatch of num_train images with a bias dimension).
+
+  Inputs:
+  - num_train, dim, num_classes: Shape of the problem.
+  - reg: Regularization strength.
+  - num_repeats: Number of calls timed for each method.
+  - seed: Seed for the random data.
+  - verbose: If true, print one line per method.
+
+  Returns:
+  A list of dictionaries with keys 'method', 'time_per_call' and
+  'max_error' (largest difference of the loss or gradient from the
+  original, relative to the largest gradient entry).
+  """
+  rng = np.random.RandomState(seed)
+  X = rng.randn(num_train, dim)
+  y = rng.randint(num_classes, size=num_train)
+  W = 0.0001 * rng.randn(dim, num_classes)
+  expected_loss, expected_grad = _svm_loss_vectorized_original(W, X, y, reg)
+  scale = np.abs(expected_grad).max()
+
+  X32, W32 = X.astype(np.float32), W.astype(np.float32)
+  methods = [
+    ('original', _svm_loss_vectorized_original, (W, X, y, reg), {}),
+    ('fused float64', svm_loss_vectorized, (W, X, y, reg), {}),
+    ('fused float64 workspace', svm_loss_vectorized, (W, X, y, reg),
+     {'workspace': np.empty((num_train, num_classes))}),
+    ('fused float32', svm_loss_vectorized, (W32, X32, y, reg), {}),
+    ('fused float32 workspace', svm_loss_vectorized, (W32, X32, y, reg),
+     {'workspace': np.empty((num_train, num_classes), np.float32)}),
+  ]
+
+  results = []
+  for method, f, args, kwargs in methods:
+    def repeat():
+      for _ in range(num_repeats):
+        result = f(*args, **kwargs)
+      return result
+    seconds, (loss, grad) = time_function(repeat)
+    max_error = max(abs(loss - expected_loss) / abs(expected_loss),
+                    np.abs(grad - expected_grad).max() / scale)
+    results.append({'method': method, 'time_per_call': seconds / num_repeats,
+                    'max_error': max_error})
+
+  if verbose:
+    for r in results:
+      print('%-23s %8.3f ms / call  max error %g' % (
+            r['method'], r['time_per_call'] * 1e3, r['max_error']))
+  return results
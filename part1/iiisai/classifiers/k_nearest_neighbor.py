@@ -1,28 +1,123 @@
+import ctypes
+import os
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from multiprocessing.sharedctypes import RawArray
+
 import numpy as np
 from past.builtins import xrange
 
+from iiisai.classifiers.knn_index import (INDEX_TYPES, exact_sq_dists,
+                                         _merge_top_k, _sort_neighbors)
+
+
+# Default upper bound, in bytes, on the working memory of one distance tile.
+DEFAULT_MEMORY_BUDGET = 256 * 1024 ** 2
+
+# Smallest number of test points processed together when the train set has to
+# be split into blocks; keeps the matrix multiplies reasonably wide.
+MIN_TEST_BLOCK = 256
+
+# Types the training set can be stored as; see KNearestNeighbor.train.
+STORAGE_DTYPES = ('float64', 'float32', 'float16', 'uint8')
+
+# remove() compacts the training set once more than this fraction of its rows
+# are tombstones.
+COMPACT_FRACTION = 0.25
+
+# add() rebuilds the search index once the rows added since it was built
+# exceed this fraction of the rows it covers; until then they are searched
+# by brute force.
+REBUILD_FRACTION = 0.25
+
+# kneighbors collects this many candidates beyond k with the tiled distance
+# expansion, whose rounding depends on where a row falls in a tile, and then
+# ranks them by exact_sq_dists.
+RERANK_PAD = 8
+
+# Upper bound in bytes on the candidate rows gathered at once for ranking.
+RERANK_BLOCK_BYTES = 1024 ** 2
+
+# Added to distances before inverting them for distance-weighted voting, so
+# that exact matches get a large but finite weight.
+WEIGHT_EPS = 1e-8
+
 
 class KNearestNeighbor(object):
   """ a kNN classifier with L2 distance """
 
   def __init__(self):
-    pass
+    self.index = None
+    self._shared_train = None
 
-  def train(self, X, y):
+  def train(self, X, y, storage_dtype=None, index=None, **index_params):
     """
     Train the classifier. For k-nearest neighbors this is just 
-    memorizing the training data.
+    memorizing the training data. The rows get the ids 0, ..., num_train - 1
+    in train_ids; see add and remove for updating the training set later.
 
     Inputs:
     - X: A numpy array of shape (num_train, D) containing the training data
-      consisting of num_train samples each of dimension D.
+      consisting of num_train samples each of dimension D. X can also be the
+      path of a .npy file or of a directory of .npy shards (concatenated in
+      filename order); these are memory-mapped and streamed from disk one
+      train block at a time instead of being loaded.
     - y: A numpy array of shape (N,) containing the training labels, where
-         y[i] is the label for X[i].
+         y[i] is the label for X[i], or the path of a .npy file holding them.
+    - storage_dtype: If None, keep a reference to X as is. Otherwise store a
+      copy of X as one of STORAGE_DTYPES; 'uint8' quantizes every dimension
+      linearly between its minimum and maximum. Reduced types are decoded to
+      float32 one train block at a time and distances are accumulated in
+      float32.
+    - index: Optional search index used by predict instead of brute force.
+      Either the name of an index in knn_index.INDEX_TYPES ('kd_tree',
+      'ball_tree' or the approximate 'ivf'), which is then built over X, or an
+      already built index object with a query(X, k) method, for example one
+      restored with IVFIndex.load. When add() or compact() rebuild it, the
+      new index has the same type and the parameters of its get_params()
+      method if it has one. The default brute force search is the
+      right choice unless D is small: the trees only beat it in about eight
+      dimensions or fewer, by a margin that grows with num_train (see
+      benchmarks.benchmark_knn_index).
+    - index_params: Extra keyword arguments for the index constructor, such
+      as leaf_size for the trees or n_lists and nprobe for 'ivf'.
     """
-    self.X_train = X
+    if isinstance(y, str):
+      y = np.load(y)
     self.y_train = y
+    self._store_train(X, storage_dtype)
+    self.num_classes = int(np.max(y)) + 1
+
+    # Stable ids of the training rows, used by add() and remove(). Rows are
+    # only ever appended or compacted, so ids stay sorted.
+    num_train = self.X_train.shape[0]
+    self.train_ids = np.arange(num_train)
+    self._next_id = num_train
+    # Tombstones: None while every row is alive, else a boolean mask.
+    self.alive = None
+    # Growable buffers backing the training arrays after add().
+    self._buffers = {}
+
+    if isinstance(index, str):
+      if index not in INDEX_TYPES:
+        raise ValueError('Invalid index "%s"' % index)
+      self._index_builder = (INDEX_TYPES[index], index_params)
+      if self.train_path is not None:
+        # The index keeps its own reordered copy of the data anyway, so the
+        # on-disk training set is read into memory once up front.
+        X = self._train_block(0, num_train)
+      index = INDEX_TYPES[index](X, **index_params)
+    elif index is not None:
+      # Rebuilds after add() and remove() keep the parameters of the index.
+      params = index.get_params() if hasattr(index, 'get_params') else {}
+      self._index_builder = (type(index), params)
+    self.index = index
+    self._num_indexed = num_train
+    self._shared_train = None
     
-  def predict(self, X, k=1, num_loops=0):
+  def predict(self, X, k=1, num_loops=None,
+              memory_budget=DEFAULT_MEMORY_BUDGET, weighted=False, n_jobs=1,
+              backend='threads'):
     """
     Predict labels for test data using this classifier.
 
@@ -31,13 +126,30 @@ class KNearestNeighbor(object):
          of num_test samples each of dimension D.
     - k: The number of nearest neighbors that vote for the predicted labels.
     - num_loops: Determines which implementation to use to compute distances
-      between training points and testing points.
+      between training points and testing points. If None (the default) the
+      index built in train is queried if there is one, and otherwise the
+      tiled engine in kneighbors is used; neither builds the full distance
+      matrix.
+    - memory_budget: Upper bound in bytes on the working memory of a single
+      distance tile; only used when num_loops is None.
+    - weighted: If True, neighbors vote with weight 1 / distance instead of
+      one vote each.
+    - n_jobs: Number of workers the test points are split across; only used
+      when num_loops is None. The memory budget is divided between them.
+    - backend: 'threads' or 'processes'. Threads share everything and rely on
+      NumPy releasing the GIL; processes get the training data through shared
+      memory and only support brute force search.
 
     Returns:
     - y: A numpy array of shape (num_test,) containing predicted labels for the
       test data, where y[i] is the predicted label for the test point X[i].  
     """
-    if num_loops == 0:
+    if num_loops is None:
+      if n_jobs > 1 and X.shape[0] > 1:
+        return self._predict_parallel(X, k, memory_budget, weighted, n_jobs,
+                                      backend)
+      return self._predict_block(X, k, memory_budget, weighted)
+    elif num_loops == 0:
       dists = self.compute_distances_no_loops(X)
     elif num_loops == 1:
       dists = self.compute_distances_one_loop(X)
@@ -46,7 +158,561 @@ class KNearestNeighbor(object):
     else:
       raise ValueError('Invalid value %d for num_loops' % num_loops)
 
-    return self.predict_labels(dists, k=k)
+    return self.predict_labels(dists, k=k, weighted=weighted)
+
+  def partial_fit(self, X, y):
+    """
+    Train on X and y if the classifier is untrained, and otherwise add them to
+    the training set with add(). Returns the ids of the new rows.
+    """
+    if getattr(self, 'X_train', None) is None:
+      self.train(X, y)
+      return self.train_ids.copy()
+    return self.add(X, y)
+
+  def add(self, X, y):
+    """
+    Append points to the training set without retraining.
+
+    Rows are written into a buffer that grows geometrically, so repeated
+    adds copy the training set only O(log N) times. The cached squared norms
+    are extended with the norms of the new rows, reduced storage types encode
+    them with the scale and offset chosen in train, and new rows are searched
+    by brute force next to the index until they are numerous enough to
+    trigger a rebuild (see REBUILD_FRACTION).
+
+    Inputs:
+    - X: A numpy array of shape (M, D) of new points.
+    - y: A numpy array of shape (M,) of their labels.
+
+    Returns:
+    - ids: An integer array of shape (M,) of the ids given to the new rows.
+    """
+    if self.train_path is not None:
+      raise ValueError('Cannot add to an on-disk training set')
+    num_old, num_new = self.X_train.shape[0], X.shape[0]
+    num_train = num_old + num_new
+    if self.train_scale is not None:
+      codes = np.rint((X - self.train_offset) / self.train_scale)
+      X = np.clip(codes, 0, 255)
+    ids = np.arange(self._next_id, self._next_id + num_new)
+    self._next_id += num_new
+
+    self._append('X_train', X)
+    self._append('y_train', y)
+    self._append('train_ids', ids)
+    if self.alive is not None:
+      self._append('alive', np.ones(num_new, dtype=bool))
+    block = self._train_block(num_old, num_train)
+    self._append('train_sq_norms', np.einsum('ij,ij->i', block, block))
+    self.num_classes = max(self.num_classes, int(np.max(y)) + 1)
+    self._shared_train = None
+
+    if (self.index is not None and
+        num_train - self._num_indexed > REBUILD_FRACTION * self._num_indexed):
+      self._rebuild_index()
+    return ids
+
+  def _append(self, name, rows):
+    """
+    Append rows to the array attribute name. The attribute becomes a view of
+    a buffer with spare capacity that later appends fill in place; the buffer
+    doubles whenever it runs out.
+    """
+    a = getattr(self, name)
+    n, m = a.shape[0], len(rows)
+    buf = self._buffers.get(name)
+    if buf is None or buf.shape[0] < n + m:
+      buf = np.empty((max(2 * n, n + m),) + a.shape[1:], dtype=a.dtype)
+      buf[:n] = a
+      self._buffers[name] = buf
+    buf[n:n + m] = rows
+    setattr(self, name, buf[:n + m])
+
+  def remove(self, ids):
+    """
+    Remove points from the training set by id.
+
+    Removed rows are only marked with a tombstone and skipped by searches;
+    once more than COMPACT_FRACTION of the rows are tombstones the training
+    set is compacted, which changes row positions but not ids.
+
+    Inputs:
+    - ids: Integer array of ids, as returned by add() or found in train_ids.
+    """
+    if self.train_path is not None:
+      raise ValueError('Cannot remove from an on-disk training set')
+    ids = np.asarray(ids)
+    positions = np.searchsorted(self.train_ids, ids)
+    found = positions < self.train_ids.shape[0]
+    positions, ids = positions[found], ids[found]
+    positions = positions[self.train_ids[positions] == ids]
+    if self.alive is None:
+      self.alive = np.ones(self.X_train.shape[0], dtype=bool)
+      self._buffers.pop('alive', None)
+    self.alive[positions] = False
+    self._shared_train = None
+    num_dead = self.alive.shape[0] - np.count_nonzero(self.alive)
+    if num_dead > COMPACT_FRACTION * self.alive.shape[0]:
+      self.compact()
+
+  def compact(self):
+    """
+    Drop tombstoned rows from the training set and rebuild the index.
+    """
+    if self.alive is None:
+      return
+    keep = self.alive
+    self.X_train = self.X_train[keep]
+    self.y_train = self.y_train[keep]
+    self.train_ids = self.train_ids[keep]
+    self.train_sq_norms = self.train_sq_norms[keep]
+    self.alive = None
+    self._buffers = {}
+    self._shared_train = None
+    if self.index is not None:
+      self._rebuild_index()
+
+  def _rebuild_index(self):
+    """
+    Build a new index of the same type over the current training set.
+    """
+    index_type, index_params = self._index_builder
+    X = self._train_block(0, self.X_train.shape[0])
+    self.index = index_type(X, **index_params)
+    self._num_indexed = self.X_train.shape[0]
+
+  def _query_index(self, X, k):
+    """
+    Answer a k-NN query through the index, skipping tombstoned rows and
+    searching rows added since the index was built by brute force.
+    """
+    num_indexed = self._num_indexed
+    num_dead = 0
+    if self.alive is not None:
+      num_dead = num_indexed - np.count_nonzero(self.alive[:num_indexed])
+    # At most num_dead of the returned neighbors can be tombstones.
+    dists, neighbors = self.index.query(X, k=k + num_dead)
+    if num_dead:
+      valid = (neighbors >= 0) & self.alive[neighbors]
+      # A stable sort moves the live neighbors to the front in order.
+      order = np.argsort(~valid, axis=1, kind='mergesort')[:, :k]
+      rows = np.arange(X.shape[0])[:, np.newaxis]
+      dists, neighbors = dists[rows, order], neighbors[rows, order]
+      dists[~valid[rows, order]] = np.inf
+      neighbors[~valid[rows, order]] = -1
+    if num_indexed < self.X_train.shape[0]:
+      tail_dists, tail_neighbors = self._brute_force(
+        X, k, DEFAULT_MEMORY_BUDGET, first=num_indexed)
+      dists = np.hstack((dists, tail_dists))
+      neighbors = np.hstack((neighbors, tail_neighbors))
+      order = _sort_neighbors(dists, neighbors)[:, :k]
+      rows = np.arange(X.shape[0])[:, np.newaxis]
+      dists, neighbors = dists[rows, order], neighbors[rows, order]
+    return dists, neighbors
+
+  def _store_train(self, X, storage_dtype):
+    """
+    Set X_train, its decoding parameters and the cached squared norms.
+    """
+    self.train_scale = None
+    self.train_offset = None
+    self.train_path = None
+    if isinstance(X, str):
+      if storage_dtype is not None:
+        raise ValueError('storage_dtype is not supported for on-disk data')
+      self.train_path = X
+      X = open_reference_set(X)
+
+    if storage_dtype is None:
+      self.storage_dtype = None
+      self.compute_dtype = None
+      self.X_train = X
+      if self.train_path is None:
+        # Squared L2 norms of the training points, shared by every tile.
+        self.train_sq_norms = np.einsum('ij,ij->i', X, X)
+        return
+      self._compute_train_norms()
+      return
+
+    storage_dtype = np.dtype(storage_dtype)
+    if storage_dtype.name not in STORAGE_DTYPES:
+      raise ValueError('Invalid storage_dtype "%s"' % storage_dtype)
+    self.storage_dtype = storage_dtype
+    self.compute_dtype = np.dtype(np.float64 if storage_dtype == np.float64
+                                  else np.float32)
+    if storage_dtype == np.uint8:
+      low = X.min(axis=0)
+      scale = (X.max(axis=0) - low) / 255.0
+      scale[scale == 0] = 1
+      codes = np.rint((X - low) / scale)
+      self.X_train = np.clip(codes, 0, 255).astype(np.uint8)
+      self.train_scale = scale.astype(np.float32)
+      self.train_offset = low.astype(np.float32)
+    else:
+      self.X_train = X.astype(storage_dtype)
+    self._compute_train_norms()
+
+  def _compute_train_norms(self):
+    """
+    Compute the cached squared norms one decoded train block at a time.
+    """
+    num_train, dim = self.X_train.shape
+    dtype = self.compute_dtype
+    if dtype is None:
+      dtype = np.result_type(self.X_train.dtype, np.float32)
+    self.train_sq_norms = np.zeros(num_train, dtype=dtype)
+    _, train_block = _block_sizes(1, num_train, DEFAULT_MEMORY_BUDGET, 0,
+                                  2 * dim * dtype.itemsize)
+    for start, stop, block in self._iter_train_blocks(train_block):
+      self.train_sq_norms[start:stop] = np.einsum('ij,ij->i', block, block)
+
+  def _train_block(self, start, stop):
+    """
+    Return rows start:stop of the training set, read into memory if it is on
+    disk and decoded to compute_dtype if it is stored in a reduced type.
+    """
+    block = self.X_train[start:stop]
+    if self.train_path is not None:
+      block = np.array(block)
+    if self.compute_dtype is None:
+      return block
+    block = block.astype(self.compute_dtype, copy=False)
+    if self.train_scale is not None:
+      block *= self.train_scale
+      block += self.train_offset
+    return block
+
+  def _train_rows(self, rows):
+    """
+    Like _train_block, for an integer array of row positions of any shape.
+    """
+    block = self.X_train[rows]
+    if self.compute_dtype is None:
+      return block
+    block = block.astype(self.compute_dtype, copy=False)
+    if self.train_scale is not None:
+      block *= self.train_scale
+      block += self.train_offset
+    return block
+
+  def _iter_train_blocks(self, train_block, first=0):
+    """
+    Yield (start, stop, block) for consecutive blocks of train_block rows,
+    beginning at row first. For on-disk training sets the next block is read
+    in a background thread while the caller works on the current one.
+    """
+    num_train = self.X_train.shape[0]
+    bounds = [(start, min(start + train_block, num_train))
+              for start in xrange(first, num_train, train_block)]
+    if self.train_path is None:
+      for start, stop in bounds:
+        yield start, stop, self._train_block(start, stop)
+      return
+
+    reader = ThreadPool(1)
+    try:
+      pending = reader.apply_async(self._train_block, bounds[0])
+      for i, (start, stop) in enumerate(bounds):
+        block = pending.get()
+        if i + 1 < len(bounds):
+          pending = reader.apply_async(self._train_block, bounds[i + 1])
+        yield start, stop, block
+    finally:
+      reader.close()
+
+  def _query_dtype(self, X):
+    """
+    Return the dtype test points and distance tiles are computed in.
+    """
+    if self.compute_dtype is not None:
+      return self.compute_dtype
+    return np.result_type(X.dtype, self.X_train.dtype, np.float32)
+
+  def _predict_block(self, X, k, memory_budget, weighted):
+    """
+    Predict labels for X in the current thread, through the index if there
+    is one and through kneighbors otherwise.
+    """
+    if self.index is not None:
+      dists, neighbors = self._query_index(X, k)
+    else:
+      dists, neighbors = self.kneighbors(X, k=k, memory_budget=memory_budget)
+    return self.vote_labels(neighbors, dists if weighted else None)
+
+  def _predict_parallel(self, X, k, memory_budget, weighted, n_jobs, backend):
+    """
+    Split X into n_jobs contiguous shards, predict each on a worker pool and
+    concatenate the results in order.
+    """
+    shards = np.array_split(X, min(n_jobs, X.shape[0]))
+    memory_budget = memory_budget // len(shards)
+    if backend == 'threads':
+      pool = ThreadPool(len(shards))
+      try:
+        results = pool.map(
+          lambda shard: self._predict_block(shard, k, memory_budget, weighted),
+          shards)
+      finally:
+        pool.close()
+    elif backend == 'processes':
+      if self.index is not None:
+        raise ValueError('The processes backend does not support indexes')
+      if self._shared_train is None:
+        # Copy the training set into shared memory once; workers map it
+        # instead of receiving a pickled copy.
+        # On-disk training sets are reopened by path in every worker.
+        self._shared_train = dict(
+          (name, _to_shared(getattr(self, name))) for name in _SHARED_ARRAYS
+          if getattr(self, name) is not None and
+          not (name == 'X_train' and self.train_path is not None))
+      state = dict((name, getattr(self, name)) for name in _WORKER_STATE)
+      pool = Pool(len(shards), initializer=_init_worker,
+                  initargs=(self._shared_train, state))
+      try:
+        results = pool.map(_predict_worker,
+                           [(shard, k, memory_budget, weighted)
+                            for shard in shards])
+      finally:
+        pool.close()
+        pool.join()
+    else:
+      raise ValueError('Invalid backend "%s"' % backend)
+    return np.concatenate(results)
+
+  def cross_validate(self, X, y, k_choices, num_folds=5, n_jobs=1,
+                     memory_budget=DEFAULT_MEMORY_BUDGET, storage_dtype=None,
+                     weighted=False):
+    """
+    Measure validation accuracy for several values of k with num_folds-fold
+    cross-validation.
+
+    Each fold is searched only once: the max(k_choices) nearest neighbors of
+    its points are found with kneighbors, and since they come back sorted the
+    neighbors for every smaller k are a prefix of that list.
+
+    Inputs:
+    - X: A numpy array of shape (N, D) of data to split into folds.
+    - y: A numpy array of shape (N,) of labels.
+    - k_choices: List of values of k to evaluate.
+    - num_folds: Number of folds; they are contiguous, as with np.array_split.
+    - n_jobs: Number of folds evaluated in parallel threads. The memory
+      budget is divided between them.
+    - memory_budget: Upper bound in bytes on the working memory of one tile.
+    - storage_dtype: Storage type of each fold's training set; see train.
+    - weighted: If True, use distance-weighted votes.
+
+    Returns:
+    - accuracies: A numpy array of shape (num_folds, len(k_choices)) where
+      accuracies[i, j] is the accuracy on fold i with k = k_choices[j].
+    """
+    folds = np.array_split(np.arange(X.shape[0]), num_folds)
+    k_max = max(k_choices)
+    n_jobs = max(1, min(n_jobs, num_folds))
+    memory_budget = memory_budget // n_jobs
+
+    def evaluate_fold(i):
+      train_idx = np.concatenate(folds[:i] + folds[i + 1:])
+      classifier = self.__class__()
+      classifier.train(X[train_idx], y[train_idx], storage_dtype=storage_dtype)
+      dists, neighbors = classifier.kneighbors(X[folds[i]], k=k_max,
+                                               memory_budget=memory_budget)
+      y_val = y[folds[i]]
+      accuracies = np.zeros(len(k_choices))
+      for j, k in enumerate(k_choices):
+        y_pred = classifier.vote_labels(neighbors[:, :k],
+                                        dists[:, :k] if weighted else None)
+        accuracies[j] = np.mean(y_pred == y_val)
+      return accuracies
+
+    if n_jobs == 1:
+      results = [evaluate_fold(i) for i in xrange(num_folds)]
+    else:
+      pool = ThreadPool(n_jobs)
+      try:
+        results = pool.map(evaluate_fold, range(num_folds))
+      finally:
+        pool.close()
+    return np.array(results)
+
+  def kneighbors(self, X, k=1, memory_budget=DEFAULT_MEMORY_BUDGET):
+    """
+    Find the k nearest training points of every test point without building
+    the full (num_test, num_train) distance matrix.
+
+    The training set is walked in blocks and each block is compared against
+    blocks of test points, so that a single tile of squared distances
+    ||a||^2 - 2ab + ||b||^2 stays under memory_budget bytes. Every tile is
+    merged into a running top-k and then discarded.
+
+    Inputs:
+    - X: A numpy array of shape (num_test, D) containing test data.
+    - k: Number of neighbors to return; capped at num_train.
+    - memory_budget: Upper bound in bytes on the working memory of one tile.
+
+    Returns a tuple of:
+    - dists: A numpy array of shape (num_test, k) where dists[i, j] is the
+      Euclidean distance from X[i] to its jth nearest training point.
+    - neighbors: An integer array of shape (num_test, k) giving the indices of
+      those training points. Each row is sorted by increasing distance, ties
+      broken by the smaller training index.
+
+    The tiles only select candidates: the final distances and their order
+    come from exact_sq_dists, which is also what the search trees in
+    knn_index use, so that equal rows tie exactly and every engine resolves
+    ties the same way.
+    """
+    return self._brute_force(X, k, memory_budget)
+
+  def _brute_force(self, X, k, memory_budget, first=0):
+    """
+    Implementation of kneighbors over the training rows from first on.
+    Tombstoned rows are skipped and k is capped at the number of live rows.
+    """
+    num_test = X.shape[0]
+    num_train = self.X_train.shape[0]
+    num_live = num_train - first
+    if self.alive is not None:
+      num_live = np.count_nonzero(self.alive[first:])
+    k = min(k, num_live)
+    dtype = self._query_dtype(X)
+    X = X.astype(dtype, copy=False)
+    best_dists = np.zeros((num_test, k), dtype=dtype)
+    best_neighbors = np.zeros((num_test, k), dtype=np.intp)
+    if k == 0:
+      return best_dists, best_neighbors
+
+    # Bound on the rounding error of an expanded squared distance.
+    rounding = (X.shape[1] * np.finfo(dtype).eps *
+                (np.einsum('ij,ij->i', X, X) +
+                 self.train_sq_norms[first:].max()))
+    todo = np.arange(num_test)
+    num_candidates = min(k + RERANK_PAD, num_live)
+    while True:
+      dists, neighbors = self._scan_top_k(X[todo], num_candidates,
+                                          memory_budget, first)
+      worst_candidate = dists.max(axis=1)
+      dists, neighbors = self._rerank(X[todo], dists, neighbors, k)
+      best_dists[todo], best_neighbors[todo] = dists, neighbors
+      if num_candidates == num_live:
+        break
+      # Every row left out has an expanded distance of at least
+      # worst_candidate, so its exact distance is at least that minus the
+      # rounding error. Test points whose kth distance is not clearly below
+      # that, because of a large group of (nearly) tied rows, are searched
+      # again with more candidates.
+      unsure = dists[:, k - 1] >= worst_candidate - rounding[todo]
+      if not np.any(unsure):
+        break
+      todo = todo[unsure]
+      num_candidates = min(4 * num_candidates, num_live)
+
+    np.maximum(best_dists, 0, out=best_dists)
+    np.sqrt(best_dists, out=best_dists)
+    return best_dists, best_neighbors
+
+  def _scan_top_k(self, X, k, memory_budget, first):
+    """
+    Walk the training rows from first on in tiles of expanded squared
+    distances ||a||^2 - 2ab + ||b||^2 and return unsorted arrays
+    (dists, neighbors) of shape (num_test, k) with the k smallest distances
+    of every test point and their train indices.
+    """
+    num_test, dim = X.shape
+    num_train = self.X_train.shape[0]
+    alive = None if self.alive is None else self.alive[first:]
+    dtype = X.dtype
+    test_sq_norms = np.einsum('ij,ij->i', X, X)
+    best_dists = np.full((num_test, k), np.inf, dtype=dtype)
+    best_neighbors = np.full((num_test, k), -1, dtype=np.intp)
+
+    # Decoded train blocks are temporaries too and count against the budget;
+    # with read-ahead from disk two of them are alive at once.
+    decoded_row_bytes = 0
+    if self.train_path is not None:
+      decoded_row_bytes = 2 * dim * dtype.itemsize
+    elif self.compute_dtype not in (None, self.storage_dtype):
+      decoded_row_bytes = dim * dtype.itemsize
+    test_block, train_block = _block_sizes(num_test, num_train - first,
+                                           memory_budget, dtype.itemsize,
+                                           decoded_row_bytes)
+    for t_start, t_stop, X_block in self._iter_train_blocks(train_block,
+                                                            first):
+      train_norms = self.train_sq_norms[t_start:t_stop]
+      if alive is not None:
+        # Tombstoned rows get an infinite distance, so they are never among
+        # the num_live nearest.
+        train_norms = np.where(alive[t_start - first:t_stop - first],
+                               train_norms, np.inf)
+      for q_start in xrange(0, num_test, test_block):
+        q_stop = min(q_start + test_block, num_test)
+        tile = X[q_start:q_stop].dot(X_block.T)
+        tile *= -2
+        tile += test_sq_norms[q_start:q_stop, np.newaxis]
+        tile += train_norms
+        _merge_top_k(best_dists[q_start:q_stop],
+                     best_neighbors[q_start:q_stop], tile, t_start)
+    return best_dists, best_neighbors
+
+  def _rerank(self, X, dists, neighbors, k):
+    """
+    Replace the distances of candidate neighbors by exact_sq_dists and
+    return the k nearest of them per test point, sorted by distance and
+    then by index. The candidates are gathered a few test points at a time
+    so that they stay in cache.
+    """
+    num_test, num_candidates = neighbors.shape
+    row_bytes = max(1, X.shape[1] * X.dtype.itemsize)
+    c_block = max(1, min(num_candidates, RERANK_BLOCK_BYTES // row_bytes))
+    test_block = max(1, RERANK_BLOCK_BYTES // (c_block * row_bytes))
+    for q_start in xrange(0, num_test, test_block):
+      q_stop = min(q_start + test_block, num_test)
+      for c_start in xrange(0, num_candidates, c_block):
+        c_stop = min(c_start + c_block, num_candidates)
+        candidates = self._train_rows(neighbors[q_start:q_stop,
+                                                c_start:c_stop])
+        dists[q_start:q_stop, c_start:c_stop] = exact_sq_dists(
+          X[q_start:q_stop], candidates, overwrite_candidates=True)
+    order = _sort_neighbors(dists, neighbors)[:, :k]
+    rows = np.arange(num_test)[:, np.newaxis]
+    return dists[rows, order], neighbors[rows, order]
+
+  def vote_labels(self, neighbors, neighbor_dists=None):
+    """
+    Predict a label for each test point from the indices of its nearest
+    training points by majority vote. Ties are broken by choosing the smaller
+    label.
+
+    All rows are voted on together: each (row, label) pair is mapped to the
+    bin row * num_classes + label so that a single bincount produces the
+    (num_test, num_classes) table of votes.
+
+    Inputs:
+    - neighbors: An integer array of shape (num_test, k) of training indices,
+      as returned by kneighbors. Entries of -1, which an index returns when
+      it finds fewer than k neighbors, do not vote.
+    - neighbor_dists: Optional array of shape (num_test, k) with the matching
+      distances. If given, each vote is weighted by 1 / distance.
+
+    Returns:
+    - y: A numpy array of shape (num_test,) containing predicted labels.
+    """
+    num_test = neighbors.shape[0]
+    missing = neighbors < 0
+    closest_y = self.y_train[np.where(missing, 0, neighbors)]
+    bins = closest_y + self.num_classes * np.arange(num_test)[:, np.newaxis]
+    weights = None
+    if neighbor_dists is not None:
+      weights = 1.0 / (neighbor_dists + WEIGHT_EPS)
+    if np.any(missing):
+      weights = np.where(missing, 0.0, 1.0 if weights is None else weights)
+    if weights is not None:
+      weights = weights.ravel()
+    votes = np.bincount(bins.ravel(), weights=weights,
+                        minlength=num_test * self.num_classes)
+    votes = votes.reshape(num_test, self.num_classes)
+    # argmax returns the first maximum, i.e. the smallest tied label.
+    return np.argmax(votes, axis=1)
 
   def compute_distances_two_loops(self, X):
     """
@@ -110,7 +776,6 @@ class KNearestNeighbor(object):
     """
     num_test = X.shape[0]
     num_train = self.X_train.shape[0]
-    dists = np.zeros((num_test, num_train)) 
     #########################################################################
     # TODO:                                                                 #
     # Compute the l2 distance between all test points and all training      #
@@ -123,13 +788,21 @@ class KNearestNeighbor(object):
     # HINT: Try to formulate the l2 distance using matrix multiplication    #
     #       and two broadcast sums.                                         #
     #########################################################################
-    pass
+    X = X.astype(self._query_dtype(X), copy=False)
+    dists = X.dot(self._train_block(0, num_train).T)
+    dists *= -2
+    dists += np.einsum('ij,ij->i', X, X)[:, np.newaxis]
+    dists += self.train_sq_norms
+    if self.alive is not None:
+      dists[:, ~self.alive] = np.inf
+    np.maximum(dists, 0, out=dists)
+    np.sqrt(dists, out=dists)
     #########################################################################
     #                         END OF YOUR CODE                              #
     #########################################################################
     return dists
 
-  def predict_labels(self, dists, k=1):
+  def predict_labels(self, dists, k=1, weighted=False):
     """
     Given a matrix of distances between test points and training points,
     predict a label for each test point.
@@ -137,36 +810,168 @@ class KNearestNeighbor(object):
     Inputs:
     - dists: A numpy array of shape (num_test, num_train) where dists[i, j]
       gives the distance betwen the ith test point and the jth training point.
+    - k: The number of nearest neighbors that vote for the predicted labels.
+    - weighted: If True, each neighbor's vote is weighted by the inverse of
+      its distance.
 
     Returns:
     - y: A numpy array of shape (num_test,) containing predicted labels for the
       test data, where y[i] is the predicted label for the test point X[i].  
     """
     num_test = dists.shape[0]
-    y_pred = np.zeros(num_test)
-    for i in xrange(num_test):
-      # A list of length k storing the labels of the k nearest neighbors to
-      # the ith test point.
-      closest_y = []
-      #########################################################################
-      # TODO:                                                                 #
-      # Use the distance matrix to find the k nearest neighbors of the ith    #
-      # testing point, and use self.y_train to find the labels of these       #
-      # neighbors. Store these labels in closest_y.                           #
-      # Hint: Look up the function numpy.argsort.                             #
-      #########################################################################
-      pass
-      #########################################################################
-      # TODO:                                                                 #
-      # Now that you have found the labels of the k nearest neighbors, you    #
-      # need to find the most common label in the list closest_y of labels.   #
-      # Store this label in y_pred[i]. Break ties by choosing the smaller     #
-      # label.                                                                #
-      #########################################################################
-      pass
-      #########################################################################
-      #                           END OF YOUR CODE                            # 
-      #########################################################################
+    k = min(k, dists.shape[1])
+    # Select the k nearest neighbors of every test point at once with a
+    # partial sort, which is linear in num_train instead of a full argsort per
+    # row, then vote over all rows with one bincount.
+    neighbors = np.argpartition(dists, k - 1, axis=1)[:, :k]
+    neighbor_dists = None
+    if weighted:
+      neighbor_dists = dists[np.arange(num_test)[:, np.newaxis], neighbors]
+    y_pred = self.vote_labels(neighbors, neighbor_dists)
 
     return y_pred
 
+
+def open_reference_set(path):
+  """
+  Memory-map an on-disk training set without loading it.
+
+  Inputs:
+  - path: Path of a .npy file, or of a directory of .npy shards with the same
+    trailing shape that are concatenated along the first axis in filename
+    order.
+
+  Returns:
+  A read-only array-like of shape (num_train, D) that supports row slicing
+  and indexing with integer arrays of rows.
+  """
+  if os.path.isdir(path):
+    return _ShardedArray(path)
+  return np.load(path, mmap_mode='r')
+
+
+class _ShardedArray(object):
+  """
+  Read-only row-wise concatenation of the memory-mapped .npy files in a
+  directory. Supports contiguous row slices and integer arrays of rows.
+  """
+
+  def __init__(self, directory):
+    names = sorted(name for name in os.listdir(directory)
+                   if name.endswith('.npy'))
+    if not names:
+      raise ValueError('No .npy shards in "%s"' % directory)
+    self.shards = [np.load(os.path.join(directory, name), mmap_mode='r')
+                   for name in names]
+    rows = [shard.shape[0] for shard in self.shards]
+    self.offsets = np.concatenate(([0], np.cumsum(rows)))
+    self.shape = (int(self.offsets[-1]),) + self.shards[0].shape[1:]
+    self.dtype = self.shards[0].dtype
+    self.nbytes = sum(shard.nbytes for shard in self.shards)
+
+  def __getitem__(self, key):
+    if not isinstance(key, slice):
+      return self._take(key)
+    start, stop, step = key.indices(self.shape[0])
+    if step != 1:
+      raise ValueError('Only contiguous row slices are supported')
+    parts = []
+    for shard, low, high in zip(self.shards, self.offsets[:-1],
+                                self.offsets[1:]):
+      if high > start and low < stop:
+        parts.append(shard[max(start, low) - low:min(stop, high) - low])
+    if not parts:
+      return np.zeros((0,) + self.shape[1:], dtype=self.dtype)
+    return np.concatenate(parts)
+
+  def _take(self, rows):
+    """
+    Gather an integer array of rows, reading each shard once.
+    """
+    rows = np.asarray(rows)
+    if rows.dtype.kind not in 'iu':
+      raise TypeError('Only row slices and integer arrays of rows of a '
+                      'sharded array are supported')
+    num_rows = self.shape[0]
+    if rows.size and (rows.min() < -num_rows or rows.max() >= num_rows):
+      raise IndexError('Row index out of range for %d rows' % num_rows)
+    rows = np.where(rows < 0, rows + num_rows, rows)
+    shard_ids = np.searchsorted(self.offsets, rows, side='right') - 1
+    out = np.empty(rows.shape + self.shape[1:], dtype=self.dtype)
+    for i in np.unique(shard_ids):
+      mask = shard_ids == i
+      out[mask] = self.shards[i][rows[mask] - self.offsets[i]]
+    return out
+
+
+# Classifier rebuilt around the shared training data in each worker process.
+_worker_classifier = None
+
+# Array attributes placed in shared memory for worker processes, and the
+# small attributes that are simply pickled to them.
+_SHARED_ARRAYS = ('X_train', 'y_train', 'train_sq_norms', 'train_scale',
+                  'train_offset', 'alive')
+_WORKER_STATE = ('num_classes', 'storage_dtype', 'compute_dtype',
+                 'train_path')
+
+
+def _to_shared(a):
+  """
+  Copy an array into shared memory and return (buffer, dtype, shape).
+  """
+  buf = RawArray(ctypes.c_char, max(a.nbytes, 1))
+  np.frombuffer(buf, dtype=a.dtype, count=a.size)[...] = a.ravel()
+  return buf, a.dtype, a.shape
+
+
+def _from_shared(shared):
+  """
+  Return a numpy view of an array created by _to_shared.
+  """
+  buf, dtype, shape = shared
+  size = int(np.prod(shape))
+  return np.frombuffer(buf, dtype=dtype, count=size).reshape(shape)
+
+
+def _init_worker(shared_train, state):
+  """
+  Pool initializer: build this process's classifier over the shared arrays.
+  """
+  global _worker_classifier
+  _worker_classifier = KNearestNeighbor()
+  for name in _SHARED_ARRAYS:
+    shared = shared_train.get(name)
+    setattr(_worker_classifier, name,
+            None if shared is None else _from_shared(shared))
+  for name, value in state.items():
+    setattr(_worker_classifier, name, value)
+  if _worker_classifier.train_path is not None:
+    _worker_classifier.X_train = open_reference_set(
+      _worker_classifier.train_path)
+
+
+def _predict_worker(args):
+  """
+  Pool task: predict one shard of test points.
+  """
+  X, k, memory_budget, weighted = args
+  return _worker_classifier._predict_block(X, k, memory_budget, weighted)
+
+
+def _block_sizes(num_test, num_train, memory_budget, itemsize,
+                 train_row_bytes=0):
+  """
+  Choose (test_block, train_block) so that one distance tile, together with
+  the argpartition indices computed over it, fits in memory_budget bytes.
+  If train blocks have to be materialized (e.g. decoded from a reduced
+  type), train_row_bytes gives the size of one of their rows and the train
+  block alone is also kept under the budget.
+  """
+  max_elements = memory_budget // (itemsize + np.dtype(np.intp).itemsize)
+  max_elements = max(1, int(max_elements))
+  train_block = max_elements // min(num_test, MIN_TEST_BLOCK)
+  if train_row_bytes:
+    train_block = min(train_block, memory_budget // train_row_bytes)
+  train_block = max(1, min(num_train, train_block))
+  test_block = max(1, min(num_test, max_elements // train_block))
+  return test_block, train_block
@@ -0,0 +1,591 @@
+import numpy as np
+from past.builtins import xrange
+
+# Bytes of training points gathered at once when trees scan their leaves.
+LEAF_BLOCK_BYTES = 4 * 1024 * 1024
+
+
+def exact_sq_dists(X, candidates, overwrite_candidates=False):
+  """
+  Squared Euclidean distances from test points to candidate training points,
+  computed from the differences rather than expanded as
+  ||a||^2 - 2ab + ||b||^2. The result for a pair does not depend on the
+  other rows, so equal candidates get exactly equal distances.
+
+  Inputs:
+  - X: Array of shape (num_test, D) of test points.
+  - candidates: Array of shape (num_test, c, D) where candidates[i] are the
+    training points compared with X[i], or of shape (c, D) for points
+    compared with every test point.
+  - overwrite_candidates: If True, candidates has shape (num_test, c, D) and
+    is overwritten with the differences instead of allocating a copy.
+
+  Returns:
+  An array of shape (num_test, c) of squared distances.
+  """
+  if overwrite_candidates:
+    diff = candidates
+    diff -= X[:, np.newaxis]
+  else:
+    diff = candidates - X[:, np.newaxis]
+  return np.einsum('ijk,ijk->ij', diff, diff)
+
+
+class BinaryTree(object):
+  """
+  Base class for exact k-nearest-neighbor search trees.
+
+  The training points are recursively split at the median of their widest
+  dimension until a node holds at most leaf_size points. The points are
+  stored reordered so that every node owns a contiguous range of rows.
+  Subclasses decide how a node is bounded, which determines the lower bound
+  on the distance from a query to any point inside it.
+  """
+
+  def __init__(self, X, leaf_size=40):
+    """
+    Build the tree.
+
+    Inputs:
+    - X: A numpy array of shape (num_train, D) containing the training data.
+    - leaf_size: Maximum number of points stored in a leaf.
+    """
+    num_train = X.shape[0]
+    self.leaf_size = leaf_size
+    self.order = np.arange(num_train)
+
+    starts, ends, lefts, rights, bounds = [], [], [], [], []
+    stack = [(0, num_train)]
+    parents = [-1]
+    while stack:
+      start, end = stack.pop()
+      parent = parents.pop()
+      node = len(starts)
+      if parent >= 0:
+        # Children are pushed right first, so the left child is built first.
+        if lefts[parent] < 0:
+          lefts[parent] = node
+        else:
+          rights[parent] = node
+      starts.append(start)
+      ends.append(end)
+      lefts.append(-1)
+      rights.append(-1)
+      points = X[self.order[start:end]]
+      bounds.append(self._node_bounds(points))
+      if end - start <= leaf_size:
+        continue
+      spread = points.max(axis=0) - points.min(axis=0)
+      dim = np.argmax(spread)
+      mid = (end - start) // 2
+      split = np.argpartition(points[:, dim], mid)
+      self.order[start:end] = self.order[start:end][split]
+      stack.extend([(start + mid, end), (start, start + mid)])
+      parents.extend([node, node])
+
+    self.node_start = np.array(starts)
+    self.node_end = np.array(ends)
+    self.node_left = np.array(lefts)
+    self.node_right = np.array(rights)
+    self._set_bounds(bounds)
+    self.data = X[self.order]
+
+    # Row ranges of the leaves, padded with -1 to the widest leaf, so that
+    # a batch of leaves can be gathered as one (n, width, D) block.
+    leaves = np.flatnonzero(self.node_left < 0)
+    self.node_leaf = np.full(len(starts), -1, dtype=np.intp)
+    self.node_leaf[leaves] = np.arange(leaves.size)
+    sizes = self.node_end[leaves] - self.node_start[leaves]
+    columns = np.arange(sizes.max())
+    self.leaf_rows = np.where(columns < sizes[:, np.newaxis],
+                              self.node_start[leaves, np.newaxis] + columns,
+                              -1)
+
+  def get_params(self):
+    """
+    Return the constructor arguments, other than X, the tree was built with.
+    """
+    return {'leaf_size': self.leaf_size}
+
+  def query(self, X, k=1, block_size=1024):
+    """
+    Find the k nearest training points of every row of X.
+
+    Inputs:
+    - X: A numpy array of shape (num_test, D) containing test data.
+    - k: Number of neighbors to return; capped at num_train.
+    - block_size: Number of queries that descend the tree together.
+
+    Returns a tuple of:
+    - dists: A numpy array of shape (num_test, k) of Euclidean distances.
+    - neighbors: An integer array of shape (num_test, k) of training indices,
+      each row sorted by increasing distance, ties broken by smaller index.
+      Distances come from exact_sq_dists, as in KNearestNeighbor.kneighbors,
+      so both return the same neighbors.
+    """
+    num_test = X.shape[0]
+    k = min(k, self.data.shape[0])
+    # Compute in the same type as KNearestNeighbor.kneighbors.
+    X = X.astype(np.result_type(X.dtype, self.data.dtype, np.float32),
+                 copy=False)
+    dists = np.full((num_test, k), np.inf)
+    neighbors = np.full((num_test, k), -1, dtype=np.intp)
+    for start in xrange(0, num_test, block_size):
+      queries = np.arange(start, min(start + block_size, num_test))
+      self._query_block(X, queries, dists, neighbors)
+    return np.sqrt(dists), neighbors
+
+  def _query_block(self, X, queries, dists, neighbors):
+    """
+    Search the tree for a block of queries, updating their rows of dists
+    (squared) and neighbors in place.
+
+    The search is breadth first over (query, node) pairs, so every level of
+    the tree costs a few vectorized operations rather than a Python loop
+    over nodes and queries. Each query first scans the leaf it falls in, so
+    its kth distance is already tight when the pairs are pruned.
+    """
+    home = np.zeros(queries.size, dtype=np.intp)
+    descending = np.arange(queries.size)
+    while descending.size:
+      left = self.node_left[home[descending]]
+      descending, left = descending[left >= 0], left[left >= 0]
+      right = self.node_right[home[descending]]
+      x = X[queries[descending]]
+      closer = self._route_sq_dist(left, x) <= self._route_sq_dist(right, x)
+      home[descending] = np.where(closer, left, right)
+    self._scan_leaves(X, queries, home, dists, neighbors)
+
+    pair_queries = np.arange(queries.size)
+    pair_nodes = np.zeros(queries.size, dtype=np.intp)
+    bounds = np.zeros(queries.size)
+    while pair_queries.size:
+      # Nodes at exactly the kth distance are still visited so that ties are
+      # resolved by index the same way as brute force search.
+      keep = bounds <= dists[queries[pair_queries], -1]
+      pair_queries, pair_nodes = pair_queries[keep], pair_nodes[keep]
+      leaf = self.node_left[pair_nodes] < 0
+      scan = leaf & (pair_nodes != home[pair_queries])
+      self._scan_leaves(X, queries[pair_queries[scan]], pair_nodes[scan],
+                        dists, neighbors)
+      pair_queries = np.tile(pair_queries[~leaf], 2)
+      pair_nodes = np.concatenate((self.node_left[pair_nodes[~leaf]],
+                                   self.node_right[pair_nodes[~leaf]]))
+      bounds = np.empty(pair_queries.size)
+      step = max(1, LEAF_BLOCK_BYTES // (X.shape[1] * X.itemsize))
+      for start in xrange(0, pair_queries.size, step):
+        stop = start + step
+        bounds[start:stop] = self._min_sq_dist(
+          pair_nodes[start:stop], X[queries[pair_queries[start:stop]]])
+
+  def _scan_leaves(self, X, queries, nodes, dists, neighbors):
+    """
+    Compare queries[i] with the points of leaf nodes[i] for every i and
+    merge the results into dists (squared) and neighbors in place. A query
+    may appear more than once, but never twice with the same leaf.
+    """
+    width = self.leaf_rows.shape[1]
+    step = max(1, LEAF_BLOCK_BYTES // (width * X.shape[1] * X.itemsize))
+    for start in xrange(0, queries.size, step):
+      block = queries[start:start + step]
+      rows = self.leaf_rows[self.node_leaf[nodes[start:start + step]]]
+      leaf_dists = exact_sq_dists(X[block], self.data[rows],
+                                  overwrite_candidates=True)
+      # Only candidates that can enter the top k are merged; equal ones are
+      # kept since they may win the tie by index.
+      pair, column = np.nonzero((rows >= 0) & (
+        leaf_dists <= dists[block, -1][:, np.newaxis]))
+      if pair.size:
+        _merge_by_query(dists, neighbors, block[pair],
+                        leaf_dists[pair, column],
+                        self.order[rows[pair, column]])
+
+  def _node_bounds(self, points):
+    """ Return the bounding object of a node given its points. """
+    raise NotImplementedError
+
+  def _set_bounds(self, bounds):
+    """ Store the list of per-node bounds as arrays. """
+    raise NotImplementedError
+
+  def _min_sq_dist(self, nodes, X):
+    """
+    Lower bounds on the squared distances from the rows of X to any point in
+    a node, as an array of shape (N,). nodes is a node or an array of shape
+    (N,) with one node per row of X.
+
+    The bounds are rounded down by _tolerance(X), so that a bound never
+    exceeds the distance exact_sq_dists returns for a point in the node and
+    points tied with the kth neighbor are not pruned.
+    """
+    raise NotImplementedError
+
+  def _tolerance(self, X):
+    """ Relative rounding error allowed for in the bounds. """
+    return 4 * X.shape[1] * np.finfo(X.dtype).eps
+
+  def _route_sq_dist(self, nodes, X):
+    """
+    The quantity compared between two children to pick the leaf a query
+    falls in; defaults to _min_sq_dist.
+    """
+    return self._min_sq_dist(nodes, X)
+
+
+class KDTree(BinaryTree):
+  """ A k-d tree whose nodes are bounded by axis-aligned boxes. """
+
+  def _node_bounds(self, points):
+    return points.min(axis=0), points.max(axis=0)
+
+  def _set_bounds(self, bounds):
+    self.node_lower = np.array([lower for lower, _ in bounds])
+    self.node_upper = np.array([upper for _, upper in bounds])
+
+  def _min_sq_dist(self, nodes, X):
+    gap = np.maximum(self.node_lower[nodes] - X, X - self.node_upper[nodes])
+    np.maximum(gap, 0, out=gap)
+    return np.einsum('ij,ij->i', gap, gap) * (1 - self._tolerance(X))
+
+
+class BallTree(BinaryTree):
+  """ A ball tree whose nodes are bounded by a centroid and a radius. """
+
+  def _node_bounds(self, points):
+    centroid = points.mean(axis=0)
+    diff = points - centroid
+    radius = np.sqrt(np.max(np.einsum('ij,ij->i', diff, diff)))
+    return centroid, radius
+
+  def _set_bounds(self, bounds):
+    self.node_centroid = np.array([centroid for centroid, _ in bounds])
+    self.node_radius = np.array([radius for _, radius in bounds])
+
+  def _min_sq_dist(self, nodes, X):
+    diff = X - self.node_centroid[nodes]
+    center_dist = np.sqrt(np.einsum('ij,ij->i', diff, diff))
+    radius = self.node_radius[nodes]
+    gap = center_dist - radius - self._tolerance(X) * (center_dist + radius)
+    np.maximum(gap, 0, out=gap)
+    return gap * gap
+
+  def _route_sq_dist(self, nodes, X):
+    # Sibling balls overlap, so a query is often inside both; the closer
+    # centroid is a better guess of where its neighbors are.
+    diff = X - self.node_centroid[nodes]
+    return np.einsum('ij,ij->i', diff, diff)
+
+
+class IVFIndex(object):
+  """
+  An inverted-file index for approximate k-nearest-neighbor search.
+
+  The training points are clustered with k-means into n_lists cells, and each
+  point is filed under its nearest centroid. A query only scans the points in
+  the nprobe cells whose centroids are closest to it, so nprobe trades recall
+  for latency: nprobe = n_lists is exact brute force.
+
+  The index keeps its own copy of the training points grouped by cell, so it
+  can be saved with save() and restored with IVFIndex.load() without the
+  original array or another round of k-means.
+  """
+
+  def __init__(self, X, n_lists=None, nprobe=8, num_iters=10,
+               max_train_points=256, seed=0):
+    """
+    Build the index.
+
+    Inputs:
+    - X: A numpy array of shape (num_train, D) containing the training data.
+    - n_lists: Number of k-means cells; defaults to sqrt(num_train).
+    - nprobe: Default number of cells scanned per query.
+    - num_iters: Number of k-means (Lloyd) iterations.
+    - max_train_points: k-means is run on at most this many points per cell,
+      sampled from X.
+    - seed: Seed for the k-means initialization and sampling.
+    """
+    num_train = X.shape[0]
+    if n_lists is None:
+      n_lists = int(np.sqrt(num_train))
+    n_lists = max(1, min(n_lists, num_train))
+    self.nprobe = nprobe
+    self.num_iters = num_iters
+    self.max_train_points = max_train_points
+    self.seed = seed
+
+    rng = np.random.RandomState(seed)
+    sample = X
+    if num_train > n_lists * max_train_points:
+      sample = X[rng.choice(num_train, n_lists * max_train_points,
+                            replace=False)]
+    # Centroids are kept in the type queries are computed in, so that
+    # finding the cells to probe does not convert every query.
+    self.centroids = _kmeans(sample, n_lists, num_iters, rng).astype(
+      np.result_type(X.dtype, np.float32))
+    self.centroid_sq_norms = np.einsum('ij,ij->i', self.centroids,
+                                       self.centroids)
+
+    assignments = _nearest_centroids(X, self.centroids)[:, 0]
+    self.order = np.argsort(assignments, kind='mergesort')
+    counts = np.bincount(assignments, minlength=n_lists)
+    self.list_offsets = np.concatenate(([0], np.cumsum(counts)))
+    self.data = X[self.order]
+    self.sq_norms = np.einsum('ij,ij->i', self.data, self.data)
+
+  def get_params(self):
+    """
+    Return the constructor arguments, other than X, the index was built
+    with. n_lists is the number of cells rather than the requested value.
+    """
+    return {'n_lists': self.centroids.shape[0], 'nprobe': self.nprobe,
+            'num_iters': self.num_iters,
+            'max_train_points': self.max_train_points, 'seed': self.seed}
+
+  def query(self, X, k=1, nprobe=None, block_size=1024):
+    """
+    Find approximate k nearest training points of every row of X.
+
+    Inputs:
+    - X: A numpy array of shape (num_test, D) containing test data.
+    - k: Number of neighbors to return; capped at num_train.
+    - nprobe: Number of cells to scan per query; defaults to self.nprobe.
+    - block_size: Maximum number of queries compared with a cell at once.
+
+    Returns a tuple of:
+    - dists: A numpy array of shape (num_test, k) of Euclidean distances.
+    - neighbors: An integer array of shape (num_test, k) of training indices,
+      each row sorted by increasing distance. If the probed cells hold fewer
+      than k points the remaining entries are inf and -1.
+    """
+    num_test = X.shape[0]
+    n_lists = self.centroids.shape[0]
+    k = min(k, self.data.shape[0])
+    if nprobe is None:
+      nprobe = self.nprobe
+    nprobe = max(1, min(nprobe, n_lists))
+    X = X.astype(np.result_type(X.dtype, self.data.dtype, np.float32),
+                 copy=False)
+
+    # Group the (query, cell) pairs by cell, so that every probed cell is
+    # scanned once, as a contiguous slice of data, against all of the
+    # queries that probe it.
+    probes = _nearest_centroids(X, self.centroids, nprobe,
+                                centroid_sq_norms=self.centroid_sq_norms)
+    probes = probes.ravel()
+    pair_order = np.argsort(probes, kind='mergesort')
+    pair_queries = pair_order // nprobe
+    cells, pair_starts = np.unique(probes[pair_order], return_index=True)
+    pair_stops = np.append(pair_starts[1:], pair_order.size)
+
+    test_sq_norms = np.einsum('ij,ij->i', X, X)
+    dists = np.full((num_test, k), np.inf, dtype=X.dtype)
+    neighbors = np.full((num_test, k), -1, dtype=np.intp)
+    for c, p_start, p_stop in zip(cells, pair_starts, pair_stops):
+      start, stop = self.list_offsets[c], self.list_offsets[c + 1]
+      if start == stop:
+        continue
+      cell = self.data[start:stop]
+      for b_start in xrange(p_start, p_stop, block_size):
+        queries = pair_queries[b_start:min(b_start + block_size, p_stop)]
+        tile = X[queries].dot(cell.T)
+        tile *= -2
+        tile += test_sq_norms[queries, np.newaxis]
+        tile += self.sq_norms[start:stop]
+        # A query probes each cell once, so its rows are gathered, merged
+        # and written back without conflicts.
+        best_dists, best_neighbors = dists[queries], neighbors[queries]
+        _merge_top_k(best_dists, best_neighbors, tile, start)
+        dists[queries], neighbors[queries] = best_dists, best_neighbors
+
+    # Neighbors are positions in data until here.
+    found = neighbors >= 0
+    neighbors[found] = self.order[neighbors[found]]
+    order = _sort_neighbors(dists, neighbors)
+    rows = np.arange(num_test)[:, np.newaxis]
+    dists, neighbors = dists[rows, order], neighbors[rows, order]
+    np.maximum(dists, 0, out=dists)
+    return np.sqrt(dists), neighbors
+
+  def save(self, filename):
+    """
+    Save the index to filename in numpy .npz format.
+    """
+    np.savez(filename, centroids=self.centroids, order=self.order,
+             list_offsets=self.list_offsets, data=self.data,
+             sq_norms=self.sq_norms, nprobe=self.nprobe,
+             num_iters=self.num_iters,
+             max_train_points=self.max_train_points, seed=self.seed)
+
+  @classmethod
+  def load(cls, filename):
+    """
+    Load an index written by save().
+    """
+    index = cls.__new__(cls)
+    with np.load(filename) as f:
+      index.centroids = f['centroids']
+      index.order = f['order']
+      index.list_offsets = f['list_offsets']
+      index.data = f['data']
+      index.sq_norms = f['sq_norms']
+      index.nprobe = int(f['nprobe'])
+      # Files saved before these were stored get the constructor defaults.
+      defaults = {'num_iters': 10, 'max_train_points': 256, 'seed': 0}
+      for name, default in defaults.items():
+        setattr(index, name, int(f[name]) if name in f.files else default)
+    index.centroid_sq_norms = np.einsum('ij,ij->i', index.centroids,
+                                        index.centroids)
+    return index
+
+
+def recall_at_k(neighbors, exact_neighbors):
+  """
+  Compute recall@k of approximate neighbors against exact ones.
+
+  Inputs:
+  - neighbors: Integer array of shape (num_test, k) of approximate neighbors.
+  - exact_neighbors: Integer array of shape (num_test, k) of exact neighbors.
+
+  Returns:
+  The fraction of exact neighbors that were found, averaged over queries.
+  """
+  num_test, k = exact_neighbors.shape
+  found = 0
+  for i in xrange(num_test):
+    found += np.intersect1d(neighbors[i], exact_neighbors[i]).size
+  return float(found) / (num_test * k)
+
+
+def _nearest_centroids(X, centroids, n=1, block_size=1024,
+                       centroid_sq_norms=None):
+  """
+  Return an integer array of shape (N, n) with the indices of the n centroids
+  closest to each row of X. X is processed in blocks of block_size rows.
+  The squared norms of the centroids can be passed in if they are known.
+  """
+  if centroid_sq_norms is None:
+    centroid_sq_norms = np.einsum('ij,ij->i', centroids, centroids)
+  nearest = np.zeros((X.shape[0], n), dtype=np.intp)
+  for start in xrange(0, X.shape[0], block_size):
+    # ||x||^2 is the same for every centroid and does not change the order.
+    dists = centroid_sq_norms - 2 * X[start:start + block_size].dot(centroids.T)
+    if n < centroids.shape[0]:
+      nearest[start:start + block_size] = np.argpartition(dists, n - 1,
+                                                          axis=1)[:, :n]
+    else:
+      nearest[start:start + block_size] = np.arange(n)
+  return nearest
+
+
+def _merge_top_k(best_dists, best_neighbors, tile, offset):
+  """
+  Merge a tile of distances into a running top-k, in place. Equal distances
+  are resolved in favour of the smaller train index.
+
+  Inputs:
+  - best_dists: Array of shape (n, k) of the current k smallest distances.
+  - best_neighbors: Integer array of shape (n, k) with their train indices.
+  - tile: Array of shape (n, m) of distances to train points offset, ...,
+    offset + m - 1.
+  - offset: Train index of the first column of tile.
+  """
+  n, k = best_dists.shape
+  rows = np.arange(n)[:, np.newaxis]
+  if tile.shape[1] > k:
+    columns = _select_k_smallest(tile, k)
+    tile = tile[rows, columns]
+  else:
+    columns = np.broadcast_to(np.arange(tile.shape[1]), tile.shape)
+  candidate_dists = np.hstack((best_dists, tile))
+  candidate_neighbors = np.hstack((best_neighbors, columns + offset))
+  keep = _sort_neighbors(candidate_dists, candidate_neighbors)[:, :k]
+  best_dists[...] = candidate_dists[rows, keep]
+  best_neighbors[...] = candidate_neighbors[rows, keep]
+
+
+def _select_k_smallest(tile, k):
+  """
+  Return an integer array of shape (n, k) with the columns of the k smallest
+  entries of every row of tile, preferring the smaller column among equal
+  entries. The columns are not sorted by value.
+
+  argpartition picks arbitrarily between entries equal to the kth smallest,
+  so rows with more such entries than fit are redone with an explicit rule.
+  """
+  n = tile.shape[0]
+  columns = np.argpartition(tile, k - 1, axis=1)[:, :k]
+  kth = tile[np.arange(n), columns[:, k - 1]][:, np.newaxis]
+  ambiguous = np.count_nonzero(tile <= kth, axis=1) > k
+  if np.any(ambiguous):
+    sub, kth = tile[ambiguous], kth[ambiguous]
+    keep = sub < kth
+    need = k - np.count_nonzero(keep, axis=1)
+    ties = sub == kth
+    keep |= ties & (np.cumsum(ties, axis=1) <= need[:, np.newaxis])
+    columns[ambiguous] = np.nonzero(keep)[1].reshape(-1, k)
+  return columns
+
+
+def _merge_by_query(best_dists, best_neighbors, queries, dists, neighbors):
+  """
+  Merge candidates into the running top-k of several queries, in place. Equal
+  distances are resolved in favour of the smaller train index.
+
+  Inputs:
+  - best_dists: Array of shape (num_test, k) of the current k smallest
+    distances.
+  - best_neighbors: Integer array of shape (num_test, k) with their train
+    indices.
+  - queries, dists, neighbors: Arrays of shape (n,) where candidate i is
+    train point neighbors[i] at distance dists[i] from test point
+    queries[i]. A query may have any number of candidates.
+  """
+  k = best_dists.shape[1]
+  targets, counts = np.unique(queries, return_counts=True)
+  all_queries = np.concatenate((np.repeat(targets, k), queries))
+  all_dists = np.concatenate((best_dists[targets].ravel(), dists))
+  all_neighbors = np.concatenate((best_neighbors[targets].ravel(), neighbors))
+  order = np.lexsort((all_neighbors, all_dists, all_queries))
+  # Every target has its k current entries plus its candidates, so taking
+  # the first k of each group leaves exactly k per target, in target order.
+  sizes = counts + k
+  starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+  rank = np.arange(order.size) - np.repeat(starts, sizes)
+  keep = order[rank < k]
+  best_dists[targets] = all_dists[keep].reshape(-1, k)
+  best_neighbors[targets] = all_neighbors[keep].reshape(-1, k)
+
+
+def _sort_neighbors(dists, neighbors):
+  """
+  Return the column order that sorts each row by distance, breaking ties by
+  the smaller train index.
+  """
+  return np.lexsort((neighbors, dists), axis=1)
+
+
+def _kmeans(X, num_clusters, num_iters, rng):
+  """
+  Cluster the rows of X with Lloyd's algorithm and return the centroids as an
+  array of shape (num_clusters, D). Empty clusters keep their old centroid.
+  """
+  centroids = X[rng.choice(X.shape[0], num_clusters, replace=False)]
+  centroids = centroids.astype(np.float64)
+  for _ in xrange(num_iters):
+    assignments = _nearest_centroids(X, centroids)[:, 0]
+    counts = np.bincount(assignments, minlength=num_clusters)
+    nonempty = counts > 0
+    # Sum the members of each cluster as contiguous segments of sorted rows.
+    order = np.argsort(assignments, kind='mergesort')
+    offsets = np.concatenate(([0], np.cumsum(counts)[:-1]))[nonempty]
+    sums = np.add.reduceat(X[order], offsets, axis=0)
+    centroids[nonempty] = sums / counts[nonempty, np.newaxis]
+  return centroids
+
+
+# Index types that KNearestNeighbor.train can build by name.
+INDEX_TYPES = {
+  'kd_tree': KDTree,
+  'ball_tree': BallTree,
+  'ivf': IVFIndex,
+}
@@ -3,6 +3,7 @@ from __future__ import print_function
 import numpy as np
 from iiisai.classifiers.linear_svm import *
 from iiisai.classifiers.softmax import *
+from iiisai.sampler import MinibatchSampler
 from past.builtins import xrange
 
 
@@ -38,11 +39,10 @@ class LinearClassifier(object):
 
     # Run stochastic gradient descent to optimize W
     loss_history = []
+    # minibatches are consecutive windows of a new permutation every epoch
+    sampler = MinibatchSampler((X, y), batch_size)
     for _ in xrange(num_iters):
-      # select subset of samples for minibatch update (with replacement)
-      indices = np.random.choice(num_train, batch_size)
-      X_batch = X[indices]
-      y_batch = y[indices]
+      X_batch, y_batch = sampler.sample()
 
       #########################################################################
       # TODO:                                                                 #
@@ -81,6 +81,71 @@ class LinearClassifier(object):
 
     return loss_history
 
+  @classmethod
+  def train_sweep(cls, X, y, X_val, y_val, learning_rates,
+                  regularization_strengths, num_iters=100, batch_size=200,
+                  verbose=False):
+    """
+    Train one classifier for every pair of learning rate and regularization
+    strength, all at once. The weight matrices of the K pairs are stacked
+    side by side into a (D, K, C) array, so that every step shares one
+    minibatch and computes the scores of all classifiers with a single
+    matrix multiply; losses, gradients and updates are vectorized over the
+    pairs. Each classifier follows the same steps as train would take with
+    that minibatch sequence.
+
+    Inputs:
+    - X, y: Training data and labels, as for train.
+    - X_val, y_val: Validation data and labels.
+    - learning_rates: Sequence of learning rates to try.
+    - regularization_strengths: Sequence of regularization strengths to try.
+    - num_iters, batch_size, verbose: As for train.
+
+    Returns:
+    A dictionary mapping each (learning_rate, reg) pair to a dictionary with
+    keys 'classifier' (a trained instance of this class), 'loss_history',
+    'train_accuracy' and 'val_accuracy'.
+    """
+    configs = [(lr, reg) for lr in learning_rates
+               for reg in regularization_strengths]
+    lrs = np.array([lr for lr, _ in configs])
+    regs = np.array([reg for _, reg in configs])
+    num_configs = len(configs)
+    num_train, dim = X.shape
+    num_classes = np.max(y) + 1
+    W = 0.001 * np.random.randn(dim, num_configs, num_classes)
+
+    loss_histories = np.zeros((num_iters, num_configs))
+    sampler = MinibatchSampler((X, y), batch_size)
+    for it in xrange(num_iters):
+      X_batch, y_batch = sampler.sample()
+      loss, grad = cls.stacked_loss(W, X_batch, y_batch, regs)
+      loss_histories[it] = loss
+      grad *= lrs[:, None]
+      W -= grad
+
+      if verbose and it % 100 == 0:
+        print('iteration %d / %d: loss %f to %f' % (it, num_iters, loss.min(),
+                                                    loss.max()))
+
+    def accuracies(X, y):
+      scores = X.dot(W.reshape(dim, -1)).reshape(X.shape[0], num_configs,
+                                                 num_classes)
+      return (np.argmax(scores, axis=2) == y[:, None]).mean(axis=0)
+
+    train_accuracies = accuracies(X, y)
+    val_accuracies = accuracies(X_val, y_val)
+
+    results = {}
+    for k, config in enumerate(configs):
+      classifier = cls()
+      classifier.W = W[:, k].copy()
+      results[config] = {'classifier': classifier,
+                         'loss_history': loss_histories[:, k].tolist(),
+                         'train_accuracy': train_accuracies[k],
+                         'val_accuracy': val_accuracies[k]}
+    return results
+
   def predict(self, X):
     """
     Use the trained weights of this linear classifier to predict labels for
@@ -127,6 +192,23 @@ class LinearClassifier(object):
     """
     pass
 
+  @staticmethod
+  def stacked_loss(W, X_batch, y_batch, reg):
+    """
+    Compute the loss function and its derivative for K stacked weight
+    matrices, as used by train_sweep. Subclasses will override this.
+
+    Inputs:
+    - W: A numpy array of shape (D, K, C) containing K weight matrices.
+    - X_batch, y_batch: A minibatch, as for loss.
+    - reg: A numpy array of shape (K,) of regularization strengths.
+
+    Returns: A tuple containing:
+    - loss as an array of shape (K,)
+    - gradient with respect to W; an array of the same shape as W
+    """
+    pass
+
 
 class LinearSVM(LinearClassifier):
   """ A subclass that uses the Multiclass SVM loss function """
@@ -134,6 +216,8 @@ class LinearSVM(LinearClassifier):
   def loss(self, X_batch, y_batch, reg):
     return svm_loss_vectorized(self.W, X_batch, y_batch, reg)
 
+  stacked_loss = staticmethod(svm_loss_stacked)
+
 
 class Softmax(LinearClassifier):
   """ A subclass that uses the Softmax + Cross-entropy loss function """
@@ -141,3 +225,5 @@ class Softmax(LinearClassifier):
   def loss(self, X_batch, y_batch, reg):
     return softmax_loss_vectorized(self.W, X_batch, y_batch, reg)
 
+  stacked_loss = staticmethod(softmax_loss_stacked)
+
@@ -65,48 +65,45 @@ def svm_loss_naive(W, X, y, reg):
   return loss, dW
 
 
-def svm_loss_vectorized(W, X, y, reg):
+def svm_loss_vectorized(W, X, y, reg, workspace=None):
   """
   Structured SVM loss function, vectorized implementation.
 
-  Inputs and outputs are the same as svm_loss_naive.
-  """
-  loss = 0.0
-  dW = np.zeros(W.shape) # initialize the gradient as zero
+  Inputs and outputs are the same as svm_loss_naive, with one addition:
+  - workspace: Optional C-contiguous array of shape (N, C) and the dtype of
+    X.dot(W), such as float32 for float32 inputs. It is overwritten and
+    reused for the scores, so that repeated calls allocate no (N, C) array.
 
-  # compute the loss and the gradient
-  num_classes = W.shape[1]
+  The scores are turned in place into the margins and then into the
+  coefficient of each X[i] in the gradient: 1 for every positive margin and
+  minus their count for the correct class. The gradient is then a single
+  X.T.dot(coeff) product.
+  """
   num_train = X.shape[0]
-
-  scores = X.dot(W)
-
-  correct_class_scores = scores[np.arange(len(X)), y]
-
-  margins = scores - correct_class_scores[:, None] + 1
-
-  margins_mask = margins < 0
-  margins[margins_mask] = 0
-  margins[np.arange(len(margins)), y] = 0
-
-  # sum and make correction for counting one loss extra
-  loss = np.sum(margins, axis=1)
-  loss = np.sum(loss)
-
-  include_in_computation = 1 * (margins > 0)
-  times_to_exclude = include_in_computation.sum(axis=1)
-  correct_class_indices = np.zeros(include_in_computation.shape)
-  correct_class_indices[np.arange(num_train), y] = 1
-  correct_class_exclusion = correct_class_indices * np.transpose([times_to_exclude] * num_classes)
-  
-  dW = X.T.dot(include_in_computation) - X.T.dot(correct_class_exclusion) 
-
-  # Right now the loss is a sum over all training examples, but we want it
-  # to be an average instead so we divide by num_train.
-  loss /= num_train
+  rows = np.arange(num_train)
+
+  if (workspace is not None and
+      workspace.dtype == np.result_type(X.dtype, W.dtype)):
+    coeff = np.dot(X, W, out=workspace)
+  else:
+    coeff = X.dot(W)
+
+  # margins, with the correct classes excluded
+  correct_class_scores = coeff[rows, y]
+  coeff -= correct_class_scores[:, None]
+  coeff += 1
+  coeff[rows, y] = 0
+  np.maximum(coeff, 0, out=coeff)
+  loss = coeff.sum() / num_train
+
+  # margins >= 0, so their sign is 1 exactly where they count
+  np.sign(coeff, out=coeff)
+  coeff[rows, y] = -coeff.sum(axis=1)
+  dW = X.T.dot(coeff)
   dW /= num_train
 
   # Add regularization to the loss.
-  loss += reg * np.sum(W * W)
+  loss += reg * np.vdot(W, W)
   dW += 2 * reg * W
   #############################################################################
   # TODO:                                                                     #
@@ -134,3 +131,43 @@ def svm_loss_vectorized(W, X, y, reg):
   #############################################################################
 
   return loss, dW
+
+
+def svm_loss_stacked(W, X, y, reg):
+  """
+  Structured SVM loss function for K weight matrices at once, as used to
+  train several hyperparameter configurations side by side. The scores of
+  all K classifiers come from one (N, D) x (D, K * C) matrix multiply.
+
+  Inputs:
+  - W: A numpy array of shape (D, K, C) containing K weight matrices.
+  - X: A numpy array of shape (N, D) containing a minibatch of data.
+  - y: A numpy array of shape (N,) containing training labels.
+  - reg: A numpy array of shape (K,) of regularization strengths.
+
+  Returns a tuple of:
+  - loss: A numpy array of shape (K,) giving the loss of each classifier
+  - gradient with respect to W; an array of the same shape as W
+  """
+  dim, num_configs, num_classes = W.shape
+  num_train = X.shape[0]
+  rows = np.arange(num_train)
+
+  scores = X.dot(W.reshape(dim, -1)).reshape(num_train, num_configs,
+                                             num_classes)
+  margins = scores - scores[rows, :, y][:, :, None] + 1
+  margins[rows, :, y] = 0
+  np.maximum(margins, 0, out=margins)
+  loss = margins.sum(axis=(0, 2)) / num_train
+
+  # Every positive margin adds X[i] to its class and subtracts it from the
+  # correct class.
+  coeff = (margins > 0).astype(X.dtype)
+  coeff[rows, :, y] = -coeff.sum(axis=2)
+  dW = X.T.dot(coeff.reshape(num_train, -1)).reshape(W.shape)
+  dW /= num_train
+
+  reg = np.asarray(reg, dtype=W.dtype)
+  loss += reg * np.sum(W * W, axis=(0, 2))
+  dW += 2 * reg[:, None] * W
+  return loss, dW
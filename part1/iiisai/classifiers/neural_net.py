@@ -4,6 +4,8 @@ import numpy as np
 import matplotlib.pyplot as plt
 from past.builtins import xrange
 
+from iiisai.sampler import MinibatchSampler
+
 class TwoLayerNet(object):
   """
   A two-layer fully-connected neural network. The net has an input dimension of
@@ -140,6 +142,7 @@ class TwoLayerNet(object):
     loss_history = []
     train_acc_history = []
     val_acc_history = []
+    sampler = MinibatchSampler((X, y), batch_size)
 
     for it in xrange(num_iters):
       X_batch = None
@@ -149,7 +152,7 @@ class TwoLayerNet(object):
       # TODO: Create a random minibatch of training data and labels, storing  #
       # them in X_batch and y_batch respectively.                             #
       #########################################################################
-      pass
+      X_batch, y_batch = sampler.sample()
       #########################################################################
       #                             END OF YOUR CODE                          #
       #########################################################################
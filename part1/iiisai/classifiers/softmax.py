@@ -2,6 +2,28 @@ import numpy as np
 from random import shuffle
 from past.builtins import xrange
 
+def softmax_inplace(scores):
+  """
+  Overwrite scores with their softmax probabilities. This is the kernel
+  shared by the softmax losses: the scores are shifted by their maximum so
+  that large scores cannot overflow, and no array the size of scores is
+  allocated, so it works in the dtype of scores (e.g. float32).
+
+  Inputs:
+  - scores: A numpy array of shape (N, C), overwritten with the probabilities.
+
+  Returns:
+  - log_Z: A numpy array of shape (N,) giving the log of the normalizer of
+    each row, log(sum_j exp(scores[i, j])) for the original scores.
+  """
+  shift = np.max(scores, axis=1, keepdims=True)
+  scores -= shift
+  np.exp(scores, out=scores)
+  Z = np.sum(scores, axis=1, keepdims=True)
+  scores /= Z
+  return (np.log(Z) + shift)[:, 0]
+
+
 def softmax_loss_naive(W, X, y, reg):
   """
   Softmax loss function, naive implementation (with loops)
@@ -44,20 +66,67 @@ def softmax_loss_vectorized(W, X, y, reg):
 
   Inputs and outputs are the same as softmax_loss_naive.
   """
-  # Initialize the loss and gradient to zero.
-  loss = 0.0
-  dW = np.zeros_like(W)
-
   #############################################################################
   # TODO: Compute the softmax loss and its gradient using no explicit loops.  #
   # Store the loss in loss and the gradient in dW. If you are not careful     #
   # here, it is easy to run into numeric instability. Don't forget the        #
   # regularization!                                                           #
   #############################################################################
-  pass
+  num_train = X.shape[0]
+  rows = np.arange(num_train)
+
+  # The scores are the only (N, C) array; they become the gradient with
+  # respect to the scores in place.
+  dscores = X.dot(W)
+  correct_class_scores = dscores[rows, y]
+  log_Z = softmax_inplace(dscores)
+  loss = np.sum(log_Z - correct_class_scores) / num_train
+  dscores[rows, y] -= 1
+  dscores /= num_train
+  dW = X.T.dot(dscores)
+
+  loss += reg * np.vdot(W, W)
+  dW += 2 * reg * W
   #############################################################################
   #                          END OF YOUR CODE                                 #
   #############################################################################
 
   return loss, dW
 
+
+
+def softmax_loss_stacked(W, X, y, reg):
+  """
+  Softmax loss function for K weight matrices at once, as used to train
+  several hyperparameter configurations side by side. The scores of all K
+  classifiers come from one (N, D) x (D, K * C) matrix multiply.
+
+  Inputs:
+  - W: A numpy array of shape (D, K, C) containing K weight matrices.
+  - X: A numpy array of shape (N, D) containing a minibatch of data.
+  - y: A numpy array of shape (N,) containing training labels.
+  - reg: A numpy array of shape (K,) of regularization strengths.
+
+  Returns a tuple of:
+  - loss: A numpy array of shape (K,) giving the loss of each classifier
+  - gradient with respect to W; an array of the same shape as W
+  """
+  dim, num_configs, num_classes = W.shape
+  num_train = X.shape[0]
+  rows = np.arange(num_train)
+
+  dscores = X.dot(W.reshape(dim, -1)).reshape(num_train, num_configs,
+                                              num_classes)
+  correct_class_scores = dscores[rows, :, y]
+  log_Z = softmax_inplace(dscores.reshape(-1, num_classes))
+  loss = np.sum(log_Z.reshape(num_train, num_configs) - correct_class_scores,
+                axis=0) / num_train
+
+  dscores[rows, :, y] -= 1
+  dW = X.T.dot(dscores.reshape(num_train, -1)).reshape(W.shape)
+  dW /= num_train
+
+  reg = np.asarray(reg, dtype=W.dtype)
+  loss += reg * np.sum(W * W, axis=(0, 2))
+  dW += 2 * reg[:, None] * W
+  return loss, dW
@@ -1,7 +1,14 @@
 from __future__ import print_function
+import ctypes
+from functools import partial
+import hashlib
+from multiprocessing import Pool
+from multiprocessing.sharedctypes import RawArray
+import os
+import time
+import types
 from past.builtins import xrange
 
-import matplotlib
 import numpy as np
 from scipy.ndimage import uniform_filter
 
@@ -17,7 +24,10 @@ def extract_features(imgs, feature_fns, verbose=False):
   - imgs: N x H X W X C array of pixel data for N images.
   - feature_fns: List of k feature functions. The ith feature function should
     take as input an H x W x D array and return a (one-dimensional) array of
-    length F_i.
+    length F_i. A feature function with a batched attribute (such as
+    hog_feature), or a functools.partial of one, is instead applied to all
+    images at once through that attribute, which takes the N x H x W x C
+    array and returns an N x F_i array.
   - verbose: Boolean; if true, print progress.
 
   Returns:
@@ -28,34 +38,468 @@ def extract_features(imgs, feature_fns, verbose=False):
   if num_images == 0:
     return np.array([])
 
+  # Batched feature functions are computed for all images up front; the rest
+  # are applied image by image below.
+  batched_features = [None] * len(feature_fns)
+  for j, feature_fn in enumerate(feature_fns):
+    batched_fn = _batched(feature_fn)
+    if batched_fn is not None:
+      batched_features[j] = batched_fn(imgs)
+      if verbose:
+        print('Done extracting batched features %d / %d' % (
+              j + 1, len(feature_fns)))
+  single_fns = [(feature_fn, j) for j, feature_fn in enumerate(feature_fns)
+                if batched_features[j] is None]
+
   # Use the first image to determine feature dimensions
   feature_dims = []
   first_image_features = []
-  for feature_fn in feature_fns:
-    feats = feature_fn(imgs[0].squeeze())
-    assert len(feats.shape) == 1, 'Feature functions must be one-dimensional'
+  for feature_fn, feats in zip(feature_fns, batched_features):
+    if feats is None:
+      feats = feature_fn(imgs[0].squeeze())
+      assert len(feats.shape) == 1, 'Feature functions must be one-dimensional'
+    else:
+      feats = feats[0]
     feature_dims.append(feats.size)
     first_image_features.append(feats)
+  offsets = np.cumsum([0] + feature_dims)
 
   # Now that we know the dimensions of the features, we can allocate a single
   # big array to store all features as columns.
   total_feature_dim = sum(feature_dims)
   imgs_features = np.zeros((num_images, total_feature_dim))
   imgs_features[0] = np.hstack(first_image_features).T
+  for j, feats in enumerate(batched_features):
+    if feats is not None:
+      imgs_features[:, offsets[j]:offsets[j + 1]] = feats
 
   # Extract features for the rest of the images.
+  if not single_fns:
+    return imgs_features
   for i in xrange(1, num_images):
-    idx = 0
-    for feature_fn, feature_dim in zip(feature_fns, feature_dims):
-      next_idx = idx + feature_dim
-      imgs_features[i, idx:next_idx] = feature_fn(imgs[i].squeeze())
-      idx = next_idx
+    for feature_fn, j in single_fns:
+      imgs_features[i, offsets[j]:offsets[j + 1]] = feature_fn(
+        imgs[i].squeeze())
     if verbose and i % 1000 == 0:
       print('Done extracting features for %d / %d images' % (i, num_images))
 
   return imgs_features
 
 
+def _batched(feature_fn):
+  """
+  Return the batched version of a feature function, or None if it has none.
+  """
+  if isinstance(feature_fn, partial):
+    batched_fn = _batched(feature_fn.func)
+    if batched_fn is None:
+      return None
+    return partial(batched_fn, *feature_fn.args, **(feature_fn.keywords or {}))
+  return getattr(feature_fn, 'batched', None)
+
+
+def extract_features_pipeline(imgs, feature_fns, n_jobs=1, chunk_size=1000,
+                              out=None, dtype=np.float64, num_images=None,
+                              verbose=False):
+  """
+  Compute the same features as extract_features, in chunks of images that
+  are processed by a pool of n_jobs worker processes.
+
+  The images are streamed through at most two shared memory buffers of
+  n_jobs * chunk_size images each: while the workers extract features from
+  one buffer the next images are copied into the other, and no more input is
+  read until a buffer is free again. Workers write their features straight
+  into the output, which can be memory-mapped, so neither the images nor the
+  features need to fit in memory.
+
+  Inputs:
+  - imgs: N x H x W x C array of pixel data, which may be memory-mapped, or
+    an iterable of such arrays holding consecutive batches of images.
+  - feature_fns: List of feature functions; see extract_features. With
+    n_jobs > 1 they are handed to the workers when the pool starts.
+  - n_jobs: Number of worker processes; 1 extracts in the calling process.
+  - chunk_size: Number of images per worker task.
+  - out: Where to store the features. None allocates a new array, a string
+    is the filename of a .npy file to create and memory-map, and an existing
+    (N, F) array, such as an np.memmap, is filled in place.
+  - dtype: Data type of the features if out is None or a filename.
+  - num_images: Total number of images when imgs is an iterable. It is only
+    needed to write an iterable to a file; without it the features of an
+    iterable are gathered in memory and concatenated.
+  - verbose: Boolean; if true, print progress and throughput.
+
+  Returns:
+  An array of shape (N, F_1 + ... + F_k) of the features, which is out if it
+  was an array.
+  """
+  if isinstance(imgs, np.ndarray):
+    num_images = imgs.shape[0]
+    batches = [imgs]
+  else:
+    batches = imgs
+  if isinstance(out, str) and num_images is None:
+    raise ValueError('num_images is required to write an iterable to a file')
+
+  # Arrays already in memory are copied into shared memory in one round;
+  # anything else goes through buffers of n_jobs * chunk_size images.
+  capacity = n_jobs * chunk_size
+  if isinstance(imgs, np.ndarray) and not isinstance(imgs, np.memmap):
+    capacity = max(capacity, num_images)
+
+  state = pool = None
+  pending = []
+  parts = []
+  position = 0
+  num_done = 0
+  slot = 0
+  tic = time.time()
+  try:
+    for pieces in _rounds(batches, capacity):
+      n = sum(piece.shape[0] for piece in pieces)
+      if state is None:
+        state, out, pool = _start_pipeline(pieces[0], feature_fns, n_jobs,
+                                           capacity, out, dtype, num_images)
+      tasks = [(slot, start, min(start + chunk_size, n), position + start)
+               for start in xrange(0, n, chunk_size)]
+
+      if pool is None:
+        if len(pieces) == 1:
+          state['inputs'] = pieces
+        else:
+          state['inputs'] = [np.concatenate(pieces)]
+        for task in tasks:
+          _store(out, parts, task, _extract_chunk(state, task))
+        num_done += n
+      else:
+        # Wait for the workers to finish the oldest round, which used the
+        # buffer about to be overwritten.
+        while pending and pending[0][0][0] == slot:
+          task, result = pending.pop(0)
+          _store(out, parts, task, result.get())
+          num_done += task[2] - task[1]
+        start = 0
+        for piece in pieces:
+          state['inputs'][slot][start:start + piece.shape[0]] = piece
+          start += piece.shape[0]
+        pending.extend((task, pool.apply_async(_pipeline_worker, (task,)))
+                       for task in tasks)
+        slot = (slot + 1) % len(state['inputs'])
+
+      position += n
+      if verbose and num_done:
+        print('Done extracting features for %d images, %.1f images / second' % (
+              num_done, num_done / (time.time() - tic)))
+
+    for task, result in pending:
+      _store(out, parts, task, result.get())
+  finally:
+    if pool is not None:
+      pool.close()
+      pool.join()
+
+  if state is None:
+    return np.array([])
+  if out is None:
+    out = np.concatenate(parts)
+  if verbose:
+    elapsed = time.time() - tic
+    print('Extracted features for %d images in %.2fs, %.1f images / second' % (
+          position, elapsed, position / elapsed))
+  return out
+
+
+# State of the feature pipeline in a worker process.
+_pipeline_state = None
+
+
+def _rounds(batches, capacity):
+  """
+  Regroup an iterable of image batches into lists of consecutive batch slices
+  holding capacity images each, except for the last list.
+  """
+  pieces = []
+  size = 0
+  for batch in batches:
+    start = 0
+    while start < batch.shape[0]:
+      stop = min(batch.shape[0], start + capacity - size)
+      pieces.append(batch[start:stop])
+      size += stop - start
+      start = stop
+      if size == capacity:
+        yield pieces
+        pieces = []
+        size = 0
+  if pieces:
+    yield pieces
+
+
+def _start_pipeline(first_batch, feature_fns, n_jobs, capacity, out, dtype,
+                    num_images):
+  """
+  Set up the output and, if n_jobs > 1, the shared input buffers and worker
+  pool of extract_features_pipeline. Returns (state, out, pool).
+  """
+  num_features = extract_features(first_batch[:1], feature_fns).shape[1]
+  if isinstance(out, str):
+    out = np.lib.format.open_memmap(out, mode='w+', dtype=dtype,
+                                    shape=(num_images, num_features))
+  state = {'feature_fns': feature_fns, 'inputs': None, 'output': out,
+           'dtype': dtype if out is None else out.dtype}
+  if n_jobs == 1:
+    if out is None and num_images is not None:
+      out = state['output'] = np.empty((num_images, num_features), dtype)
+    return state, out, None
+
+  # Workers see the output through shared memory or by reopening its file;
+  # any other output array is filled by this process from their results.
+  worker_state = dict(state)
+  if out is None and num_images is not None:
+    worker_state['output'] = _shared_empty((num_images, num_features), dtype)
+    out = state['output'] = _from_shared(worker_state['output'])
+  elif isinstance(out, np.memmap) and out.filename is not None:
+    worker_state['output'] = ('memmap', out.filename, out.offset, out.shape,
+                              out.dtype)
+  else:
+    worker_state['output'] = None
+
+  num_slots = 1 if num_images is not None and num_images <= capacity else 2
+  worker_state['inputs'] = [
+    _shared_empty((capacity,) + first_batch.shape[1:], first_batch.dtype)
+    for _ in xrange(num_slots)]
+  state['inputs'] = [_from_shared(shared) for shared in worker_state['inputs']]
+  pool = Pool(n_jobs, initializer=_init_pipeline_worker,
+              initargs=(worker_state,))
+  return state, out, pool
+
+
+def _shared_empty(shape, dtype):
+  """
+  Allocate an uninitialized array in shared memory and return
+  (buffer, dtype, shape).
+  """
+  dtype = np.dtype(dtype)
+  nbytes = int(np.prod(shape)) * dtype.itemsize
+  return RawArray(ctypes.c_char, max(nbytes, 1)), dtype, shape
+
+
+def _from_shared(shared):
+  """
+  Return a numpy view of an array created by _shared_empty.
+  """
+  buf, dtype, shape = shared
+  size = int(np.prod(shape))
+  return np.frombuffer(buf, dtype=dtype, count=size).reshape(shape)
+
+
+def _init_pipeline_worker(state):
+  """
+  Pool initializer: map the shared inputs and output of the pipeline.
+  """
+  global _pipeline_state
+  state = dict(state)
+  state['inputs'] = [_from_shared(shared) for shared in state['inputs']]
+  output = state['output']
+  if output is not None and output[0] == 'memmap':
+    _, filename, offset, shape, dtype = output
+    state['output'] = np.memmap(filename, dtype=dtype, mode='r+',
+                                offset=offset, shape=shape)
+  elif output is not None:
+    state['output'] = _from_shared(output)
+  _pipeline_state = state
+
+
+def _pipeline_worker(task):
+  """
+  Pool task: extract the features of one chunk of images.
+  """
+  return _extract_chunk(_pipeline_state, task)
+
+
+def _extract_chunk(state, task):
+  """
+  Extract the features of images start:stop of input buffer slot, which are
+  images position:position + stop - start overall. They are written to the
+  output if there is one and returned otherwise.
+  """
+  slot, start, stop, position = task
+  feats = extract_features(state['inputs'][slot][start:stop],
+                           state['feature_fns'])
+  if state['output'] is None:
+    return feats.astype(state['dtype'], copy=False)
+  state['output'][position:position + stop - start] = feats
+  return None
+
+
+def _store(out, parts, task, feats):
+  """
+  Put the features returned for a task into out, or in order into parts if
+  there is no output array.
+  """
+  if feats is None:
+    return
+  if out is None:
+    parts.append(feats)
+  else:
+    position = task[3]
+    out[position:position + feats.shape[0]] = feats
+
+
+def extract_features_cached(imgs, feature_fns, cache_dir,
+                            max_cache_bytes=2 * 1024 ** 3, verbose=False,
+                            **kwargs):
+  """
+  Like extract_features_pipeline, but remember the result in cache_dir.
+
+  Entries are keyed by a hash of the image array (its shape, dtype and
+  contents), of the feature functions and of the output dtype, so a cached
+  matrix is reused whenever the same features are requested for the same
+  images, for example after a notebook restart. A feature function is
+  identified by its module, name and code, together with its defaults and
+  closure, the code of the functions of its own module that it calls, and
+  its batched version if it has one; the parameters of a functools.partial
+  are part of its identity. Other globals read by a feature function are
+  not, so pass parameters through partial rather than through global
+  variables.
+
+  Hits are returned as read-only memory-mapped arrays. When the entries take
+  more than max_cache_bytes, the least recently used ones are deleted.
+
+  Inputs:
+  - imgs: N x H x W x C array of pixel data, which may be memory-mapped.
+  - feature_fns: List of feature functions; see extract_features.
+  - cache_dir: Directory holding the cached feature matrices as .npy files.
+  - max_cache_bytes: Size cap of the cache directory.
+  - verbose: Boolean; if true, print whether the cache was hit.
+  - kwargs: Extra arguments for extract_features_pipeline, such as n_jobs,
+    chunk_size or dtype.
+
+  Returns:
+  An array of shape (N, F_1 + ... + F_k) of the features.
+  """
+  dtype = np.dtype(kwargs.pop('dtype', np.float64))
+  key = hashlib.sha1()
+  key.update(repr((imgs.shape, imgs.dtype.str, dtype.str)).encode('utf-8'))
+  for start in xrange(0, imgs.shape[0], 1024):
+    key.update(np.ascontiguousarray(imgs[start:start + 1024]))
+  for feature_fn in feature_fns:
+    key.update(_feature_fn_key(feature_fn).encode('utf-8'))
+  path = os.path.join(cache_dir, key.hexdigest() + '.npy')
+
+  if os.path.exists(path):
+    if verbose:
+      print('Loading cached features from %s' % path)
+    # The modification time orders the entries for eviction.
+    os.utime(path, None)
+    return np.load(path, mmap_mode='r')
+
+  if not os.path.isdir(cache_dir):
+    os.makedirs(cache_dir)
+  # Write under a temporary name so that an interrupted extraction never
+  # leaves a truncated entry behind.
+  tmp_path = '%s.%d.tmp.npy' % (path[:-len('.npy')], os.getpid())
+  try:
+    feats = extract_features_pipeline(imgs, feature_fns, out=tmp_path,
+                                      dtype=dtype, verbose=verbose, **kwargs)
+    if isinstance(feats, np.memmap):
+      feats.flush()
+    del feats
+    os.rename(tmp_path, path)
+  finally:
+    if os.path.exists(tmp_path):
+      os.remove(tmp_path)
+  _evict(cache_dir, max_cache_bytes, keep=path)
+  return np.load(path, mmap_mode='r')
+
+
+def _feature_fn_key(feature_fn):
+  """
+  Return a string identifying a feature function and its parameters. The
+  string is the same in every process: code objects, including nested ones
+  such as lambdas and comprehensions, are hashed by their contents rather
+  than by their repr, which holds a memory address. The batched version that
+  extract_features dispatches to is part of the key, and so are the
+  functions of the same module that either one calls.
+  """
+  if isinstance(feature_fn, partial):
+    return 'partial(%s, %s, %s)' % (
+      _feature_fn_key(feature_fn.func),
+      [_value_key(arg) for arg in feature_fn.args],
+      sorted((name, _value_key(value))
+             for name, value in (feature_fn.keywords or {}).items()))
+  code = getattr(feature_fn, '__code__', None)
+  if code is None:
+    return repr(feature_fn)
+  closure = [cell.cell_contents for cell in feature_fn.__closure__ or ()]
+  body = hashlib.sha1()
+  _hash_code(body, code, feature_fn.__globals__)
+  for value in list(feature_fn.__defaults__ or ()) + closure:
+    body.update(_value_key(value).encode('utf-8'))
+  batched_fn = _batched(feature_fn)
+  if batched_fn is not None:
+    body.update(_feature_fn_key(batched_fn).encode('utf-8'))
+  name = getattr(feature_fn, '__qualname__', feature_fn.__name__)
+  return '%s.%s:%s' % (feature_fn.__module__, name, body.hexdigest())
+
+
+def _hash_code(body, code, namespace, seen=None):
+  """
+  Update the hash body with the bytecode, names and constants of a code
+  object, recursing into the code objects among its constants and into the
+  functions it reads from namespace, the globals of the function, that are
+  defined in the same module.
+  """
+  if seen is None:
+    seen = set()
+  body.update(code.co_code)
+  body.update(repr(code.co_names).encode('utf-8'))
+  for const in code.co_consts:
+    if isinstance(const, types.CodeType):
+      _hash_code(body, const, namespace, seen)
+    else:
+      body.update(_value_key(const).encode('utf-8'))
+  for name in code.co_names:
+    helper = namespace.get(name)
+    if (name not in seen and isinstance(helper, types.FunctionType) and
+        helper.__module__ == namespace.get('__name__')):
+      seen.add(name)
+      _hash_code(body, helper.__code__, namespace, seen)
+      for value in helper.__defaults__ or ():
+        body.update(_value_key(value).encode('utf-8'))
+
+
+def _value_key(value):
+  """
+  Return a string identifying a default, closure or constant value.
+  """
+  if isinstance(value, partial) or hasattr(value, '__code__'):
+    return _feature_fn_key(value)
+  if isinstance(value, frozenset):
+    # Set order depends on string hashing, which changes between processes.
+    return 'frozenset(%s)' % sorted(_value_key(item) for item in value)
+  return repr(value)
+
+
+def _evict(cache_dir, max_cache_bytes, keep=None):
+  """
+  Delete the least recently used .npy files of cache_dir, other than keep,
+  until the remaining ones take at most max_cache_bytes.
+  """
+  entries = []
+  for filename in os.listdir(cache_dir):
+    path = os.path.join(cache_dir, filename)
+    if filename.endswith('.npy') and not filename.endswith('.tmp.npy'):
+      info = os.stat(path)
+      entries.append((info.st_mtime, info.st_size, path))
+  total = sum(size for _, size, _ in entries)
+  for _, size, path in sorted(entries):
+    if total <= max_cache_bytes:
+      break
+    if path != keep:
+      os.remove(path)
+      total -= size
+
+
 def rgb2gray(rgb):
   """Convert RGB image to grayscale
 
@@ -91,7 +535,7 @@ def hog_feature(im):
   if im.ndim == 3:
     image = rgb2gray(im)
   else:
-    image = np.at_least_2d(im)
+    image = np.atleast_2d(im)
 
   sx, sy = image.shape # image size
   orientations = 9 # number of gradient bins
@@ -118,11 +562,107 @@ def hog_feature(im):
     # select magnitudes for those orientations
     cond2 = temp_ori > 0
     temp_mag = np.where(cond2, grad_mag, 0)
-    orientation_histogram[:,:,i] = uniform_filter(temp_mag, size=(cx, cy))[cx/2::cx, cy/2::cy].T
+    orientation_histogram[:,:,i] = uniform_filter(temp_mag, size=(cx, cy))[cx//2::cx, cy//2::cy].T
   
   return orientation_histogram.ravel()
 
 
+def hog_features(imgs, block_size=1000):
+  """Compute the HOG feature of hog_feature for a batch of images
+
+    All images of a block are processed together: every gradient pixel is
+    assigned to its orientation bin in a single pass, and the 8 x 8 cell
+    averages of all bins, which is what the uniform_filter in hog_feature
+    computes at the sampled cell centers, are summed with one bincount.
+
+    Parameters:
+      imgs : N x H x W x C array of rgb images, or N x H x W array of
+        grayscale images
+      block_size : number of images processed at once, bounding the memory
+        used by the intermediate arrays
+
+    Returns:
+      feats: N x F array whose ith row equals hog_feature(imgs[i])
+
+  """
+  num_images = imgs.shape[0]
+  feats = None
+  for start in xrange(0, num_images, block_size):
+    block = imgs[start:start + block_size]
+    block_feats = _hog_cells(*_gradients(_gray_images(block)))
+    if feats is None:
+      feats = np.zeros((num_images, block_feats.shape[1]))
+    feats[start:start + block.shape[0]] = block_feats
+  return feats
+
+
+def _gray_images(imgs):
+  """
+  Return the N x H x W grayscale version of a batch of rgb or grayscale
+  images, as used by hog_feature.
+  """
+  if imgs.ndim == 4 and imgs.shape[3] == 1:
+    imgs = imgs[:, :, :, 0]
+  if imgs.ndim == 4:
+    return rgb2gray(imgs)
+  return imgs.astype(np.float64)
+
+
+def _gradients(image):
+  """
+  Return the gradient magnitudes and orientations (in degrees, shifted by
+  90) of an N x H x W batch of grayscale images, as used by hog_feature.
+  """
+  gx = np.zeros(image.shape)
+  gy = np.zeros(image.shape)
+  gx[:, :, :-1] = np.diff(image, n=1, axis=2)
+  gy[:, :-1, :] = np.diff(image, n=1, axis=1)
+  grad_mag = np.sqrt(gx ** 2 + gy ** 2)
+  grad_ori = np.arctan2(gy, (gx + 1e-15)) * (180 / np.pi) + 90
+  return grad_mag, grad_ori
+
+
+def _hog_cells(grad_mag, grad_ori):
+  """
+  Pool the gradients of an N x H x W batch into the N x F HOG features of
+  hog_feature.
+  """
+  n, sx, sy = grad_mag.shape
+  orientations = 9 # number of gradient bins
+  cx, cy = (8, 8) # pixels per cell
+  n_cellsx = int(np.floor(sx / cx))  # number of cells in x
+  n_cellsy = int(np.floor(sy / cy))  # number of cells in y
+  bin_width = 180 / orientations
+
+  # Same bins as the masked passes of hog_feature: bin i holds orientations
+  # in [bin_width * i, bin_width * (i + 1)), and an orientation of exactly
+  # 0 or outside [0, 180) is not counted. The comparisons correct floor for
+  # rounding at the bin edges.
+  bins = np.floor(grad_ori / bin_width)
+  bins -= grad_ori < bin_width * bins
+  bins += grad_ori >= bin_width * (bins + 1)
+  valid = (grad_ori > 0) & (grad_ori < 180)
+  bins = np.where(valid, bins, orientations).astype(np.intp)
+
+  # Pool each cell's magnitudes into its histogram with one bincount over
+  # (image, cell row, cell col, bin) indices; pixels outside the cells and
+  # uncounted orientations go to a discard bin.
+  cell_x = np.minimum(np.arange(sx) // cx, n_cellsx)
+  cell_y = np.minimum(np.arange(sy) // cy, n_cellsy)
+  cell_idx = cell_x[:, np.newaxis] * (n_cellsy + 1) + cell_y
+  idx = np.arange(n)[:, np.newaxis, np.newaxis] * (n_cellsx + 1)
+  idx = (idx * (n_cellsy + 1) + cell_idx) * (orientations + 1) + bins
+  cells = np.bincount(idx.ravel(), weights=grad_mag.ravel(),
+                      minlength=n * (n_cellsx + 1) * (n_cellsy + 1) *
+                      (orientations + 1))
+  cells = cells.reshape(n, n_cellsx + 1, n_cellsy + 1, orientations + 1)
+  cells = cells[:, :n_cellsx, :n_cellsy, :orientations] / (cx * cy)
+  return cells.transpose(0, 2, 1, 3).reshape(n, -1)
+
+
+hog_feature.batched = hog_features
+
+
 def color_histogram_hsv(im, nbin=10, xmin=0, xmax=255, normalized=True):
   """
   Compute color histogram for an image using hue.
@@ -138,14 +678,239 @@ def color_histogram_hsv(im, nbin=10, xmin=0, xmax=255, normalized=True):
     1D vector of length nbin giving the color histogram over the hue of the
     input image.
   """
-  ndim = im.ndim
+  return color_histograms_hsv(im[np.newaxis], nbin=nbin, xmin=xmin,
+                              xmax=xmax, normalized=normalized)[0]
+
+
+def color_histograms_hsv(imgs, nbin=10, xmin=0, xmax=255, normalized=True,
+                         block_size=1000):
+  """
+  Compute the hue histogram of color_histogram_hsv for a batch of images.
+
+  The hue of every pixel is computed in one vectorized pass, with the same
+  formula as matplotlib.colors.rgb_to_hsv, and the histograms of a block of
+  images are counted with one bincount over the bins offset by nbin times
+  the image index.
+
+  Inputs:
+  - imgs: N x H x W x C array of pixel data for N RGB images.
+  - nbin, xmin, xmax, normalized: See color_histogram_hsv.
+  - block_size: Number of images processed at once, bounding the memory used
+    by the intermediate arrays.
+
+  Returns:
+    N x nbin array whose ith row equals color_histogram_hsv(imgs[i]).
+  """
+  num_images = imgs.shape[0]
+  imhist = np.zeros((num_images, nbin))
+  for start in xrange(0, num_images, block_size):
+    block = imgs[start:start + block_size]
+    hue = _hue(block[..., :3] / float(xmax)) * xmax
+    imhist[start:start + block.shape[0]] = _hue_histograms(
+      hue, nbin, xmin, xmax, normalized)
+  return imhist
+
+
+def _hue_histograms(hue, nbin, xmin, xmax, normalized):
+  """
+  Build the histograms of color_histogram_hsv from an N x H x W array of
+  hues scaled to [0, xmax).
+  """
+  n = hue.shape[0]
   bins = np.linspace(xmin, xmax, nbin+1)
-  hsv = matplotlib.colors.rgb_to_hsv(im/xmax) * xmax
-  imhist, bin_edges = np.histogram(hsv[:,:,0], bins=bins, density=normalized)
-  imhist = imhist * np.diff(bin_edges)
 
-  # return histogram
+  # Bin like np.histogram does for equal-width bins: values outside
+  # [xmin, xmax] are dropped, xmax falls in the last bin, and the computed
+  # bin is corrected against the actual edges.
+  hue = hue.reshape(n, -1)
+  inside = (hue >= bins[0]) & (hue <= bins[-1])
+  idx = np.floor((hue - bins[0]) * (nbin / float(bins[-1] - bins[0])))
+  idx = np.clip(idx, 0, nbin - 1).astype(np.intp)
+  idx -= hue < bins[idx]
+  idx += (hue >= bins[np.minimum(idx + 1, nbin)]) & (idx != nbin - 1)
+  idx += nbin * np.arange(n)[:, np.newaxis]
+  counts = np.bincount(idx[inside], minlength=n * nbin)
+  imhist = counts.reshape(n, nbin).astype(np.float64)
+
+  if normalized:
+    # np.histogram with density=True, multiplied back by the bin widths.
+    imhist /= imhist.sum(axis=1, keepdims=True)
+  else:
+    imhist *= np.diff(bins)
   return imhist
 
 
-pass
+def _hue(rgb):
+  """
+  Return the hue in [0, 1) of an array of RGB values in [0, 1] whose last
+  axis holds the channels, as computed by matplotlib.colors.rgb_to_hsv.
+  """
+  if np.any(rgb > 1) or np.any(rgb < 0):
+    raise ValueError('RGB values must be in the 0..1 range')
+  r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+  value = rgb.max(axis=-1)
+  delta = value - rgb.min(axis=-1)
+  ipos = delta > 0
+  safe_delta = np.where(ipos, delta, 1)
+  # Where several channels are the maximum, the last one wins, as in
+  # rgb_to_hsv.
+  hue = np.zeros(value.shape)
+  hue = np.where((r == value) & ipos, (g - b) / safe_delta, hue)
+  hue = np.where((g == value) & ipos, 2.0 + (b - r) / safe_delta, hue)
+  hue = np.where((b == value) & ipos, 4.0 + (r - g) / safe_delta, hue)
+  return (hue / 6.0) % 1.0
+
+
+color_histogram_hsv.batched = color_histograms_hsv
+
+
+# Registries of extract_registered_features. An intermediate is an array
+# computed from a block of images, such as its grayscale version, that the
+# planner computes once per block and shares between all the features and
+# intermediates that require it. The block itself is the intermediate
+# 'images'.
+INTERMEDIATES = {}
+FEATURES = {}
+
+
+def register_intermediate(name, requires=('images',)):
+  """
+  Decorator registering fn(*required) as the intermediate name, where
+  required holds the values of the intermediates named in requires.
+  """
+  def decorator(fn):
+    INTERMEDIATES[name] = (tuple(requires), fn)
+    return fn
+  return decorator
+
+
+def register_feature(name, requires=('images',)):
+  """
+  Decorator registering fn(*required, **params) as the feature name. It
+  receives the values of the intermediates named in requires for a block of
+  N images, plus the parameters given to extract_registered_features, and
+  returns an N x F array.
+  """
+  def decorator(fn):
+    FEATURES[name] = (tuple(requires), fn)
+    return fn
+  return decorator
+
+
+def plan_features(features):
+  """
+  Return the names of the intermediates needed by a list of features, in an
+  order in which each one comes after those it requires.
+
+  Inputs:
+  - features: List of feature names, or (name, params) pairs.
+  """
+  plan = []
+  def visit(name):
+    if name == 'images' or name in plan:
+      return
+    if name not in INTERMEDIATES:
+      raise ValueError('Invalid intermediate "%s"' % name)
+    for required in INTERMEDIATES[name][0]:
+      visit(required)
+    plan.append(name)
+  for name, _ in _feature_specs(features):
+    for required in FEATURES[name][0]:
+      visit(required)
+  return plan
+
+
+def extract_registered_features(imgs, features, block_size=1000,
+                                verbose=False):
+  """
+  Compute registered features for a batch of images, block by block. Each
+  intermediate in plan_features(features) is computed once per block and
+  passed to every feature that requires it, so that for example HOG and a
+  color histogram do not each convert the images on their own.
+
+  The columns are the concatenation of the features in the order given, so
+  ['hog', ('color_histogram_hsv', {'nbin': 10})] gives the same matrix as
+  extract_features with [hog_feature, partial(color_histogram_hsv, nbin=10)].
+
+  Inputs:
+  - imgs: N x H x W x C array of pixel data for N images.
+  - features: List of names from FEATURES, or (name, params) pairs where
+    params is a dict of keyword arguments for that feature.
+  - block_size: Number of images processed at once, bounding the memory used
+    by the intermediates.
+  - verbose: Boolean; if true, print progress.
+
+  Returns:
+  An array of shape (N, F_1 + ... + F_k) of the features.
+  """
+  specs = _feature_specs(features)
+  plan = plan_features(features)
+  num_images = imgs.shape[0]
+  imgs_features = None
+  for start in xrange(0, num_images, block_size):
+    values = {'images': imgs[start:start + block_size]}
+    for name in plan:
+      requires, fn = INTERMEDIATES[name]
+      values[name] = fn(*[values[required] for required in requires])
+    block_features = []
+    for name, params in specs:
+      requires, fn = FEATURES[name]
+      block_features.append(
+        fn(*[values[required] for required in requires], **params))
+    block_features = np.hstack(block_features)
+
+    if imgs_features is None:
+      imgs_features = np.zeros((num_images, block_features.shape[1]))
+    imgs_features[start:start + block_features.shape[0]] = block_features
+    if verbose:
+      print('Done extracting features for %d / %d images' % (
+            start + block_features.shape[0], num_images))
+
+  if imgs_features is None:
+    return np.array([])
+  return imgs_features
+
+
+def _feature_specs(features):
+  """
+  Normalize a list of feature names and (name, params) pairs to pairs.
+  """
+  specs = []
+  for feature in features:
+    name, params = (feature, {}) if isinstance(feature, str) else feature
+    if name not in FEATURES:
+      raise ValueError('Invalid feature "%s"' % name)
+    specs.append((name, params))
+  return specs
+
+
+@register_intermediate('gray')
+def _gray_intermediate(imgs):
+  return _gray_images(imgs)
+
+
+@register_intermediate('gradients', requires=('gray',))
+def _gradients_intermediate(gray):
+  return _gradients(gray)
+
+
+# Hue of pixels in the range 0..255, in [0, 1).
+@register_intermediate('hue')
+def _hue_intermediate(imgs):
+  return _hue(imgs[..., :3] / 255.0)
+
+
+@register_feature('hog', requires=('gradients',))
+def _hog_registered(gradients):
+  return _hog_cells(*gradients)
+
+
+@register_feature('color_histogram_hsv', requires=('hue', 'images'))
+def _color_histogram_hsv_registered(hue, imgs, nbin=10, xmin=0, xmax=255,
+                                    normalized=True):
+  # The shared hue is for the range 0..255. Mathematically the hue does not
+  # depend on the range, but the bins only match color_histogram_hsv exactly
+  # if the pixels are divided by the same xmax.
+  if xmax != 255:
+    hue = _hue(imgs[..., :3] / float(xmax))
+  return _hue_histograms(hue * xmax, nbin, xmin, xmax, normalized)
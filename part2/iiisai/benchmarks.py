@@ -0,0 +1,408 @@
+from __future__ import print_function
+
+import time
+
+import numpy as np
+
+from iiisai.data_utils import get_CIFAR10_data, load_CIFAR10
+
+
+def time_function(f, *args, **kwargs):
+    """
+    Call f with the given arguments and return a tuple (seconds, result).
+    """
+    tic = time.time()
+    result = f(*args, **kwargs)
+    toc = time.time()
+    return toc - tic, result
+
+
+def measure_peak_memory(f, *args, **kwargs):
+    """
+    Call f with the given arguments and return a tuple (peak_bytes, seconds,
+    result), where peak_bytes is the largest amount of memory allocated
+    during the call as traced by tracemalloc. numpy arrays are traced, while
+    pages of memory-mapped files are not.
+    """
+    import tracemalloc
+    tracemalloc.start()
+    try:
+        seconds, result = time_function(f, *args, **kwargs)
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return peak_bytes, seconds, result
+
+
+def _get_CIFAR10_data_float64(num_training=49000, num_validation=1000,
+                              num_test=1000):
+    """
+    The original get_CIFAR10_data: float64 images, fancy-indexed splits, and
+    mean subtraction followed by a transposed copy.
+    """
+    cifar10_dir = 'iiisai/datasets/cifar-10-batches-py'
+    X_train, y_train, X_test, y_test = load_CIFAR10(cifar10_dir)
+    mask = list(range(num_training, num_training + num_validation))
+    X_val = X_train[mask]
+    mask = list(range(num_training))
+    X_train = X_train[mask]
+    mask = list(range(num_test))
+    X_test = X_test[mask]
+    mean_image = np.mean(X_train, axis=0)
+    X_train -= mean_image
+    X_val -= mean_image
+    X_test -= mean_image
+    return {
+      'X_train': X_train.transpose(0, 3, 1, 2).copy(),
+      'X_val': X_val.transpose(0, 3, 1, 2).copy(),
+      'X_test': X_test.transpose(0, 3, 1, 2).copy(),
+    }
+
+
+def benchmark_get_CIFAR10_data(dtypes=(np.float64, np.float32), verbose=True):
+    """
+    Report the peak memory and time of get_CIFAR10_data before and after it
+    was changed to write all splits in one pass into a single buffer. Run
+    from the directory holding iiisai/datasets, as get_CIFAR10_data expects;
+    load_CIFAR10 is called once first so that neither side pays for building
+    the uint8 cache.
+
+    Inputs:
+    - dtypes: Data types to run the current get_CIFAR10_data with.
+    - verbose: If true, print one line per measurement.
+
+    Returns:
+    A list of dictionaries with keys 'method', 'peak_bytes', 'time' and
+    'max_error' (largest difference from the original images).
+    """
+    load_CIFAR10('iiisai/datasets/cifar-10-batches-py', dtype=None)
+    peak_bytes, seconds, expected = measure_peak_memory(
+        _get_CIFAR10_data_float64)
+    results = [{'method': 'original float64', 'peak_bytes': peak_bytes,
+                'time': seconds, 'max_error': 0.0}]
+    for dtype in dtypes:
+        peak_bytes, seconds, data = measure_peak_memory(get_CIFAR10_data,
+                                                        dtype=dtype)
+        max_error = max(np.max(np.abs(data[name] - expected[name]))
+                        for name in ('X_train', 'X_val', 'X_test'))
+        results.append({'method': 'one pass %s' % np.dtype(dtype).name,
+                        'peak_bytes': peak_bytes, 'time': seconds,
+                        'max_error': max_error})
+        del data
+
+    if verbose:
+        for r in results:
+            print('%-17s peak %8.1f MB  %7.3fs  max error %g' % (
+                  r['method'], r['peak_bytes'] / 1024.0 ** 2, r['time'],
+                  r['max_error']))
+    return results
+
+
+def benchmark_minibatch_sampling(num_train=49000, dim=3072, batch_size=100,
+                                 num_steps=1000, dtype=np.float32,
+                                 verbose=True):
+    """
+    Report the per-step cost of drawing minibatches from a random training
+    set: np.random.choice with a gather, as the solvers used to, against
+    MinibatchSampler with and without reorder. The cost of the per-epoch
+    permutation is included in the sampler times.
+
+    Inputs:
+    - num_train, dim: Shape of the random training data.
+    - batch_size: Number of examples per minibatch.
+    - num_steps: Number of minibatches drawn with each method.
+    - dtype: Data type of the training data.
+    - verbose: If true, print one line per method.
+
+    Returns:
+    A list of dictionaries with keys 'method' and 'time_per_step'.
+    """
+    from iiisai.sampler import MinibatchSampler
+
+    X = np.random.randn(num_train, dim).astype(dtype)
+    y = np.random.randint(10, size=num_train)
+
+    def choice():
+        for _ in range(num_steps):
+            mask = np.random.choice(num_train, batch_size)
+            X[mask], y[mask]
+
+    def sampler(reorder):
+        sampler = MinibatchSampler((X, y), batch_size, reorder=reorder)
+        for _ in range(num_steps):
+            sampler.sample()
+
+    results = []
+    for method, f, args in [('np.random.choice', choice, ()),
+                            ('sampler', sampler, (False,)),
+                            ('sampler reorder', sampler, (True,))]:
+        seconds, _ = time_function(f, *args)
+        results.append({'method': method,
+                        'time_per_step': seconds / num_steps})
+
+    if verbose:
+        for r in results:
+            print('%-16s %8.1f us / step' % (r['method'],
+                                             r['time_per_step'] * 1e6))
+    return results
+
+
+def benchmark_fc_net_arena(hidden_dims=(100, 100, 100), input_dim=3 * 32 * 32,
+                           num_classes=10, batch_size=200, num_steps=20,
+                           dtype=np.float32, verbose=True):
+    """
+    Show the memory allocated by training steps of a FullyConnectedNet with
+    and without its arena mode. After one warm-up step, which allocates the
+    arena, num_steps steps of loss and an sgd update are traced with
+    tracemalloc; the arena mode should allocate next to nothing.
+
+    Inputs:
+    - hidden_dims, input_dim, num_classes: Shape of the network.
+    - batch_size: Number of examples per step.
+    - num_steps: Number of steps traced.
+    - dtype: Data type of the network and the data.
+    - verbose: If true, print one line per mode.
+
+    Returns:
+    A list of dictionaries with keys 'method', 'peak_bytes' (the largest
+    amount of memory allocated at once during the steps), 'time_per_step',
+    'max_error' (largest difference of the losses from the regular mode) and
+    'max_grad_error' (largest difference of the gradients of the warm-up
+    step from the regular mode).
+    """
+    from iiisai.classifiers.fc_net import FullyConnectedNet
+
+    X = np.random.randn(batch_size, input_dim).astype(dtype)
+    y = np.random.randint(num_classes, size=batch_size)
+    params = FullyConnectedNet(list(hidden_dims), input_dim, num_classes,
+                               dtype=dtype).params
+
+    def train(model):
+        losses = []
+        for _ in range(num_steps):
+            loss, grads = model.loss(X, y)
+            for k, dw in grads.items():
+                w = model.params[k]
+                dw *= 1e-3
+                w -= dw
+            losses.append(loss)
+        return losses
+
+    results = []
+    for method, arena in (('regular', False), ('arena', True)):
+        model = FullyConnectedNet(list(hidden_dims), input_dim, num_classes,
+                                  dtype=dtype, arena=arena)
+        model.params = {k: v.copy() for k, v in params.items()}
+        _, grads = model.loss(X, y)
+        # The arena mode reuses its gradient arrays in the next step.
+        grads = {k: v.copy() for k, v in grads.items()}
+        model.params = {k: v.copy() for k, v in params.items()}
+        peak_bytes, seconds, losses = measure_peak_memory(train, model)
+        if not results:
+            expected, expected_grads = losses, grads
+        results.append({'method': method, 'peak_bytes': peak_bytes,
+                        'time_per_step': seconds / num_steps,
+                        'max_error': np.max(np.abs(np.subtract(losses,
+                                                               expected))),
+                        'max_grad_error': max(
+                            np.max(np.abs(grads[k] - expected_grads[k]))
+                            for k in expected_grads)})
+
+    if verbose:
+        for r in results:
+            print('%-7s peak %10.1f KB  %8.3f ms / step  max error %g  '
+                  'max grad error %g' % (
+                      r['method'], r['peak_bytes'] / 1024.0,
+                      r['time_per_step'] * 1e3, r['max_error'],
+                      r['max_grad_error']))
+    return results
+
+
+def check_fc_net_arena(max_peak_fraction=0.1, tol=1e-5, **kwargs):
+    """
+    Check with benchmark_fc_net_arena that the arena mode of
+    FullyConnectedNet allocates less than max_peak_fraction of the memory of
+    the regular mode during training, and that its losses and gradients
+    match the regular mode to within tol.
+
+    Inputs:
+    - max_peak_fraction: Largest allowed ratio of the arena peak to the
+      regular peak.
+    - tol: Largest allowed difference of the losses and of the gradients.
+    - kwargs: Extra arguments for benchmark_fc_net_arena.
+
+    Raises AssertionError on a failure.
+    """
+    kwargs.setdefault('verbose', False)
+    regular, arena = benchmark_fc_net_arena(**kwargs)
+    assert arena['peak_bytes'] < max_peak_fraction * regular['peak_bytes'], (
+        'arena peak %d bytes is not below %g of the regular %d bytes' % (
+            arena['peak_bytes'], max_peak_fraction, regular['peak_bytes']))
+    assert arena['max_error'] <= tol, (
+        'arena losses differ by %g' % arena['max_error'])
+    assert arena['max_grad_error'] <= tol, (
+        'arena gradients differ by %g' % arena['max_grad_error'])
+
+
+def _scores_with_caches(model, X):
+    """
+    The test-time forward pass that the models ran before they had an
+    inference path, building every cache: conv - relu - pool - affine -
+    relu - affine for a ThreeLayerConvNet, affine - relu stacks otherwise,
+    with test-mode batch normalization if the model uses it.
+    """
+    from iiisai.layer_utils import (affine_bn_relu_forward, affine_forward,
+                                    affine_relu_forward,
+                                    conv_relu_pool_forward)
+
+    params = model.params
+    if 'W1' in params and params['W1'].ndim == 4:
+        filter_size = params['W1'].shape[2]
+        conv_param = {'stride': 1, 'pad': (filter_size - 1) // 2}
+        pool_param = {'pool_height': 2, 'pool_width': 2, 'stride': 2}
+        out, cache1 = conv_relu_pool_forward(X, params['W1'], params['b1'],
+                                             conv_param, pool_param)
+        out, cache2 = affine_relu_forward(out, params['W2'], params['b2'])
+        scores, cache3 = affine_forward(out, params['W3'], params['b3'])
+        return scores
+    num_layers = len([k for k in params if k.startswith('W')])
+    out = X.astype(model.dtype) if hasattr(model, 'dtype') else X
+    caches = []
+    for i in range(1, num_layers):
+        if getattr(model, 'use_batchnorm', False):
+            bn_param = dict(model.bn_params[i - 1], mode='test')
+            out, cache = affine_bn_relu_forward(
+                out, params['W%d' % i], params['b%d' % i],
+                params['gamma%d' % i], params['beta%d' % i], bn_param)
+        else:
+            out, cache = affine_relu_forward(out, params['W%d' % i],
+                                             params['b%d' % i])
+        caches.append(cache)
+    scores, cache = affine_forward(out, params['W%d' % num_layers],
+                                   params['b%d' % num_layers])
+    return scores
+
+
+def benchmark_inference(models=None, batch_size=500, input_dim=(3, 32, 32),
+                        num_repeats=3, dtype=np.float32, verbose=True):
+    """
+    Compare the peak memory and time of scoring a batch with the test-time
+    forward pass that builds every cache against the inference path that
+    model.loss(X) now takes.
+
+    Inputs:
+    - models: List of (name, model) pairs; by default a ThreeLayerConvNet
+      and a FullyConnectedNet with and without batch normalization on
+      CIFAR-10 sized images.
+    - batch_size: Number of images scored at once.
+    - input_dim: Shape (C, H, W) of the random images.
+    - num_repeats: Number of times each batch is scored.
+    - dtype: Data type of the images.
+    - verbose: If true, print one line per measurement.
+
+    Returns:
+    A list of dictionaries with keys 'model', 'method', 'peak_bytes',
+    'time' (per batch) and 'max_error' (largest difference from the scores
+    with caches).
+    """
+    if models is None:
+        from iiisai.classifiers.cnn import ThreeLayerConvNet
+        from iiisai.classifiers.fc_net import FullyConnectedNet
+        models = [('ThreeLayerConvNet', ThreeLayerConvNet(input_dim=input_dim,
+                                                          dtype=dtype)),
+                  ('FullyConnectedNet', FullyConnectedNet(
+                      [100, 100, 100], input_dim=int(np.prod(input_dim)),
+                      dtype=dtype)),
+                  ('FullyConnectedNet+bn', FullyConnectedNet(
+                      [100, 100, 100], input_dim=int(np.prod(input_dim)),
+                      use_batchnorm=True, dtype=dtype))]
+    X = np.random.randn(batch_size, *input_dim).astype(dtype)
+    for name, model in models:
+        if getattr(model, 'use_batchnorm', False):
+            # A training pass gives the batch normalization layers their
+            # running statistics.
+            model.loss(X, np.zeros(batch_size, dtype=int))
+
+    def repeat(f, *args):
+        for _ in range(num_repeats):
+            scores = f(*args)
+        return scores
+
+    results = []
+    for name, model in models:
+        peak_bytes, seconds, expected = measure_peak_memory(
+            repeat, _scores_with_caches, model, X)
+        results.append({'model': name, 'method': 'with caches',
+                        'peak_bytes': peak_bytes,
+                        'time': seconds / num_repeats, 'max_error': 0.0})
+        peak_bytes, seconds, scores = measure_peak_memory(repeat, model.loss,
+                                                          X)
+        results.append({'model': name, 'method': 'inference',
+                        'peak_bytes': peak_bytes,
+                        'time': seconds / num_repeats,
+                        'max_error': np.max(np.abs(scores - expected))})
+
+    if verbose:
+        for r in results:
+            print('%-20s %-11s peak %8.1f MB  %7.3fs  max error %g' % (
+                  r['model'], r['method'], r['peak_bytes'] / 1024.0 ** 2,
+                  r['time'], r['max_error']))
+    return results
+
+
+def benchmark_batchnorm_folding(hidden_dims=(100, 100, 100, 100),
+                                input_dim=3 * 32 * 32, num_classes=10,
+                                batch_size=500, num_repeats=10,
+                                dtype=np.float32, verbose=True):
+    """
+    Compare the test-time scores of a FullyConnectedNet with batch
+    normalization and dropout against the InferenceModel returned by
+    optimize_for_inference, which folds the batch normalization into the
+    affine layers and drops the dropout. A few training-mode passes on random
+    data first give the batch normalization layers running statistics.
+
+    Inputs:
+    - hidden_dims, input_dim, num_classes: Shape of the network.
+    - batch_size: Number of examples scored at once.
+    - num_repeats: Number of times the batch is scored.
+    - dtype: Data type of the network and the data.
+    - verbose: If true, print one line per model.
+
+    Returns:
+    A list of dictionaries with keys 'method', 'num_layers', 'peak_bytes',
+    'time' (per batch) and 'max_error' (largest difference from the scores
+    of the original model, relative to the largest score).
+    """
+    from iiisai.classifiers.fc_net import FullyConnectedNet
+    from iiisai.inference import export_layers, optimize_for_inference
+
+    model = FullyConnectedNet(list(hidden_dims), input_dim, num_classes,
+                              dropout=0.5, use_batchnorm=True, dtype=dtype)
+    X = np.random.randn(batch_size, input_dim).astype(dtype)
+    y = np.random.randint(num_classes, size=batch_size)
+    for _ in range(5):
+        model.loss(X, y)
+    fast_model = optimize_for_inference(model)
+
+    def repeat(f, *args):
+        for _ in range(num_repeats):
+            scores = f(*args)
+        return scores
+
+    peak_bytes, seconds, expected = measure_peak_memory(repeat, model.loss, X)
+    results = [{'method': 'original', 'num_layers': len(export_layers(model)),
+                'peak_bytes': peak_bytes, 'time': seconds / num_repeats,
+                'max_error': 0.0}]
+    peak_bytes, seconds, scores = measure_peak_memory(repeat, fast_model.loss,
+                                                      X)
+    results.append({'method': 'optimized', 'num_layers': len(fast_model.layers),
+                    'peak_bytes': peak_bytes, 'time': seconds / num_repeats,
+                    'max_error': np.max(np.abs(scores - expected)) /
+                                 np.max(np.abs(expected))})
+
+    if verbose:
+        for r in results:
+            print('%-9s %2d layers  peak %7.1f MB  %7.4fs  max error %g' % (
+                  r['method'], r['num_layers'], r['peak_bytes'] / 1024.0 ** 2,
+                  r['time'], r['max_error']))
+    return results
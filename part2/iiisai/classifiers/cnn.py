@@ -92,6 +92,14 @@ class ThreeLayerConvNet(object):
         # pass pool_param to the forward pass for the max-pooling layer
         pool_param = {'pool_height': 2, 'pool_width': 2, 'stride': 2}
 
+        # In test mode only the scores are needed, so skip the caches and the
+        # im2col matrix of the convolution
+        if y is None:
+            out = conv_relu_pool_forward_inference(X, W1, b1, conv_param,
+                                                   pool_param)
+            out = affine_relu_forward_inference(out, W2, b2)
+            return affine_forward_inference(out, W3, b3)
+
         scores = None
         ############################################################################
         # TODO: Implement the forward pass for the three-layer convolutional net,  #
@@ -110,9 +118,6 @@ class ThreeLayerConvNet(object):
         #                             END OF YOUR CODE                             #
         ############################################################################
 
-        if y is None:
-            return scores
-
         loss, grads = 0, {}
         ############################################################################
         # TODO: Implement the backward pass for the three-layer convolutional net, #
@@ -120,7 +125,7 @@ class ThreeLayerConvNet(object):
         # data loss using softmax, and make sure that grads[k] holds the gradients #
         # for self.params[k]. Don't forget to add L2 regularization!               #
         ############################################################################
-        loss, dout = softmax_loss(scores, y)
+        loss, dout = softmax_loss(scores, y, overwrite_x=True)
         
         # add up all the squared weights and add regularization term
         loss += 0.5 * self.reg * (np.sum(W1 * W1) + np.sum(W2 * W2) + np.sum(W1 * W1))
@@ -5,20 +5,6 @@ import numpy as np
 from iiisai.layers import *
 from iiisai.layer_utils import *
 
-def softmax(X):
-    """
-    input:
-        X: Array of input, shape (N, D)
-
-    Return the softmax scores for the input. Output has same shape as X
-    """
-
-    exponentiated = np.exp(X)
-    normalizer = np.sum(exponentiated, axis=1)
-
-    result = exponentiated / normalizer[:, None]
-    return result
-
 class TwoLayerNet(object):
     """
     A two-layer fully-connected neural network with ReLU nonlinearity and
@@ -93,6 +79,13 @@ class TwoLayerNet(object):
         - grads: Dictionary with the same keys as self.params, mapping parameter
           names to gradients of the loss with respect to those parameters.
         """
+        # In test mode only the scores are needed, so skip the caches
+        if y is None:
+            out = affine_relu_forward_inference(X, self.params['W1'],
+                                                self.params['b1'])
+            return affine_forward_inference(out, self.params['W2'],
+                                            self.params['b2'])
+
         scores = None
         ############################################################################
         # TODO: Implement the forward pass for the two-layer net, computing the    #
@@ -107,10 +100,6 @@ class TwoLayerNet(object):
         #                             END OF YOUR CODE                             #
         ############################################################################
 
-        # If y is None then we are in test mode so just return scores
-        if y is None:
-            return scores
-
         loss, grads = 0, {}
         ############################################################################
         # TODO: Implement the backward pass for the two-layer net. Store the loss  #
@@ -122,7 +111,7 @@ class TwoLayerNet(object):
         # automated tests, make sure that your L2 regularization includes a factor #
         # of 0.5 to simplify the expression for the gradient.                      #
         ############################################################################
-        loss, dout = softmax_loss(scores, y)
+        loss, dout = softmax_loss(scores, y, overwrite_x=True)
         
         # add up all the squared weights and add regularization term
         loss += (0.5 * self.reg * (np.sum(self.params['W1'] * self.params['W1']) +
@@ -167,7 +156,7 @@ class FullyConnectedNet(object):
 
     def __init__(self, hidden_dims, input_dim=3*32*32, num_classes=10,
                  dropout=0, use_batchnorm=False, reg=0.0,
-                 weight_scale=1e-2, dtype=np.float32, seed=None):
+                 weight_scale=1e-2, dtype=np.float32, seed=None, arena=False):
         """
         Initialize a new FullyConnectedNet.
 
@@ -187,6 +176,11 @@ class FullyConnectedNet(object):
         - seed: If not None, then pass this random seed to the dropout layers. This
           will make the dropout layers deteriminstic so we can gradient check the
           model.
+        - arena: If True, a network without batch normalization or dropout
+          allocates its activations, backward buffers and gradients once per
+          batch size and reuses them on every call to loss, so that a training
+          step allocates next to nothing. The gradients returned by loss are
+          then overwritten by the next call.
         """
         self.use_batchnorm = use_batchnorm
         self.use_dropout = dropout > 0
@@ -194,6 +188,8 @@ class FullyConnectedNet(object):
         self.num_layers = 1 + len(hidden_dims)
         self.dtype = dtype
         self.params = {}
+        self.arena = arena
+        self._arenas = {}
 
         ############################################################################
         # TODO: Initialize the parameters of the network, storing all values in    #
@@ -211,6 +207,9 @@ class FullyConnectedNet(object):
         for i in range(1, self.num_layers + 1):
             self.params['W{}'.format(i)] = weight_scale * np.random.randn(dims[i - 1], dims[i])
             self.params['b{}'.format(i)] = np.zeros(dims[i])
+            if self.use_batchnorm and i < self.num_layers:
+                self.params['gamma{}'.format(i)] = np.ones(dims[i])
+                self.params['beta{}'.format(i)] = np.zeros(dims[i])
 
         ############################################################################
         #                             END OF YOUR CODE                             #
@@ -245,6 +244,11 @@ class FullyConnectedNet(object):
 
         Input / output: Same as TwoLayerNet above.
         """
+        if y is None:
+            return self._scores_inference(X)
+        if self.arena and not self.use_batchnorm and not self.use_dropout:
+            return self._loss_arena(X, y)
+
         X = X.astype(self.dtype)
         mode = 'test' if y is None else 'train'
 
@@ -271,13 +275,22 @@ class FullyConnectedNet(object):
         ############################################################################
         # save cache for later use
         caches = []
+        dropout_caches = []
 
         # initialize out to input
         out = X
         # forward pass hidden layers
         for i in range(self.num_layers - 1):
-            out, cache = affine_relu_forward(out, self.params['W{}'.format(i + 1)], self.params['b{}'.format(i + 1)])
+            if self.use_batchnorm:
+                out, cache = affine_bn_relu_forward(out, self.params['W{}'.format(i + 1)], self.params['b{}'.format(i + 1)],
+                                                    self.params['gamma{}'.format(i + 1)], self.params['beta{}'.format(i + 1)],
+                                                    self.bn_params[i])
+            else:
+                out, cache = affine_relu_forward(out, self.params['W{}'.format(i + 1)], self.params['b{}'.format(i + 1)])
             caches.append(cache)
+            if self.use_dropout:
+                out, cache = dropout_forward(out, self.dropout_param)
+                dropout_caches.append(cache)
 
         # activation layer
         scores, cache = affine_forward(out, self.params['W{}'.format(self.num_layers)], self.params['b{}'.format(self.num_layers)])
@@ -304,7 +317,7 @@ class FullyConnectedNet(object):
         # automated tests, make sure that your L2 regularization includes a factor #
         # of 0.5 to simplify the expression for the gradient.                      #
         ############################################################################
-        loss, dout = softmax_loss(scores, y)
+        loss, dout = softmax_loss(scores, y, overwrite_x=True)
         
         # calculate regularization
         L2 = np.sum([np.sum(self.params['W{}'.format(i + 1)] * self.params['W{}'.format(i + 1)]) for i in range(self.num_layers)])
@@ -316,7 +329,14 @@ class FullyConnectedNet(object):
         grads['b{}'.format(self.num_layers)] = db + self.params['b{}'.format(self.num_layers)] * self.reg
 
         for i in range(self.num_layers - 2, -1, -1):
-            dx, dw, db = affine_relu_backward(dx, caches[i])        
+            if self.use_dropout:
+                dx = dropout_backward(dx, dropout_caches[i])
+            if self.use_batchnorm:
+                dx, dw, db, dgamma, dbeta = affine_bn_relu_backward(dx, caches[i])
+                grads['gamma{}'.format(i + 1)] = dgamma
+                grads['beta{}'.format(i + 1)] = dbeta
+            else:
+                dx, dw, db = affine_relu_backward(dx, caches[i])
 
             # add regularization derivative as wel
             grads['W{}'.format(i + 1)] = dw + self.params['W{}'.format(i + 1)] * self.reg
@@ -327,3 +347,120 @@ class FullyConnectedNet(object):
         ############################################################################
 
         return loss, grads
+
+
+    def _get_arena(self, N):
+        """
+        Return the buffers used by _loss_arena for minibatches of N examples,
+        allocating them the first time.
+        """
+        if N in self._arenas:
+            return self._arenas[N]
+        L = self.num_layers
+        W = [self.params['W{}'.format(i + 1)] for i in range(L)]
+        arena = {
+            'X': np.empty((N, W[0].shape[0]), dtype=self.dtype),
+            # outputs of the hidden layers, their ReLU masks and gradients
+            'h': [np.empty((N, w.shape[1]), dtype=self.dtype) for w in W[:-1]],
+            'mask': [np.empty((N, w.shape[1]), dtype=bool) for w in W[:-1]],
+            'dh': [np.empty((N, w.shape[1]), dtype=self.dtype) for w in W[:-1]],
+            'scores': np.empty((N, W[-1].shape[1]), dtype=self.dtype),
+            'scratch': np.empty(max(w.size for w in W), dtype=self.dtype),
+            'grads': {},
+        }
+        for k, v in self.params.items():
+            arena['grads'][k] = np.empty_like(v)
+        self._arenas[N] = arena
+        return arena
+
+
+    def _loss_arena(self, X, y):
+        """
+        Same as loss at training time, for the arena mode of networks without batch
+        normalization or dropout: every intermediate is written with out=
+        into the buffers of _get_arena, the ReLUs are applied in place, and
+        the gradient with respect to the input X, which is not needed, is
+        not computed.
+        """
+        N = X.shape[0]
+        arena = self._get_arena(N)
+        L = self.num_layers
+        params = self.params
+
+        if X.dtype == self.dtype and X.flags.c_contiguous:
+            out = X.reshape(N, -1)
+        else:
+            out = arena['X']
+            np.copyto(out, X.reshape(N, -1))
+        inputs = [out]
+        for i in range(L - 1):
+            h = arena['h'][i]
+            np.dot(out, params['W{}'.format(i + 1)], out=h)
+            h += params['b{}'.format(i + 1)]
+            np.maximum(h, 0, out=h)
+            np.greater(h, 0, out=arena['mask'][i])
+            inputs.append(h)
+            out = h
+        scores = arena['scores']
+        np.dot(out, params['W{}'.format(L)], out=scores)
+        scores += params['b{}'.format(L)]
+
+        loss, dout = softmax_loss(scores, y, overwrite_x=True)
+        for i in range(L):
+            w = params['W{}'.format(i + 1)]
+            loss += 0.5 * self.reg * np.vdot(w, w)
+
+        grads = arena['grads']
+        scratch = arena['scratch']
+        for i in range(L - 1, -1, -1):
+            w = params['W{}'.format(i + 1)]
+            b = params['b{}'.format(i + 1)]
+            dw = grads['W{}'.format(i + 1)]
+            db = grads['b{}'.format(i + 1)]
+            np.dot(inputs[i].T, dout, out=dw)
+            np.sum(dout, axis=0, out=db)
+            # as in loss, both the weights and the biases are regularized
+            reg_w = scratch[:w.size].reshape(w.shape)
+            np.multiply(w, self.reg, out=reg_w)
+            dw += reg_w
+            reg_b = scratch[:b.size]
+            np.multiply(b, self.reg, out=reg_b)
+            db += reg_b
+            if i > 0:
+                dh = arena['dh'][i - 1]
+                np.dot(dout, w.T, out=dh)
+                np.multiply(dh, arena['mask'][i - 1], out=dh)
+                dout = dh
+
+        return loss, grads
+
+
+    def _scores_inference(self, X):
+        """
+        Compute the test-time scores, in which dropout does nothing and batch
+        normalization uses its running mean and variance: the layers run in
+        place and build no caches.
+        """
+        out = np.asarray(X, dtype=self.dtype)
+        for i in range(self.num_layers - 1):
+            if self.use_batchnorm:
+                out = affine_bn_relu_forward_inference(
+                    out, self.params['W{}'.format(i + 1)],
+                    self.params['b{}'.format(i + 1)],
+                    self.params['gamma{}'.format(i + 1)],
+                    self.params['beta{}'.format(i + 1)], self.bn_params[i])
+            else:
+                out = affine_relu_forward_inference(
+                    out, self.params['W{}'.format(i + 1)],
+                    self.params['b{}'.format(i + 1)])
+        return affine_forward_inference(
+            out, self.params['W{}'.format(self.num_layers)],
+            self.params['b{}'.format(self.num_layers)])
+
+
+    def __getstate__(self):
+        # The arena buffers are rebuilt on demand, so leave them out of
+        # pickled checkpoints.
+        state = dict(self.__dict__)
+        state['_arenas'] = {}
+        return state
@@ -2,6 +2,15 @@ from __future__ import print_function
 
 from builtins import range
 from six.moves import cPickle as pickle
+from collections import OrderedDict
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+import ctypes
+import json
+from multiprocessing import Pool
+from multiprocessing.sharedctypes import RawArray
 import numpy as np
 import os
 from scipy.misc import imread
@@ -15,65 +24,145 @@ def load_pickle(f):
         return  pickle.load(f, encoding='latin1')
     raise ValueError("invalid python version: {}".format(version))
 
-def load_CIFAR_batch(filename):
-    """ load single batch of cifar """
+def load_CIFAR_batch(filename, dtype="float"):
+    """ load single batch of cifar; dtype None keeps the uint8 pixels """
     with open(filename, 'rb') as f:
         datadict = load_pickle(f)
         X = datadict['data']
         Y = datadict['labels']
-        X = X.reshape(10000, 3, 32, 32).transpose(0,2,3,1).astype("float")
+        X = X.reshape(10000, 3, 32, 32).transpose(0,2,3,1)
+        if dtype is not None:
+            X = X.astype(dtype)
         Y = np.array(Y)
         return X, Y
 
-def load_CIFAR10(ROOT):
-    """ load all of cifar """
+def load_CIFAR10_pickles(ROOT, dtype="float"):
+    """ load all of cifar from the pickled batches """
     xs = []
     ys = []
     for b in range(1,6):
         f = os.path.join(ROOT, 'data_batch_%d' % (b, ))
-        X, Y = load_CIFAR_batch(f)
+        X, Y = load_CIFAR_batch(f, dtype)
         xs.append(X)
         ys.append(Y)
     Xtr = np.concatenate(xs)
     Ytr = np.concatenate(ys)
     del X, Y
-    Xte, Yte = load_CIFAR_batch(os.path.join(ROOT, 'test_batch'))
+    Xte, Yte = load_CIFAR_batch(os.path.join(ROOT, 'test_batch'), dtype)
     return Xtr, Ytr, Xte, Yte
 
 
+# Files of the uint8 CIFAR-10 cache written by cache_CIFAR10, in the order
+# returned by load_CIFAR10.
+CIFAR10_CACHE_FILES = ('cifar10_X_train.npy', 'cifar10_y_train.npy',
+                       'cifar10_X_test.npy', 'cifar10_y_test.npy')
+
+def cache_CIFAR10(ROOT, cache_dir=None):
+    """
+    Convert the pickled CIFAR-10 batches in ROOT once into .npy files that
+    load_CIFAR10 memory-maps: uint8 images of shape (N, 32, 32, 3) and int64
+    labels. Does nothing if the cache already exists.
+
+    Inputs:
+    - ROOT: Directory of the pickled batches.
+    - cache_dir: Directory of the cache; defaults to ROOT.
+
+    Returns the cache directory.
+    """
+    if cache_dir is None:
+        cache_dir = ROOT
+    paths = [os.path.join(cache_dir, name) for name in CIFAR10_CACHE_FILES]
+    if all(os.path.isfile(path) for path in paths):
+        return cache_dir
+    arrays = load_CIFAR10_pickles(ROOT, dtype=None)
+    for array, path in zip(arrays, paths):
+        # Rename a complete file into place so that an interrupted
+        # conversion never leaves a truncated cache behind.
+        tmp_path = path[:-len('.npy')] + '.tmp.npy'
+        np.save(tmp_path, array)
+        os.rename(tmp_path, path)
+    return cache_dir
+
+def load_CIFAR10(ROOT, dtype="float", cache_dir=None):
+    """
+    load all of cifar
+
+    The first call converts the pickled batches into a uint8 cache (see
+    cache_CIFAR10) and later calls memory-map it. With dtype None the images
+    are returned as read-only uint8 memory maps, whose pages are shared by
+    every process reading them and which can be converted to floats lazily,
+    e.g. one batch at a time; otherwise they are converted to dtype. If the
+    cache cannot be written the pickles are read directly.
+    """
+    try:
+        cache_dir = cache_CIFAR10(ROOT, cache_dir)
+    except (IOError, OSError):
+        return load_CIFAR10_pickles(ROOT, dtype)
+    Xtr, Ytr, Xte, Yte = [
+        np.load(os.path.join(cache_dir, name), mmap_mode='r')
+        for name in CIFAR10_CACHE_FILES]
+    if dtype is not None:
+        # astype on a memmap returns a memmap subclass; hand back plain arrays.
+        Xtr = np.asarray(Xtr.astype(dtype))
+        Xte = np.asarray(Xte.astype(dtype))
+    return Xtr, np.array(Ytr), Xte, np.array(Yte)
+
+
 def get_CIFAR10_data(num_training=49000, num_validation=1000, num_test=1000,
-                     subtract_mean=True):
+                     subtract_mean=True, dtype=np.float32, out=None):
     """
     Load the CIFAR-10 dataset from disk and perform preprocessing to prepare
     it for classifiers. These are the same steps as we used for the SVM, but
     condensed to a single function.
+
+    The splits are slices of the memory-mapped uint8 images (see
+    load_CIFAR10), and each one is converted to dtype, mean-subtracted and
+    transposed to channels-first in a single pass that writes straight into
+    one buffer of shape (num_training + num_validation + num_test, 3, 32, 32).
+    X_train, X_val and X_test are consecutive views of that buffer.
+
+    Inputs:
+    - num_training, num_validation, num_test: Number of images in each split.
+    - subtract_mean: Whether to subtract the mean training image.
+    - dtype: Data type of the images; float32 by default, as used by the nets.
+    - out: Optional preallocated buffer of the shape above, for example in
+      shared memory, to write the images into; its dtype overrides dtype.
     """
     # Load the raw CIFAR-10 data
     cifar10_dir = 'iiisai/datasets/cifar-10-batches-py'
-    X_train, y_train, X_test, y_test = load_CIFAR10(cifar10_dir)
-
-    # Subsample the data
-    mask = list(range(num_training, num_training + num_validation))
-    X_val = X_train[mask]
-    y_val = y_train[mask]
-    mask = list(range(num_training))
-    X_train = X_train[mask]
-    y_train = y_train[mask]
-    mask = list(range(num_test))
-    X_test = X_test[mask]
-    y_test = y_test[mask]
-
-    # Normalize the data: subtract the mean image
+    X_train, y_train, X_test, y_test = load_CIFAR10(cifar10_dir, dtype=None)
+
+    # Subsample the data; slices of the memory maps copy nothing.
+    X_val = X_train[num_training:num_training + num_validation]
+    y_val = y_train[num_training:num_training + num_validation]
+    X_train = X_train[:num_training]
+    y_train = y_train[:num_training]
+    X_test = X_test[:num_test]
+    y_test = y_test[:num_test]
+
+    splits = [X_train, X_val, X_test]
+    if out is None:
+        num_images = sum(X.shape[0] for X in splits)
+        out = np.empty((num_images, 3, 32, 32), dtype=dtype)
+
+    # Normalize the data: subtract the mean image, accumulated in float64
+    mean_image = None
     if subtract_mean:
-        mean_image = np.mean(X_train, axis=0)
-        X_train -= mean_image
-        X_val -= mean_image
-        X_test -= mean_image
-
-    # Transpose so that channels come first
-    X_train = X_train.transpose(0, 3, 1, 2).copy()
-    X_val = X_val.transpose(0, 3, 1, 2).copy()
-    X_test = X_test.transpose(0, 3, 1, 2).copy()
+        mean_image = np.mean(X_train, axis=0, dtype=np.float64)
+        mean_image = mean_image.transpose(2, 0, 1).astype(out.dtype)
+
+    # Transpose so that channels come first, converting and subtracting the
+    # mean in the same pass
+    start = 0
+    for i, X in enumerate(splits):
+        view = out[start:start + X.shape[0]]
+        if mean_image is None:
+            view[...] = X.transpose(0, 3, 1, 2)
+        else:
+            np.subtract(X.transpose(0, 3, 1, 2), mean_image, out=view)
+        splits[i] = view
+        start += X.shape[0]
+    X_train, X_val, X_test = splits
 
     # Package data into a dictionary
     return {
@@ -83,16 +172,25 @@ def get_CIFAR10_data(num_training=49000, num_validation=1000, num_test=1000,
     }
 
 
-def load_tiny_imagenet(path, dtype=np.float32, subtract_mean=True):
+def load_tiny_imagenet(path, dtype=np.float32, subtract_mean=True, n_jobs=1,
+                       cache=True):
     """
     Load TinyImageNet. Each of TinyImageNet-100-A, TinyImageNet-100-B, and
     TinyImageNet-200 have the same directory structure, so this can be used
     to load any of them.
 
+    The JPEGs are decoded by a pool of n_jobs processes straight into one
+    preallocated uint8 array in shared memory. Unless cache is False, that
+    array and the labels are then packed into path (see
+    TINY_IMAGENET_CACHE_FILES), and later loads memory-map it instead of
+    decoding again; delete those files if the dataset changes.
+
     Inputs:
     - path: String giving path to the directory to load.
     - dtype: numpy datatype used to load the data.
     - subtract_mean: Whether to subtract the mean training image.
+    - n_jobs: Number of processes decoding the images.
+    - cache: Whether to read and write the packed cache.
 
     Returns: A dictionary with the following entries:
     - class_names: A list where class_names[i] is a list of strings giving the
@@ -120,66 +218,96 @@ def load_tiny_imagenet(path, dtype=np.float32, subtract_mean=True):
             wnid_to_words[wnid] = [w.strip() for w in words.split(',')]
     class_names = [wnid_to_words[wnid] for wnid in wnids]
 
-    # Next load training data.
-    X_train = []
+    X_file, labels_file = [os.path.join(path, name)
+                           for name in TINY_IMAGENET_CACHE_FILES]
+    if cache and os.path.isfile(X_file) and os.path.isfile(labels_file):
+        X = np.load(X_file, mmap_mode='r')
+        labels = np.load(labels_file)
+        y_train = labels['y_train']
+        y_val = labels['y_val']
+        y_test = labels['y_test'] if 'y_test' in labels else None
+    else:
+        img_files, y_train, y_val, y_test = _tiny_imagenet_files(
+            path, wnids, wnid_to_label)
+        print('decoding %d images with %d processes' % (len(img_files),
+                                                        n_jobs))
+        X = _decode_images(img_files, n_jobs)
+        if cache:
+            labels = {'y_train': y_train, 'y_val': y_val}
+            if y_test is not None:
+                labels['y_test'] = y_test
+            try:
+                # Rename complete files into place so that an interrupted
+                # load never leaves a truncated cache behind.
+                np.save(X_file[:-len('.npy')] + '.tmp.npy', X)
+                np.savez(labels_file[:-len('.npz')] + '.tmp.npz', **labels)
+                os.rename(X_file[:-len('.npy')] + '.tmp.npy', X_file)
+                os.rename(labels_file[:-len('.npz')] + '.tmp.npz',
+                          labels_file)
+            except (IOError, OSError):
+                print('could not write the cache in %s' % path)
+
+    num_train, num_val = len(y_train), len(y_val)
+    X_train = X[:num_train].astype(dtype)
+    X_val = X[num_train:num_train + num_val].astype(dtype)
+    X_test = X[num_train + num_val:].astype(dtype)
+
+    mean_image = X_train.mean(axis=0)
+    if subtract_mean:
+        X_train -= mean_image[None]
+        X_val -= mean_image[None]
+        X_test -= mean_image[None]
+
+    return {
+      'class_names': class_names,
+      'X_train': X_train,
+      'y_train': y_train,
+      'X_val': X_val,
+      'y_val': y_val,
+      'X_test': X_test,
+      'y_test': y_test,
+      'class_names': class_names,
+      'mean_image': mean_image,
+    }
+
+
+# Packed cache of load_tiny_imagenet: all decoded images as one uint8 array
+# (training, then validation, then test images) and the labels.
+TINY_IMAGENET_CACHE_FILES = ('tiny_imagenet_X.npy', 'tiny_imagenet_y.npz')
+
+
+def _tiny_imagenet_files(path, wnids, wnid_to_label):
+    """
+    List the image files of TinyImageNet in the order they are packed, and
+    return them with the training, validation and test labels.
+    """
+    # Training images, grouped by synset
+    img_files = []
     y_train = []
-    for i, wnid in enumerate(wnids):
-        if (i + 1) % 20 == 0:
-            print('loading training data for synset %d / %d'
-                  % (i + 1, len(wnids)))
+    for wnid in wnids:
         # To figure out the filenames we need to open the boxes file
         boxes_file = os.path.join(path, 'train', wnid, '%s_boxes.txt' % wnid)
         with open(boxes_file, 'r') as f:
             filenames = [x.split('\t')[0] for x in f]
-        num_images = len(filenames)
-
-        X_train_block = np.zeros((num_images, 3, 64, 64), dtype=dtype)
-        y_train_block = wnid_to_label[wnid] * \
-                        np.ones(num_images, dtype=np.int64)
-        for j, img_file in enumerate(filenames):
-            img_file = os.path.join(path, 'train', wnid, 'images', img_file)
-            img = imread(img_file)
-            if img.ndim == 2:
-        ## grayscale file
-                img.shape = (64, 64, 1)
-            X_train_block[j] = img.transpose(2, 0, 1)
-        X_train.append(X_train_block)
-        y_train.append(y_train_block)
-
-    # We need to concatenate all training data
-    X_train = np.concatenate(X_train, axis=0)
-    y_train = np.concatenate(y_train, axis=0)
-
-    # Next load validation data
+        img_files.extend(os.path.join(path, 'train', wnid, 'images', name)
+                         for name in filenames)
+        y_train.extend([wnid_to_label[wnid]] * len(filenames))
+    y_train = np.array(y_train, dtype=np.int64)
+
+    # Validation images
     with open(os.path.join(path, 'val', 'val_annotations.txt'), 'r') as f:
-        img_files = []
         val_wnids = []
         for line in f:
             img_file, wnid = line.split('\t')[:2]
-            img_files.append(img_file)
+            img_files.append(os.path.join(path, 'val', 'images', img_file))
             val_wnids.append(wnid)
-        num_val = len(img_files)
-        y_val = np.array([wnid_to_label[wnid] for wnid in val_wnids])
-        X_val = np.zeros((num_val, 3, 64, 64), dtype=dtype)
-        for i, img_file in enumerate(img_files):
-            img_file = os.path.join(path, 'val', 'images', img_file)
-            img = imread(img_file)
-            if img.ndim == 2:
-                img.shape = (64, 64, 1)
-            X_val[i] = img.transpose(2, 0, 1)
-
-    # Next load test images
+    y_val = np.array([wnid_to_label[wnid] for wnid in val_wnids])
+
     # Students won't have test labels, so we need to iterate over files in the
     # images directory.
-    img_files = os.listdir(os.path.join(path, 'test', 'images'))
-    X_test = np.zeros((len(img_files), 3, 64, 64), dtype=dtype)
-    for i, img_file in enumerate(img_files):
-        img_file = os.path.join(path, 'test', 'images', img_file)
-        img = imread(img_file)
-        if img.ndim == 2:
-            img.shape = (64, 64, 1)
-        X_test[i] = img.transpose(2, 0, 1)
-
+    test_files = os.listdir(os.path.join(path, 'test', 'images'))
+    img_files.extend(os.path.join(path, 'test', 'images', img_file)
+                     for img_file in test_files)
     y_test = None
     y_test_file = os.path.join(path, 'test', 'test_annotations.txt')
     if os.path.isfile(y_test_file):
@@ -189,49 +317,248 @@ def load_tiny_imagenet(path, dtype=np.float32, subtract_mean=True):
                 line = line.split('\t')
                 img_file_to_wnid[line[0]] = line[1]
         y_test = [wnid_to_label[img_file_to_wnid[img_file]]
-                  for img_file in img_files]
+                  for img_file in test_files]
         y_test = np.array(y_test)
+    return img_files, y_train, y_val, y_test
 
-    mean_image = X_train.mean(axis=0)
-    if subtract_mean:
-        X_train -= mean_image[None]
-        X_val -= mean_image[None]
-        X_test -= mean_image[None]
 
-    return {
-      'class_names': class_names,
-      'X_train': X_train,
-      'y_train': y_train,
-      'X_val': X_val,
-      'y_val': y_val,
-      'X_test': X_test,
-      'y_test': y_test,
-      'class_names': class_names,
-      'mean_image': mean_image,
-    }
+# Output array of the image decoding worker processes.
+_decoded_images = None
+
+
+def _decode_images(img_files, n_jobs, chunk_size=256):
+    """
+    Decode 64 x 64 images into an (N, 3, 64, 64) uint8 array, with n_jobs
+    processes writing into a shared array if n_jobs > 1.
+    """
+    shape = (len(img_files), 3, 64, 64)
+    if n_jobs == 1:
+        X = np.empty(shape, dtype=np.uint8)
+        _decode_into(X, 0, img_files)
+        return X
+
+    buf = RawArray(ctypes.c_char, max(int(np.prod(shape)), 1))
+    pool = Pool(n_jobs, initializer=_init_decode_worker, initargs=(buf, shape))
+    try:
+        pool.map(_decode_worker,
+                 [(start, img_files[start:start + chunk_size])
+                  for start in range(0, len(img_files), chunk_size)])
+    finally:
+        pool.close()
+        pool.join()
+    return np.frombuffer(buf, dtype=np.uint8,
+                         count=int(np.prod(shape))).reshape(shape)
+
+
+def _decode_into(X, start, img_files):
+    """
+    Decode img_files into X[start], X[start + 1], ...
+    """
+    for i, img_file in enumerate(img_files):
+        img = imread(img_file)
+        if img.ndim == 2:
+            ## grayscale file
+            img.shape = (64, 64, 1)
+        X[start + i] = img.transpose(2, 0, 1)
+
+
+def _init_decode_worker(buf, shape):
+    """
+    Pool initializer: map the shared output array.
+    """
+    global _decoded_images
+    _decoded_images = np.frombuffer(buf, dtype=np.uint8,
+                                    count=int(np.prod(shape))).reshape(shape)
 
 
-def load_models(models_dir):
+def _decode_worker(args):
     """
-    Load saved models from disk. This will attempt to unpickle all files in a
-    directory; any files that give errors on unpickling (such as README.txt)
-    will be skipped.
+    Pool task: decode one chunk of images into the shared output array.
+    """
+    start, img_files = args
+    _decode_into(_decoded_images, start, img_files)
+
+
+def load_models(models_dir, max_bytes=None):
+    """
+    Load saved models from disk, lazily. The directory is indexed up front
+    from the manifest written by save_model together with the files whose
+    first and last bytes look like a complete pickled dictionary (skipping
+    files such as README.txt). A model is only unpickled the first time it
+    is accessed.
 
     Inputs:
     - models_dir: String giving the path to a directory containing model files.
       Each model file is a pickled dictionary with a 'model' field.
+    - max_bytes: Optional cap on the memory of the models kept loaded; see
+      LazyModels.
 
     Returns:
-    A dictionary mapping model file names to models.
+    A LazyModels mapping from model file names to models.
     """
-    models = {}
-    for model_file in os.listdir(models_dir):
-        with open(os.path.join(models_dir, model_file), 'rb') as f:
-            try:
-                models[model_file] = load_pickle(f)['model']
-            except pickle.UnpicklingError:
-                continue
-    return models
+    return LazyModels(models_dir, max_bytes)
+
+
+# Name of the manifest that save_model keeps in a models directory.
+MODELS_MANIFEST = 'manifest.json'
+
+
+class LazyModels(Mapping):
+    """
+    A read-only mapping from the model files of a directory to the models
+    they contain, which unpickles each model on first access.
+
+    Loaded models are cached. If max_bytes is given, the least recently used
+    models are dropped from the cache once their parameters take more than
+    max_bytes; parameters memory-mapped from a .params.npy file (see
+    save_model) do not count, since their pages are not held in memory.
+    """
+
+    def __init__(self, models_dir, max_bytes=None):
+        self.models_dir = models_dir
+        self.max_bytes = max_bytes
+        self.cached_bytes = 0
+        self._cache = OrderedDict()
+        # The manifest only lists models written by save_model, so the
+        # directory is scanned as well for models pickled by other means.
+        files = set(name for name in os.listdir(models_dir)
+                    if _looks_like_pickle(os.path.join(models_dir, name)))
+        manifest = os.path.join(models_dir, MODELS_MANIFEST)
+        if os.path.isfile(manifest):
+            with open(manifest, 'r') as f:
+                files.update(name for name in json.load(f) if
+                             os.path.isfile(os.path.join(models_dir, name)))
+        self._files = sorted(files)
+        self._file_set = files
+
+    def __getitem__(self, model_file):
+        if model_file in self._cache:
+            # Reinsert to mark the model as most recently used.
+            model, nbytes = self._cache.pop(model_file)
+            self._cache[model_file] = (model, nbytes)
+            return model
+        if model_file not in self._file_set:
+            raise KeyError(model_file)
+
+        model = _load_model(os.path.join(self.models_dir, model_file))
+        params = getattr(model, 'params', {})
+        nbytes = sum(p.nbytes for p in params.values()
+                     if isinstance(p, np.ndarray) and
+                     not isinstance(p, np.memmap))
+        self._cache[model_file] = (model, nbytes)
+        self.cached_bytes += nbytes
+        while (self.max_bytes is not None and len(self._cache) > 1 and
+               self.cached_bytes > self.max_bytes):
+            _, (_, evicted_bytes) = self._cache.popitem(last=False)
+            self.cached_bytes -= evicted_bytes
+        return model
+
+    def __contains__(self, model_file):
+        # Mapping.__contains__ would load the model to answer.
+        return model_file in self._file_set
+
+    def __iter__(self):
+        return iter(self._files)
+
+    def __len__(self):
+        return len(self._files)
+
+
+def save_model(model, models_dir, model_file):
+    """
+    Save a model so that load_models can load it lazily. The arrays in
+    model.params are packed into model_file + '.params.npy' and
+    memory-mapped (copy-on-write) when the model is loaded; the rest of the
+    model is pickled into model_file as a dictionary with a 'model' field.
+    The model is also added to the manifest of models_dir.
+
+    Inputs:
+    - model: A model with a params dictionary of numpy arrays.
+    - models_dir: String giving the path of the models directory.
+    - model_file: Name of the model file within models_dir.
+    """
+    params = model.params
+    layout = {}
+    offset = 0
+    for name, p in params.items():
+        # Align every array so that it can be viewed in its own dtype.
+        offset = -(-offset // 16) * 16
+        layout[name] = (p.dtype.str, p.shape, offset)
+        offset += p.nbytes
+    packed = np.zeros(offset, dtype=np.uint8)
+    for name, p in params.items():
+        _, _, start = layout[name]
+        packed[start:start + p.nbytes] = np.ascontiguousarray(p).view(
+            np.uint8).ravel()
+    params_file = model_file + '.params.npy'
+    np.save(os.path.join(models_dir, params_file), packed)
+
+    model.params = {}
+    try:
+        checkpoint = {'model': model, 'params_file': params_file,
+                      'params_layout': layout}
+        with open(os.path.join(models_dir, model_file), 'wb') as f:
+            pickle.dump(checkpoint, f, protocol=2)
+    finally:
+        model.params = params
+
+    manifest = os.path.join(models_dir, MODELS_MANIFEST)
+    model_files = []
+    if os.path.isfile(manifest):
+        with open(manifest, 'r') as f:
+            model_files = json.load(f)
+    if model_file not in model_files:
+        model_files.append(model_file)
+    with open(manifest, 'w') as f:
+        json.dump(sorted(model_files), f)
+
+
+def _load_model(filename):
+    """
+    Unpickle the model of a model file, memory-mapping its parameters if
+    they were saved by save_model.
+    """
+    with open(filename, 'rb') as f:
+        checkpoint = load_pickle(f)
+    model = checkpoint['model']
+    if 'params_file' in checkpoint:
+        packed = np.load(os.path.join(os.path.dirname(filename),
+                                      checkpoint['params_file']),
+                         mmap_mode='c')
+        model.params = {}
+        for name, (dtype, shape, offset) in checkpoint['params_layout'].items():
+            dtype = np.dtype(dtype)
+            nbytes = int(np.prod(shape)) * dtype.itemsize
+            model.params[name] = packed[offset:offset + nbytes].view(
+                dtype).reshape(shape)
+    return model
+
+
+def _looks_like_pickle(filename):
+    """
+    Check whether a file starts with the opcodes of a pickled dictionary and
+    ends with the STOP opcode, without unpickling it. A dictionary starts
+    with EMPTY_DICT in protocol 1 and up, after PROTO for protocols 2 and up
+    and a FRAME header for protocols 4 and up, and with MARK followed by
+    DICT in protocol 0.
+    """
+    if not os.path.isfile(filename) or filename.endswith('.params.npy'):
+        return False
+    with open(filename, 'rb') as f:
+        head = f.read(12)
+        if os.path.getsize(filename) < 2:
+            return False
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) != b'.':
+            return False
+    if head[:1] == b'\x80':
+        protocol = ord(head[1:2] or b'\x00')
+        if not 2 <= protocol <= pickle.HIGHEST_PROTOCOL:
+            return False
+        # Protocols 4 and up frame the data behind a 9 byte header.
+        head = head[11:] if head[2:3] == b'\x95' else head[2:]
+        return head[:1] == b'}'
+    return head[:1] == b'}' or head[:2] == b'(d'
 
 
 def load_imagenet_val(num=None):
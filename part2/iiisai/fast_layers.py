@@ -40,10 +40,13 @@ def conv_forward_im2col(x, w, b, conv_param):
     return out, cache
 
 
-def conv_forward_strides(x, w, b, conv_param):
+def _im2col_strides(x, HH, WW, stride, pad):
+    """
+    Pad x and lay out its receptive fields as the columns of a matrix of
+    shape (C * HH * WW, N * out_h * out_w), by picking clever strides.
+    Returns (x_cols, out_h, out_w).
+    """
     N, C, H, W = x.shape
-    F, _, HH, WW = w.shape
-    stride, pad = conv_param['stride'], conv_param['pad']
 
     # Check dimensions
     #assert (W + 2 * pad - WW) % stride == 0, 'width does not work'
@@ -67,6 +70,14 @@ def conv_forward_strides(x, w, b, conv_param):
                   shape=shape, strides=strides)
     x_cols = np.ascontiguousarray(x_stride)
     x_cols.shape = (C * HH * WW, N * out_h * out_w)
+    return x_cols, out_h, out_w
+
+
+def conv_forward_strides(x, w, b, conv_param):
+    N = x.shape[0]
+    F, _, HH, WW = w.shape
+    stride, pad = conv_param['stride'], conv_param['pad']
+    x_cols, out_h, out_w = _im2col_strides(x, HH, WW, stride, pad)
 
     # Now all our convolutions are a big matrix multiply
     res = w.reshape(F, -1).dot(x_cols) + b.reshape(-1, 1)
@@ -130,6 +141,39 @@ conv_forward_fast = conv_forward_strides
 conv_backward_fast = conv_backward_strides
 
 
+def conv_forward_inference(x, w, b, conv_param, chunk_size=64):
+    """
+    Forward pass of a convolutional layer for inference only. It computes
+    the same output as conv_forward_strides but builds no cache, and forms
+    the im2col matrix for chunk_size images at a time, so that it is never
+    held for the whole batch.
+
+    Inputs are the same as conv_forward_strides, plus:
+    - chunk_size: Number of images convolved at once.
+
+    Returns:
+    - out: Output data, of shape (N, F, H', W')
+    """
+    N = x.shape[0]
+    F, _, HH, WW = w.shape
+    stride, pad = conv_param['stride'], conv_param['pad']
+    w_rows = w.reshape(F, -1)
+    b_col = b.reshape(-1, 1)
+
+    out = None
+    for start in range(0, N, chunk_size):
+        x_chunk = x[start:start + chunk_size]
+        x_cols, out_h, out_w = _im2col_strides(x_chunk, HH, WW, stride, pad)
+        res = w_rows.dot(x_cols)
+        del x_cols
+        res += b_col
+        res.shape = (F, x_chunk.shape[0], out_h, out_w)
+        if out is None:
+            out = np.empty((N, F, out_h, out_w), dtype=res.dtype)
+        out[start:start + x_chunk.shape[0]] = res.transpose(1, 0, 2, 3)
+    return out
+
+
 def max_pool_forward_fast(x, pool_param):
     """
     A fast implementation of the forward pass for a max pooling layer.
@@ -154,6 +198,30 @@ def max_pool_forward_fast(x, pool_param):
     return out, cache
 
 
+def max_pool_forward_inference(x, pool_param):
+    """
+    Forward pass of a max pooling layer for inference only: the same output
+    as max_pool_forward_fast, without a cache. Pooling regions that tile the
+    input are reduced by taking the elementwise maximum of one strided view
+    per position in the region, in place in the output.
+    """
+    N, C, H, W = x.shape
+    pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+    stride = pool_param['stride']
+
+    same_size = pool_height == pool_width == stride
+    tiles = H % pool_height == 0 and W % pool_width == 0
+    if same_size and tiles:
+        out = x[:, :, ::stride, ::stride].copy()
+        for i in range(pool_height):
+            for j in range(pool_width):
+                if i or j:
+                    np.maximum(out, x[:, :, i::stride, j::stride], out=out)
+        return out
+    out, _ = max_pool_forward_im2col(x, pool_param)
+    return out
+
+
 def max_pool_backward_fast(dout, cache):
     """
     A fast implementation of the backward pass for a max pooling layer.
@@ -0,0 +1,243 @@
+"""
+Test-time graph optimization. A trained model is exported as a list of
+layers, the list is optimized for inference, and the result is wrapped in an
+InferenceModel that computes the same scores with fewer passes over memory:
+
+model = FullyConnectedNet(..., use_batchnorm=True, dropout=0.5)
+solver = Solver(model, data, ...)
+solver.train()
+fast_model = optimize_for_inference(model)
+scores = fast_model.loss(X)
+
+Each layer is a dictionary with a 'type' key and the arrays it needs:
+- 'affine': 'w', 'b'
+- 'conv': 'w', 'b', 'conv_param'
+- 'batchnorm', 'spatial_batchnorm': 'gamma', 'beta', 'running_mean',
+  'running_var'
+- 'relu'
+- 'max_pool': 'pool_param'
+- 'dropout'
+and, after optimization:
+- 'scale_shift': 'scale', 'shift'; a batch normalization reduced to one
+  multiply and one add
+- 'affine_relu': 'w', 'b'
+- 'conv_relu_pool': 'w', 'b', 'conv_param', 'pool_param'
+"""
+
+from builtins import object
+import numpy as np
+
+from iiisai.layers import *
+from iiisai.fast_layers import *
+from iiisai.layer_utils import *
+
+
+def export_layers(model):
+    """
+    Describe the test-time computation of a model as a list of layers.
+
+    Inputs:
+    - model: A TwoLayerNet, FullyConnectedNet or ThreeLayerConvNet. A model
+      with batch normalization must have been trained, so that its running
+      means and variances exist.
+
+    Returns:
+    - layers: List of layer dictionaries, holding references to the
+      parameters of the model.
+    """
+    from iiisai.classifiers.cnn import ThreeLayerConvNet
+    from iiisai.classifiers.fc_net import FullyConnectedNet, TwoLayerNet
+
+    params = model.params
+    if isinstance(model, ThreeLayerConvNet):
+        filter_size = params['W1'].shape[2]
+        return [
+            {'type': 'conv', 'w': params['W1'], 'b': params['b1'],
+             'conv_param': {'stride': 1, 'pad': (filter_size - 1) // 2}},
+            {'type': 'relu'},
+            {'type': 'max_pool',
+             'pool_param': {'pool_height': 2, 'pool_width': 2, 'stride': 2}},
+            {'type': 'affine', 'w': params['W2'], 'b': params['b2']},
+            {'type': 'relu'},
+            {'type': 'affine', 'w': params['W3'], 'b': params['b3']},
+        ]
+    if isinstance(model, TwoLayerNet):
+        return [
+            {'type': 'affine', 'w': params['W1'], 'b': params['b1']},
+            {'type': 'relu'},
+            {'type': 'affine', 'w': params['W2'], 'b': params['b2']},
+        ]
+    if not isinstance(model, FullyConnectedNet):
+        raise ValueError('Cannot export a model of type %s' %
+                         type(model).__name__)
+
+    layers = []
+    for i in range(1, model.num_layers):
+        layers.append({'type': 'affine', 'w': params['W{}'.format(i)],
+                       'b': params['b{}'.format(i)]})
+        if model.use_batchnorm:
+            bn_param = model.bn_params[i - 1]
+            if 'running_mean' not in bn_param:
+                raise ValueError('Batch normalization layer %d has no running '
+                                 'statistics; train the model first' % i)
+            layers.append({'type': 'batchnorm',
+                           'gamma': params['gamma{}'.format(i)],
+                           'beta': params['beta{}'.format(i)],
+                           'running_mean': bn_param['running_mean'],
+                           'running_var': bn_param['running_var']})
+        layers.append({'type': 'relu'})
+        if model.use_dropout:
+            layers.append({'type': 'dropout'})
+    layers.append({'type': 'affine',
+                   'w': params['W{}'.format(model.num_layers)],
+                   'b': params['b{}'.format(model.num_layers)]})
+    return layers
+
+
+def optimize_layers(layers):
+    """
+    Optimize a list of layers for inference:
+    - Dropout layers are removed, since inverted dropout does nothing at test
+      time.
+    - Batch normalization that follows an affine or convolutional layer is
+      folded into its weights and biases; any other batch normalization
+      becomes a 'scale_shift' layer.
+    - An affine layer followed by a ReLU becomes an 'affine_relu' layer, and a
+      convolution followed by a ReLU and a max pool a 'conv_relu_pool' layer,
+      which run their ReLUs in place.
+
+    The input layers and their arrays are not modified.
+
+    Inputs:
+    - layers: List of layer dictionaries, as returned by export_layers.
+
+    Returns:
+    - optimized: The optimized list of layer dictionaries.
+    """
+    folded = []
+    for layer in layers:
+        kind = layer['type']
+        if kind == 'dropout':
+            continue
+        if kind not in ('batchnorm', 'spatial_batchnorm'):
+            folded.append(dict(layer))
+            continue
+
+        # The test-time output of batchnorm_forward is x * scale + shift
+        scale = layer['gamma'] / np.sqrt(layer['running_var'])
+        shift = layer['beta'] - layer['running_mean'] * scale
+        previous = folded[-1] if folded else None
+        if (previous is not None and
+                (previous['type'], kind) in (('affine', 'batchnorm'),
+                                             ('conv', 'spatial_batchnorm'))):
+            w = previous['w']
+            if kind == 'batchnorm':
+                previous['w'] = w * scale.astype(w.dtype)
+            else:
+                previous['w'] = w * scale.astype(w.dtype)[:, None, None, None]
+            previous['b'] = (previous['b'] * scale + shift).astype(w.dtype)
+        elif kind == 'batchnorm':
+            folded.append({'type': 'scale_shift', 'scale': scale,
+                           'shift': shift})
+        else:
+            folded.append({'type': 'scale_shift',
+                           'scale': scale[:, None, None],
+                           'shift': shift[:, None, None]})
+
+    optimized = []
+    i = 0
+    while i < len(folded):
+        layer = folded[i]
+        kinds = tuple(l['type'] for l in folded[i:i + 3])
+        if kinds[:2] == ('affine', 'relu'):
+            optimized.append({'type': 'affine_relu', 'w': layer['w'],
+                              'b': layer['b']})
+            i += 2
+        elif kinds == ('conv', 'relu', 'max_pool'):
+            optimized.append({'type': 'conv_relu_pool', 'w': layer['w'],
+                              'b': layer['b'],
+                              'conv_param': layer['conv_param'],
+                              'pool_param': folded[i + 2]['pool_param']})
+            i += 3
+        else:
+            optimized.append(layer)
+            i += 1
+    return optimized
+
+
+def run_layers(layers, X):
+    """
+    Compute the output of a list of layers for a minibatch X, without
+    building any caches.
+    """
+    out = X
+    for layer in layers:
+        kind = layer['type']
+        if kind == 'affine':
+            out = affine_forward_inference(out, layer['w'], layer['b'])
+        elif kind == 'affine_relu':
+            out = affine_relu_forward_inference(out, layer['w'], layer['b'])
+        elif kind == 'conv':
+            out = conv_forward_inference(out, layer['w'], layer['b'],
+                                         layer['conv_param'])
+        elif kind == 'conv_relu_pool':
+            out = conv_relu_pool_forward_inference(out, layer['w'],
+                                                   layer['b'],
+                                                   layer['conv_param'],
+                                                   layer['pool_param'])
+        elif kind == 'relu':
+            out = np.maximum(out, 0)
+        elif kind == 'max_pool':
+            out = max_pool_forward_inference(out, layer['pool_param'])
+        elif kind in ('batchnorm', 'spatial_batchnorm'):
+            bn_param = {'mode': 'test',
+                        'running_mean': layer['running_mean'],
+                        'running_var': layer['running_var']}
+            forward = (batchnorm_forward if kind == 'batchnorm'
+                       else spatial_batchnorm_forward)
+            out, _ = forward(out, layer['gamma'], layer['beta'], bn_param)
+        elif kind == 'scale_shift':
+            out = out * layer['scale']
+            out += layer['shift']
+        elif kind == 'dropout':
+            pass
+        else:
+            raise ValueError('Unrecognized layer type "%s"' % kind)
+    return out
+
+
+class InferenceModel(object):
+    """
+    A model that only computes test-time scores, from a list of layers. It
+    follows the API of the classifiers in test mode, so that it can be used
+    with Solver.check_accuracy.
+    """
+
+    def __init__(self, layers, dtype=np.float32):
+        """
+        Inputs:
+        - layers: List of layer dictionaries.
+        - dtype: Data type the input is converted to.
+        """
+        self.layers = layers
+        self.dtype = dtype
+
+    def loss(self, X, y=None):
+        """
+        Compute the scores for X; y must be None.
+        """
+        if y is not None:
+            raise ValueError('An InferenceModel can only compute scores')
+        return run_layers(self.layers, np.asarray(X, dtype=self.dtype))
+
+
+def optimize_for_inference(model):
+    """
+    Export a trained model and optimize it for inference; see export_layers
+    and optimize_layers.
+
+    Returns:
+    - An InferenceModel computing the test-time scores of model.
+    """
+    dtype = getattr(model, 'dtype', model.params['W1'].dtype)
+    return InferenceModel(optimize_layers(export_layers(model)), dtype)
@@ -21,6 +21,16 @@ def affine_relu_forward(x, w, b):
     return out, cache
 
 
+def affine_relu_forward_inference(x, w, b):
+    """
+    Affine transform followed by a ReLU for inference only: the ReLU is
+    applied in place to the output of the affine layer and no cache is built.
+    """
+    out = affine_forward_inference(x, w, b)
+    np.maximum(out, 0, out=out)
+    return out
+
+
 def affine_relu_backward(dout, cache):
     """
     Backward pass for the affine-relu convenience layer
@@ -31,6 +41,50 @@ def affine_relu_backward(dout, cache):
     return dx, dw, db
 
 
+def affine_bn_relu_forward(x, w, b, gamma, beta, bn_param):
+    """
+    Convenience layer that performs an affine transform, batch normalization
+    and a ReLU.
+
+    Inputs:
+    - x: Input to the affine layer
+    - w, b: Weights for the affine layer
+    - gamma, beta, bn_param: Parameters for the batch normalization layer
+
+    Returns a tuple of:
+    - out: Output from the ReLU
+    - cache: Object to give to the backward pass
+    """
+    a, fc_cache = affine_forward(x, w, b)
+    an, bn_cache = batchnorm_forward(a, gamma, beta, bn_param)
+    out, relu_cache = relu_forward(an)
+    cache = (fc_cache, bn_cache, relu_cache)
+    return out, cache
+
+
+def affine_bn_relu_forward_inference(x, w, b, gamma, beta, bn_param):
+    """
+    Affine transform, test-time batch normalization and a ReLU for inference
+    only: the normalization and the ReLU are applied in place to the output
+    of the affine layer and no cache is built.
+    """
+    out = affine_forward_inference(x, w, b)
+    batchnorm_forward_inference(out, gamma, beta, bn_param)
+    np.maximum(out, 0, out=out)
+    return out
+
+
+def affine_bn_relu_backward(dout, cache):
+    """
+    Backward pass for the affine-batchnorm-relu convenience layer
+    """
+    fc_cache, bn_cache, relu_cache = cache
+    dan = relu_backward(dout, relu_cache)
+    da, dgamma, dbeta = batchnorm_backward(dan, bn_cache)
+    dx, dw, db = affine_backward(da, fc_cache)
+    return dx, dw, db, dgamma, dbeta
+
+
 def conv_relu_forward(x, w, b, conv_param):
     """
     A convenience layer that performs a convolution followed by a ReLU.
@@ -95,6 +149,18 @@ def conv_relu_pool_forward(x, w, b, conv_param, pool_param):
     return out, cache
 
 
+def conv_relu_pool_forward_inference(x, w, b, conv_param, pool_param):
+    """
+    Convolution, ReLU and pool for inference only. Neither caches nor the
+    im2col matrix of the whole batch are kept, and since max pooling commutes
+    with the ReLU, the ReLU is applied in place to the smaller pooled output.
+    """
+    a = conv_forward_inference(x, w, b, conv_param)
+    out = max_pool_forward_inference(a, pool_param)
+    np.maximum(out, 0, out=out)
+    return out
+
+
 def conv_relu_pool_backward(dout, cache):
     """
     Backward pass for the conv-relu-pool convenience layer
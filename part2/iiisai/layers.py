@@ -38,6 +38,16 @@ def affine_forward(x, w, b):
     return out, cache
 
 
+def affine_forward_inference(x, w, b):
+    """
+    Forward pass of an affine layer for inference only: the same output as
+    affine_forward, with the bias added in place and no cache.
+    """
+    out = x.reshape(x.shape[0], -1).dot(w)
+    out += b
+    return out
+
+
 def affine_backward(dout, cache):
     """
     Computes the backward pass for an affine layer.
@@ -108,12 +118,7 @@ def relu_backward(dout, cache):
     ###########################################################################
     # TODO: Implement the ReLU backward pass.                                 #
     ###########################################################################
-    positive_mask = x > 0
-
-    filtering = np.zeros(x.shape)
-    filtering[positive_mask] = 1
-
-    dx = dout * filtering
+    dx = dout * (x > 0)
     ###########################################################################
     #                             END OF YOUR CODE                            #
     ###########################################################################
@@ -221,6 +226,22 @@ def batchnorm_forward(x, gamma, beta, bn_param):
     return out, cache
 
 
+def batchnorm_forward_inference(x, gamma, beta, bn_param):
+    """
+    Test-time forward pass for batch normalization, for inference only: the
+    same output as batchnorm_forward in 'test' mode, computed in place in x
+    from the running mean and variance of bn_param, with no cache.
+    """
+    D = x.shape[1]
+    running_mean = bn_param.get('running_mean', np.zeros(D, dtype=x.dtype))
+    running_var = bn_param.get('running_var', np.zeros(D, dtype=x.dtype))
+    x -= running_mean
+    x /= np.sqrt(running_var)
+    x *= gamma
+    x += beta
+    return x
+
+
 def batchnorm_backward(dout, cache):
     """
     Backward pass for batch normalization.
@@ -333,7 +354,8 @@ def dropout_forward(x, dropout_param):
         # TODO: Implement training phase forward pass for inverted dropout.   #
         # Store the dropout mask in the mask variable.                        #
         #######################################################################
-        pass
+        mask = (np.random.rand(*x.shape) >= p) / (1 - p)
+        out = x * mask
         #######################################################################
         #                           END OF YOUR CODE                          #
         #######################################################################
@@ -341,7 +363,7 @@ def dropout_forward(x, dropout_param):
         #######################################################################
         # TODO: Implement the test phase forward pass for inverted dropout.   #
         #######################################################################
-        pass
+        out = x
         #######################################################################
         #                            END OF YOUR CODE                         #
         #######################################################################
@@ -368,7 +390,7 @@ def dropout_backward(dout, cache):
         #######################################################################
         # TODO: Implement training phase backward pass for inverted dropout   #
         #######################################################################
-        pass
+        dx = dout * mask
         #######################################################################
         #                          END OF YOUR CODE                           #
         #######################################################################
@@ -709,7 +731,45 @@ def svm_loss(x, y):
     return loss, dx
 
 
-def softmax_loss(x, y):
+def softmax_inplace(x):
+    """
+    Overwrites scores with their softmax probabilities. This is the kernel
+    shared by softmax and the softmax losses: the scores are shifted by
+    their maximum so that large scores cannot overflow, and no array the
+    size of x is allocated, so it works in the dtype of x (e.g. float32).
+
+    Inputs:
+    - x: Scores of shape (N, C), overwritten with the probabilities.
+
+    Returns:
+    - log_Z: Array of shape (N,) giving the log of the normalizer of each row,
+      log(sum_j exp(x[i, j])) for the original scores.
+    """
+    shift = np.max(x, axis=1, keepdims=True)
+    x -= shift
+    np.exp(x, out=x)
+    Z = np.sum(x, axis=1, keepdims=True)
+    x /= Z
+    return (np.log(Z) + shift)[:, 0]
+
+
+def softmax(x, overwrite_x=False):
+    """
+    Computes softmax probabilities.
+
+    Inputs:
+    - x: Scores of shape (N, C).
+    - overwrite_x: If True, the probabilities are written into x.
+
+    Returns:
+    - probs: Softmax probabilities, of the same shape as x
+    """
+    probs = x if overwrite_x else x.copy()
+    softmax_inplace(probs)
+    return probs
+
+
+def softmax_loss(x, y, overwrite_x=False):
     """
     Computes the loss and gradient for softmax classification.
 
@@ -718,18 +778,18 @@ def softmax_loss(x, y):
       class for the ith input.
     - y: Vector of labels, of shape (N,) where y[i] is the label for x[i] and
       0 <= y[i] < C
+    - overwrite_x: If True, dx is computed in place in x instead of in a new
+      array, for callers that no longer need the scores.
 
     Returns a tuple of:
     - loss: Scalar giving the loss
     - dx: Gradient of the loss with respect to x
     """
-    shifted_logits = x - np.max(x, axis=1, keepdims=True)
-    Z = np.sum(np.exp(shifted_logits), axis=1, keepdims=True)
-    log_probs = shifted_logits - np.log(Z)
-    probs = np.exp(log_probs)
     N = x.shape[0]
-    loss = -np.sum(log_probs[np.arange(N), y]) / N
-    dx = probs.copy()
+    correct_class_scores = x[np.arange(N), y]
+    dx = x if overwrite_x else x.copy()
+    log_Z = softmax_inplace(dx)
+    loss = np.sum(log_Z - correct_class_scores) / N
     dx[np.arange(N), y] -= 1
     dx /= N
     return loss, dx
@@ -0,0 +1,95 @@
+from builtins import object
+import numpy as np
+
+
+class MinibatchSampler(object):
+    """
+    A MinibatchSampler hands out minibatches for stochastic gradient descent.
+
+    Instead of drawing every minibatch with np.random.choice (sampling with
+    replacement, one random gather per step), the training set is shuffled
+    once per epoch and the permutation is cut into contiguous windows of
+    batch_size indices, so each epoch visits every example once. A window that
+    would run past the end of the permutation starts a new epoch; the
+    leftover examples are visited in a later epoch instead.
+
+    With reorder=True the arrays themselves are permuted once per epoch,
+    with one gather each, and every minibatch is then a contiguous slice of
+    them, i.e. a view that costs nothing to take. This trades one extra copy
+    of the arrays in memory for cheaper steps.
+
+    Example usage:
+
+    sampler = MinibatchSampler((X_train, y_train), batch_size=100)
+    for t in range(num_iterations):
+        X_batch, y_batch = sampler.sample()
+        ...
+
+    Randomness comes from np.random, so np.random.seed makes it repeatable.
+    """
+
+    def __init__(self, arrays, batch_size, reorder=False):
+        """
+        Construct a new MinibatchSampler.
+
+        Inputs:
+        - arrays: Tuple of arrays with the same first dimension N, such as
+          (X_train, y_train); minibatches are taken from all of them at once.
+        - batch_size: Number of examples per minibatch.
+        - reorder: If True, permute the arrays once per epoch and return
+          minibatches as slices of them.
+        """
+        self.arrays = tuple(arrays)
+        self.num_train = self.arrays[0].shape[0]
+        self.batch_size = batch_size
+        self.reorder = reorder and batch_size <= self.num_train
+        self.epoch = 0
+        self._new_epoch()
+
+    def _new_epoch(self):
+        """
+        Draw the permutation of a new epoch and rewind to its start.
+        """
+        self.order = np.random.permutation(self.num_train)
+        self.position = 0
+        if self.reorder:
+            self._shuffled = [a[self.order] for a in self.arrays]
+
+    def sample_indices(self):
+        """
+        Return the indices into the arrays of the next minibatch.
+        """
+        if self.batch_size > self.num_train:
+            # Minibatches larger than the training set span several epochs.
+            windows = []
+            needed = self.batch_size
+            while needed > 0:
+                if self.position == self.num_train:
+                    self._new_epoch()
+                    self.epoch += 1
+                stop = min(self.num_train, self.position + needed)
+                windows.append(self.order[self.position:stop])
+                needed -= stop - self.position
+                self.position = stop
+            return np.concatenate(windows)
+
+        if self.position + self.batch_size > self.num_train:
+            self._new_epoch()
+            self.epoch += 1
+        start = self.position
+        self.position += self.batch_size
+        return self.order[start:self.position]
+
+    def sample(self):
+        """
+        Return the next minibatch as a tuple with one array per input array.
+        """
+        if not self.reorder:
+            indices = self.sample_indices()
+            return tuple(a[indices] for a in self.arrays)
+        if self.position + self.batch_size > self.num_train:
+            self._new_epoch()
+            self.epoch += 1
+        start = self.position
+        self.position += self.batch_size
+        return tuple(a[start:self.position] for a in self._shuffled)
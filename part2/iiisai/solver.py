@@ -9,6 +9,7 @@ import pickle as pickle
 import numpy as np
 
 from iiisai import optim
+from iiisai.sampler import MinibatchSampler
 
 
 class Solver(object):
@@ -102,6 +103,10 @@ class Solver(object):
           learning rate is multiplied by this value.
         - batch_size: Size of minibatches used to compute loss and gradient
           during training.
+        - reorder_data: Boolean; if set to true then the training data is
+          permuted once per epoch so that minibatches are contiguous slices
+          of it, at the cost of a second copy of the training data. See
+          MinibatchSampler.
         - num_epochs: The number of epochs to run for during training.
         - print_every: Integer; training losses will be printed every
           print_every iterations.
@@ -125,6 +130,7 @@ class Solver(object):
         self.optim_config = kwargs.pop('optim_config', {})
         self.lr_decay = kwargs.pop('lr_decay', 1.0)
         self.batch_size = kwargs.pop('batch_size', 100)
+        self.reorder_data = kwargs.pop('reorder_data', False)
         self.num_epochs = kwargs.pop('num_epochs', 10)
         self.num_train_samples = kwargs.pop('num_train_samples', 1000)
         self.num_val_samples = kwargs.pop('num_val_samples', None)
@@ -160,6 +166,12 @@ class Solver(object):
         self.train_acc_history = []
         self.val_acc_history = []
 
+        # Minibatches are drawn from a new permutation of the training data
+        # every epoch
+        self.sampler = MinibatchSampler((self.X_train, self.y_train),
+                                        self.batch_size,
+                                        reorder=self.reorder_data)
+
         # Make a deep copy of the optim_config for each parameter
         self.optim_configs = {}
         for p in self.model.params:
@@ -173,10 +185,7 @@ class Solver(object):
         be called manually.
         """
         # Make a minibatch of training data
-        num_train = self.X_train.shape[0]
-        batch_mask = np.random.choice(num_train, self.batch_size)
-        X_batch = self.X_train[batch_mask]
-        y_batch = self.y_train[batch_mask]
+        X_batch, y_batch = self.sampler.sample()
 
         # Compute loss and gradient
         loss, grads = self.model.loss(X_batch, y_batch)
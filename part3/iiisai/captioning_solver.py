@@ -5,6 +5,7 @@ import numpy as np
 
 from iiisai import optim
 from iiisai.coco_utils import sample_coco_minibatch
+from iiisai.sampler import MinibatchSampler
 
 
 class CaptioningSolver(object):
@@ -129,6 +130,12 @@ class CaptioningSolver(object):
         self.train_acc_history = []
         self.val_acc_history = []
 
+        # Minibatches are drawn from a new permutation of the training
+        # captions every epoch
+        self.sampler = MinibatchSampler((self.data['train_captions'],
+                                         self.data['train_image_idxs']),
+                                        self.batch_size)
+
         # Make a deep copy of the optim_config for each parameter
         self.optim_configs = {}
         for p in self.model.params:
@@ -144,7 +151,8 @@ class CaptioningSolver(object):
         # Make a minibatch of training data
         minibatch = sample_coco_minibatch(self.data,
                       batch_size=self.batch_size,
-                      split='train')
+                      split='train',
+                      sampler=self.sampler)
         captions, features, urls = minibatch
 
         # Compute loss and gradient
@@ -75,11 +75,16 @@ def decode_captions(captions, idx_to_word):
     return decoded
 
 
-def sample_coco_minibatch(data, batch_size=100, split='train'):
-    split_size = data['%s_captions' % split].shape[0]
-    mask = np.random.choice(split_size, batch_size)
-    captions = data['%s_captions' % split][mask]
-    image_idxs = data['%s_image_idxs' % split][mask]
+def sample_coco_minibatch(data, batch_size=100, split='train', sampler=None):
+    # A MinibatchSampler over (captions, image_idxs) of the split replaces
+    # sampling with replacement by one pass over the split per epoch.
+    if sampler is not None:
+        captions, image_idxs = sampler.sample()
+    else:
+        split_size = data['%s_captions' % split].shape[0]
+        mask = np.random.choice(split_size, batch_size)
+        captions = data['%s_captions' % split][mask]
+        image_idxs = data['%s_image_idxs' % split][mask]
     image_features = data['%s_features' % split][image_idxs]
     urls = data['%s_urls' % split][image_idxs]
     return captions, image_features, urls
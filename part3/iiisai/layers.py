@@ -277,25 +277,65 @@ def svm_loss(x, y):
     return loss, dx
 
 
-def softmax_loss(x, y):
+def softmax_inplace(x):
+    """
+    Overwrites scores with their softmax probabilities. This is the kernel
+    shared by softmax and the softmax losses: the scores are shifted by
+    their maximum so that large scores cannot overflow, and no array the
+    size of x is allocated, so it works in the dtype of x (e.g. float32).
+
+    Inputs:
+    - x: Scores of shape (N, C), overwritten with the probabilities.
+
+    Returns:
+    - log_Z: Array of shape (N,) giving the log of the normalizer of each row,
+      log(sum_j exp(x[i, j])) for the original scores.
+    """
+    shift = np.max(x, axis=1, keepdims=True)
+    x -= shift
+    np.exp(x, out=x)
+    Z = np.sum(x, axis=1, keepdims=True)
+    x /= Z
+    return (np.log(Z) + shift)[:, 0]
+
+
+def softmax(x, overwrite_x=False):
+    """
+    Computes softmax probabilities.
+
+    Inputs:
+    - x: Scores of shape (N, C).
+    - overwrite_x: If True, the probabilities are written into x.
+
+    Returns:
+    - probs: Softmax probabilities, of the same shape as x
+    """
+    probs = x if overwrite_x else x.copy()
+    softmax_inplace(probs)
+    return probs
+
+
+def softmax_loss(x, y, overwrite_x=False):
     """
     Computes the loss and gradient for softmax classification.
 
     Inputs:
-    - x: Input data, of shape (N, C) where x[i, j] is the score for the jth class
-      for the ith input.
+    - x: Input data, of shape (N, C) where x[i, j] is the score for the jth
+      class for the ith input.
     - y: Vector of labels, of shape (N,) where y[i] is the label for x[i] and
       0 <= y[i] < C
+    - overwrite_x: If True, dx is computed in place in x instead of in a new
+      array, for callers that no longer need the scores.
 
     Returns a tuple of:
     - loss: Scalar giving the loss
     - dx: Gradient of the loss with respect to x
     """
-    probs = np.exp(x - np.max(x, axis=1, keepdims=True))
-    probs /= np.sum(probs, axis=1, keepdims=True)
     N = x.shape[0]
-    loss = -np.sum(np.log(probs[np.arange(N), y])) / N
-    dx = probs.copy()
+    correct_class_scores = x[np.arange(N), y]
+    dx = x if overwrite_x else x.copy()
+    log_Z = softmax_inplace(dx)
+    loss = np.sum(log_Z - correct_class_scores) / N
     dx[np.arange(N), y] -= 1
     dx /= N
     return loss, dx
@@ -2,6 +2,8 @@ from __future__ import print_function, division
 from builtins import range
 import numpy as np
 
+from iiisai.layers import softmax_inplace
+
 
 """
 This file defines layer types that are commonly used for recurrent neural
@@ -526,10 +528,10 @@ def temporal_softmax_loss(x, y, mask, verbose=False):
     y_flat = y.reshape(N * T)
     mask_flat = mask.reshape(N * T)
 
-    probs = np.exp(x_flat - np.max(x_flat, axis=1, keepdims=True))
-    probs /= np.sum(probs, axis=1, keepdims=True)
-    loss = -np.sum(mask_flat * np.log(probs[np.arange(N * T), y_flat])) / N
-    dx_flat = probs.copy()
+    correct_class_scores = x_flat[np.arange(N * T), y_flat]
+    dx_flat = x_flat.copy()
+    log_Z = softmax_inplace(dx_flat)
+    loss = np.sum(mask_flat * (log_Z - correct_class_scores)) / N
     dx_flat[np.arange(N * T), y_flat] -= 1
     dx_flat /= N
     dx_flat *= mask_flat[:, None]